@@ -69,6 +69,10 @@ class Config:
     up_to_layer: Union[int, str] = "all"
     ablate_component:str = "all"
     flag: str = ""
+    token_budget: Optional[int] = None
+    sweep_budget_mb: Optional[int] = None
+    streaming: bool = False
+    tokenization_cache_dir: Optional[str] = "../data/tokenization_cache"
 
     @classmethod
     def from_args(cls, args):
@@ -84,7 +88,11 @@ class Config:
             total_effect=args.total_effect if args.total_effect else False,
             hf_model_name= get_hf_model_name(args.model_name),
             ablate_component=args.ablate_component,
-            flag = args.flag
+            flag = args.flag,
+            token_budget=args.token_budget,
+            sweep_budget_mb=args.sweep_budget_mb,
+            streaming=args.streaming,
+            tokenization_cache_dir=args.tokenization_cache_dir,
         )
         
     def to_json(self):
@@ -100,7 +108,11 @@ class Config:
             "total_effect": self.total_effect,
             "hf_model_name": self.hf_model_name,
             "ablate_component": self.ablate_component,
-            "flag": self.flag
+            "flag": self.flag,
+            "token_budget": self.token_budget,
+            "sweep_budget_mb": self.sweep_budget_mb,
+            "streaming": self.streaming,
+            "tokenization_cache_dir": self.tokenization_cache_dir,
         }
 
 def get_dataset_path(args):
@@ -135,8 +147,8 @@ def logit_attribution(model, dataset, config, args):
         dataset_slice_name if config.up_to_layer == "all" else f"{dataset_slice_name}_layer_{config.up_to_layer}"
     )
     print("Running logit attribution")
-    attributor = LogitAttribution(dataset, model, config.batch_size // 5, config.experiment)
-    dataframe = attributor.run(apply_ln=False, normalize_logit=config.normalize_logit, up_to_layer=config.up_to_layer)
+    attributor = LogitAttribution(dataset, model, config.batch_size // 5, config.experiment, token_budget=config.token_budget)
+    dataframe = attributor.run(apply_ln=False, normalize_logit=config.normalize_logit, up_to_layer=config.up_to_layer, streaming=config.streaming)
     save_dataframe(
         f"../results/{config.experiment}{config.flag}/logit_attribution/{config.model_name}_{dataset_slice_name}",
         "logit_attribution_data",
@@ -167,6 +179,7 @@ def logit_lens(model, dataset, config, args):
         logit_lens_cnfg.component,
         logit_lens_cnfg.return_index,
         normalize_logit=config.normalize_logit,
+        streaming=config.streaming,
     )
     save_dataframe(
         f"../results/{config.experiment}{config.flag}/logit_lens/{config.model_name}_{data_slice_name}",
@@ -193,10 +206,22 @@ def ablate(model, dataset, config, args):
     data_slice_name = "full" if config.dataset_end is None else config.dataset_end
     start_slice_name = "" if config.dataset_start is None else f"{config.dataset_start}_"
     data_slice_name = f"{start_slice_name}{data_slice_name}_total_effect" if config.total_effect else data_slice_name
+    # estimated effects are saved apart from the exact ones
+    data_slice_name = f"{data_slice_name}_attribution_patching" if args.attribution_patching else data_slice_name
+    # streaming runs save the means (mem_mean, cp_mean, n_examples) instead of the per-example logits
+    data_slice_name = f"{data_slice_name}_streaming" if config.streaming else data_slice_name
     LOAD_FROM_PT = None
-    ablator = Ablate(dataset, model, config.batch_size, config.experiment)
+    ablator = Ablate(
+        dataset,
+        model,
+        config.batch_size,
+        config.experiment,
+        sweep_budget_mb=config.sweep_budget_mb,
+        checkpoint_dir=args.checkpoint_dir,
+        resume=args.resume,
+    )
     if args.ablate_component == "all":
-        dataframe, tuple_results = ablator.run_all(normalize_logit=config.normalize_logit, total_effect=args.total_effect, load_from_pt=LOAD_FROM_PT)
+        dataframe, tuple_results = ablator.run_all(normalize_logit=config.normalize_logit, total_effect=args.total_effect, load_from_pt=LOAD_FROM_PT, approximate=args.attribution_patching, streaming=config.streaming)
         save_dataframe(
             f"../results/{config.experiment}{config.flag}/ablation/{config.model_name}_{data_slice_name}",
             "ablation_data",
@@ -204,7 +229,7 @@ def ablate(model, dataset, config, args):
         )
         torch.save(tuple_results, f"../results/{config.experiment}{config.flag}/ablation/{config.model_name}_{data_slice_name}/ablation_data.pt")
     else:
-        dataframe, tuple_results = ablator.run(args.ablate_component, normalize_logit=config.normalize_logit, total_effect=args.total_effect, load_from_pt=LOAD_FROM_PT)
+        dataframe, tuple_results = ablator.run(args.ablate_component, normalize_logit=config.normalize_logit, total_effect=args.total_effect, load_from_pt=LOAD_FROM_PT, approximate=args.attribution_patching, streaming=config.streaming)
         save_dataframe(
             f"../results/{config.experiment}{config.flag}/ablation/{config.model_name}_{data_slice_name}",
             f"ablation_data_{args.ablate_component}",
@@ -231,8 +256,8 @@ def ablate_plot(config, data_slice_name):
 def pattern(model, dataset, config, args):
     data_slice_name = "full" if config.dataset_end is None else config.dataset_end
     print("Running head pattern")
-    pattern = HeadPattern(dataset, model, config.batch_size, config.experiment)
-    dataframe = pattern.run()
+    pattern = HeadPattern(dataset, model, config.batch_size, config.experiment, token_budget=config.token_budget)
+    dataframe = pattern.run(streaming=config.streaming)
     save_dataframe(
         f"../results/{config.experiment}{config.flag}/head_pattern/{config.model_name}_{data_slice_name}",
         "head_pattern_data",
@@ -309,7 +334,7 @@ def main(args):
     if args.dataset:
         return
     model = load_model(config)
-    dataset = BaseDataset(path=config.dataset_path, experiment=config.experiment, model=model, start=config.dataset_start, end=config.dataset_end)
+    dataset = BaseDataset(path=config.dataset_path, experiment=config.experiment, model=model, start=config.dataset_start, end=config.dataset_end, cache_dir=config.tokenization_cache_dir)
 
     experiments = []
     if args.logit_attribution:
@@ -352,12 +377,20 @@ if __name__ == "__main__":
     parser.add_argument("--logit-lens", action="store_true")
     parser.add_argument("--ablate", action="store_true")
     parser.add_argument("--total-effect", action="store_true")
+    parser.add_argument("--attribution-patching", action="store_true", help="estimate the ablations with one forward and backward per batch")
     parser.add_argument("--pattern", action="store_true")
     parser.add_argument("--all", action="store_true")
     parser.add_argument("--dataset", action="store_true", default=False)
     parser.add_argument("--ablate-component", type=str, default="all")
     parser.add_argument("--experiment", type=str, default="")
     parser.add_argument("--flag", type=str, default="")
+    parser.add_argument("--token-budget", type=int, default=config_defaults.token_budget, help="pack prompts of different lengths in padded batches of at most this many tokens")
+    parser.add_argument("--sweep-budget-mb", type=int, default=config_defaults.sweep_budget_mb, help="evaluate several ablations per forward by stacking copies of the batch, within this many MB of activations")
+    parser.add_argument("--checkpoint-dir", type=str, default=None, help="save the ablation logits of each batch in this directory")
+    parser.add_argument("--resume", action="store_true", help="resume the ablation run saved in --checkpoint-dir")
+    parser.add_argument("--streaming", action="store_true", help="keep running statistics instead of the per-example results")
+    parser.add_argument("--tokenization-cache-dir", type=str, default=config_defaults.tokenization_cache_dir, help="cache the tokenized dataset in this directory")
+    parser.add_argument("--no-tokenization-cache", dest="tokenization_cache_dir", action="store_const", const=None, help="do not cache the tokenized dataset on disk")
     
     args = parser.parse_args()
     main(args)
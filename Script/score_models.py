@@ -24,6 +24,8 @@ import ipdb
 from Src.model import ModelFactory, BaseModel
 
 NUM_SAMPLES = 1
+SIMILARITY_SOURCE = "word2vec"
+TOKENIZATION_CACHE_DIR = "../data/tokenization_cache"
 FAMILY_NAME = "gpt2"
 
 
@@ -136,6 +138,8 @@ def init_dataset(config: LaunchConfig, model: BaseModel):
         experiment=config.experiment,
         similarity=(config.similarity, config.interval, config.similarity_type),
         no_subject=True,
+        similarity_source=SIMILARITY_SOURCE,
+        cache_dir=TOKENIZATION_CACHE_DIR,
     )
 
 
@@ -258,7 +262,10 @@ if __name__ == "__main__":
     parser.add_argument("--premise", action="store_true")
     parser.add_argument("--similarity", action="store_true")
     parser.add_argument("--similarity-type", type=str)
+    parser.add_argument("--similarity-source", type=str, default=SIMILARITY_SOURCE, choices=["word2vec", "unembed", "embed"])
     parser.add_argument("--num-samples", type=int, default=NUM_SAMPLES)
+    parser.add_argument("--tokenization-cache-dir", type=str, default=TOKENIZATION_CACHE_DIR, help="cache the tokenized dataset in this directory")
+    parser.add_argument("--no-tokenization-cache", dest="tokenization_cache_dir", action="store_const", const=None)
     parser.add_argument("--experiment", type=str, default="")
     parser.add_argument(
         "--models-name",
@@ -281,4 +288,6 @@ if __name__ == "__main__":
     args = parser.parse_args()
     NUM_SAMPLES = args.num_samples
     SIMILARITY_TYPE = args.similarity_type
+    SIMILARITY_SOURCE = args.similarity_source
+    TOKENIZATION_CACHE_DIR = args.tokenization_cache_dir
     main(args)
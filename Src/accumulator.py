@@ -0,0 +1,143 @@
+import torch
+from math import prod
+from typing import List, Optional, Sequence, Tuple, Union
+
+try:
+    from tdigest import TDigest
+except ImportError:
+    TDigest = None
+
+
+class RunningStats:
+    """
+    Running mean and variance (Welford, merged batch by batch with Chan's update) of a tensor of statistics, e.g. one per
+    (layer, position) or (layer, head). Values are given as (*shape, batch) tensors, the examples on the last dimension.
+    """
+
+    def __init__(self, shape: Union[Tuple[int, ...], torch.Size] = ()):
+        self.shape = tuple(shape)
+        self.count = torch.zeros(self.shape, dtype=torch.float64)
+        self.mean = torch.zeros(self.shape, dtype=torch.float64)
+        self.m2 = torch.zeros(self.shape, dtype=torch.float64)
+
+    @classmethod
+    def from_values(cls, values: torch.Tensor) -> "RunningStats":
+        """
+        Statistics of a (*shape, examples) tensor of per-example values
+        """
+        stats = cls(values.shape[:-1])
+        stats.update(values)
+        return stats
+
+    def update(self, values: torch.Tensor, mask: Optional[torch.Tensor] = None):
+        """
+        Add a batch of examples; with mask (shape) only the True entries are updated
+        """
+        values = values.detach().to("cpu", torch.float64)
+        n_batch = values.shape[-1]
+        if n_batch == 0:
+            return
+        batch_mean = values.mean(dim=-1)
+        batch_m2 = ((values - batch_mean.unsqueeze(-1)) ** 2).sum(dim=-1)
+        count = self.count + n_batch
+        delta = batch_mean - self.mean
+        mean = self.mean + delta * n_batch / count
+        m2 = self.m2 + batch_m2 + delta**2 * self.count * n_batch / count
+        if mask is None:
+            self.count, self.mean, self.m2 = count, mean, m2
+        else:
+            mask = mask.cpu()
+            self.count = torch.where(mask, count, self.count)
+            self.mean = torch.where(mask, mean, self.mean)
+            self.m2 = torch.where(mask, m2, self.m2)
+
+    def sum(self) -> torch.Tensor:
+        return self.mean * self.count
+
+    def std(self) -> torch.Tensor:
+        """
+        Sample standard deviation (0 with less than two examples)
+        """
+        variance = self.m2 / (self.count - 1).clamp(min=1)
+        return torch.where(self.count > 1, variance.sqrt(), torch.zeros_like(variance))
+
+    def half_width(self, z: float = 1.96) -> torch.Tensor:
+        """
+        Half width of the normal confidence interval of the mean (inf with less than two examples)
+        """
+        half_width = z * self.std() / self.count.clamp(min=1).sqrt()
+        return torch.where(self.count > 1, half_width, torch.full_like(half_width, float("inf")))
+
+    def converged(self, tolerance: float, z: float = 1.96, min_count: int = 0) -> torch.Tensor:
+        """
+        True where the half width of the confidence interval is at most tolerance, or the interval clearly excludes zero
+        """
+        half_width = self.half_width(z)
+        settled = (half_width <= tolerance) | (self.mean.abs() > half_width)
+        return settled & (self.count >= min_count)
+
+    def merge(self, other: "RunningStats"):
+        """
+        Add the examples summarized by other (same shape), e.g. the statistics of another length
+        """
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        weight = torch.where(count > 0, other.count / count.clamp(min=1), torch.zeros_like(count))
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * weight
+        self.mean = self.mean + delta * weight
+        self.count = count
+
+    def pool(self, dim: int = 0, index: Optional[Sequence[int]] = None) -> "RunningStats":
+        """
+        Statistics of the examples of all the entries along dim (only the given indices if set), as if their values had
+        been concatenated, e.g. the mean over positions and examples of each layer. nan if there are no examples.
+        """
+        count, mean, m2 = self.count, self.mean, self.m2
+        if index is not None:
+            index_tensor = torch.tensor(list(index), dtype=torch.long)
+            count, mean, m2 = (tensor.index_select(dim, index_tensor) for tensor in (count, mean, m2))
+        pooled = RunningStats(count.sum(dim).shape)
+        pooled.count = count.sum(dim)
+        pooled.mean = (count * mean).sum(dim) / pooled.count
+        pooled.m2 = m2.sum(dim) + (count * (mean - pooled.mean.unsqueeze(dim)) ** 2).sum(dim)
+        return pooled
+
+
+class RunningQuantiles:
+    """
+    Approximate quantiles of each entry with one t-digest per entry (requires the optional tdigest package).
+    Values are given as (*shape, batch) tensors, as RunningStats.
+    """
+
+    def __init__(self, shape: Union[Tuple[int, ...], torch.Size] = (), delta: float = 0.01):
+        if TDigest is None:
+            raise ImportError("RunningQuantiles requires the tdigest package: pip install tdigest")
+        self.shape = tuple(shape)
+        self.digests: List = [TDigest(delta=delta) for _ in range(prod(self.shape))]
+
+    def update(self, values: torch.Tensor, mask: Optional[torch.Tensor] = None):
+        """
+        Add a batch of examples; with mask (shape) only the True entries are updated
+        """
+        values = values.detach().to("cpu", torch.float64).reshape(len(self.digests), -1).numpy()
+        if values.shape[-1] == 0:
+            return
+        selected = None if mask is None else mask.cpu().reshape(-1).tolist()
+        for index, digest in enumerate(self.digests):
+            if selected is None or selected[index]:
+                digest.batch_update(values[index])
+
+    def merge(self, other: "RunningQuantiles"):
+        """
+        Add the examples summarized by other (same shape), e.g. the quantiles of another length
+        """
+        self.digests = [digest + other_digest for digest, other_digest in zip(self.digests, other.digests)]
+
+    def quantile(self, q: float) -> torch.Tensor:
+        """
+        q-quantile (q in [0, 1]) of each entry, nan for the entries without examples
+        """
+        return torch.tensor(
+            [digest.percentile(100 * q) if digest.n > 0 else float("nan") for digest in self.digests],
+            dtype=torch.float64,
+        ).view(self.shape)
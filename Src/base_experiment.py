@@ -1,23 +1,59 @@
 import random
 from Src.dataset import BaseDataset
-from Src.model import BaseModel
+from Src.model import BaseModel, check_left_padding, normalize_readout
 import torch
-from torch.utils.data import DataLoader
-from typing import Optional, Literal
+from typing import Dict, Iterator, List, Optional, Literal, Tuple
 # from line_profiler import profile
 
 
 torch.set_grad_enabled(False)
 
 
+def _vocab_reductions(
+    logit: torch.Tensor,
+    target_logit: torch.Tensor,
+    logsumexp: bool = True,
+    argmax: bool = True,
+    rank: bool = True,
+    chunk_size: Optional[int] = None,
+) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor], Optional[torch.Tensor]]:
+    """
+    The requested reductions over the vocabulary: logsumexp, argmax, and rank of the targets (number of strictly larger
+    logits). With chunk_size, the vocabulary is reduced chunk_size columns at a time.
+    """
+    d_vocab = logit.shape[-1]
+    chunk_size = d_vocab if chunk_size is None else chunk_size
+    batch_lse = batch_max = batch_argmax = batch_rank = None
+    for start in range(0, d_vocab, chunk_size):
+        chunk = logit[:, start : start + chunk_size]
+        if logsumexp:
+            chunk_lse = torch.logsumexp(chunk.float(), dim=-1)
+            batch_lse = chunk_lse if batch_lse is None else torch.logaddexp(batch_lse, chunk_lse)
+        if argmax:
+            chunk_max, chunk_argmax = chunk.max(dim=-1)
+            chunk_argmax = chunk_argmax + start
+            if batch_max is None:
+                batch_max, batch_argmax = chunk_max, chunk_argmax
+            else:
+                # strict comparison: the first maximum wins, as torch.argmax
+                improved = chunk_max > batch_max
+                batch_max = torch.where(improved, chunk_max, batch_max)
+                batch_argmax = torch.where(improved, chunk_argmax, batch_argmax)
+        if rank:
+            chunk_rank = (chunk.unsqueeze(1) > target_logit.unsqueeze(-1)).sum(-1)
+            batch_rank = chunk_rank if batch_rank is None else batch_rank + chunk_rank
+    return batch_lse, batch_argmax, batch_rank
+
+
 # @profile
 def to_logit_token(
     logit,
     target,
-    normalize="none",
+    normalize: Literal["none", "softmax", "log_softmax", "logsoftmax"] = "none",
     return_index=False,
     return_winners=False,
     return_rank=False,
+    vocab_chunk_size: Optional[int] = None,
 ) -> tuple[
     torch.Tensor,
     torch.Tensor,
@@ -26,52 +62,46 @@ def to_logit_token(
     Optional[int],
     Optional[int],
 ]:
+    """
+    Logits of the mem (target[:, 0]) and cp (target[:, 1]) tokens at the last position, normalized with the logsumexp
+    over the vocabulary (the full softmax is never materialized). With return_index, the 0-based rank of each target in
+    the vocabulary; with return_winners, 1 where the target is the argmax. The results are on the cpu.
+    vocab_chunk_size: reduce the vocabulary this many columns at a time, for very large vocabularies
+    """
     assert (
         len(logit.shape) in [2, 3]
     ), "logit should be of shape (batch_size, d_vocab) or (batch_size, seq_len, d_vocab)"
     if len(logit.shape) == 3:
         logit = logit[:, -1, :]  # batch_size, d_vocab
     if normalize == "logsoftmax":
-        logit = torch.log_softmax(logit, dim=-1)
-    elif normalize == "softmax":
-        logit = torch.softmax(logit, dim=-1)
-    elif normalize == "none":
-        pass
-    logit_mem = torch.zeros(target.shape[0])
-    logit_cp = torch.zeros(target.shape[0])
-    index_mem = torch.zeros(target.shape[0], dtype=torch.float32)
-    index_cp = torch.zeros(target.shape[0], dtype=torch.float32)
+        normalize = "log_softmax"
+    if normalize not in ["none", "softmax", "log_softmax"]:
+        raise ValueError(f"normalize must be one of none, softmax, log_softmax, got {normalize}")
+    target = target[:, :2].to(logit.device)
+    target_logit = logit.gather(-1, target)  # batch_size, 2
 
+    logsumexp, argmax, rank = _vocab_reductions(
+        logit,
+        target_logit,
+        logsumexp=normalize != "none",
+        argmax=return_winners,
+        rank=return_index,
+        chunk_size=vocab_chunk_size,
+    )
+    # ranks do not depend on the normalization (monotonic in the logits)
+    columns = [normalize_readout(target_logit.float(), logsumexp, normalize)]
     if return_index:
-        sorted_indices = torch.argsort(logit, descending=True)
-    # batch_indices = torch.arange(target.shape[0])
-    # logit_mem = logit[batch_indices, target[:, 0]]
-    # logit_cp = logit[batch_indices, target[:, 1]]
-    logit_argmaxs = torch.argmax(logit, dim=-1)
-    mem_winners = torch.zeros(target.shape[0], dtype=torch.float32)
-    cp_winners = torch.zeros(target.shape[0], dtype=torch.float32)
-
-    for i in range(target.shape[0]):
-        logit_mem[i] = logit[i, target[i, 0]]
-        # save the position of target[i, 0] in the logit sorted
-        # index_mem[i] = torch.argsort(logit[i], descending=True).tolist().index(target[i, 0])
-        logit_cp[i] = logit[i, target[i, 1]]
-        if return_winners:
-            if logit_argmaxs[i] == target[i, 0]:
-                mem_winners[i] = 1
-
-            if logit_argmaxs[i] == target[i, 1]:
-                cp_winners[i] = 1
-        if return_index:
-            target_expanded_0 = target[:, 0].unsqueeze(1) == sorted_indices
-            target_expanded_1 = target[:, 1].unsqueeze(1) == sorted_indices
-            index_mem = target_expanded_0.nonzero()[
-                :, 1
-            ]  # Select column index for matches of target[:, 0]
-            index_cp = target_expanded_1.nonzero()[
-                :, 1
-            ]  # Select column index for matches of target[:, 1]
-        # index_cp[i] = torch.argsort(logit[i], descending=True).tolist().index(target[i, 1])
+        columns.append(rank.float())
+    if return_winners:
+        columns.append((argmax.unsqueeze(-1) == target).float())
+    # a single device to cpu copy
+    result = torch.cat(columns, dim=-1).cpu()
+    logit_mem, logit_cp = result[:, 0], result[:, 1]
+    index_mem = index_cp = mem_winners = cp_winners = None
+    if return_index:
+        index_mem, index_cp = result[:, 2].long(), result[:, 3].long()
+    if return_winners:
+        mem_winners, cp_winners = result[:, -2], result[:, -1]
 
     if return_winners:
         if return_index:
@@ -83,17 +113,28 @@ def to_logit_token(
 
 
 class BaseExperiment:
+    # hook points consumed by the experiment (see BaseModel.run_with_cache), None caches every activation
+    cached_activations: Optional[List[str]] = None
+    # move the cached activations to the cpu as they are produced
+    offload_cache: bool = False
+
     def __init__(
         self,
         dataset: BaseDataset,
         model: BaseModel,
         batch_size: int,
         experiment: Literal["copyVSfact", "contextVSfact"] = "copyVSfact",
+        token_budget: Optional[int] = None,
     ):
+        """
+        token_budget: if set, prompts of different lengths are packed in left-padded batches of at most token_budget tokens
+            (and batch_size prompts) instead of running a separate set of batches for each length
+        """
         self.dataset = dataset
         self.model = model
         self.model.eval()
         self.batch_size = batch_size
+        self.token_budget = token_budget
         self.experiment: Literal["copyVSfact", "contextVSfact"] = experiment
         # requires grad to false
         torch.set_grad_enabled(False)
@@ -101,28 +142,96 @@ class BaseExperiment:
         #     raise ValueError("Model and dataset should have the same model_name, found {} and {}".format(
         #         self.model.cfg.model_name, self.dataset.model.cfg.model_name))
 
-    def set_len(self, length: int, slice_to_fit_batch: bool = True) -> None:
+    def set_len(self, length: Optional[int], slice_to_fit_batch: bool = True) -> None:
         self.dataset.set_len(length)
 
+    def get_dataloader(self, shuffle: bool = False):
+        return self.dataset.get_dataloader(
+            batch_size=self.batch_size, shuffle=shuffle, token_budget=self.token_budget
+        )
+
+    def get_stratified_batches(
+        self, lengths: Optional[List[int]] = None, generator: Optional[torch.Generator] = None
+    ) -> Iterator[Dict]:
+        """
+        Same-length batches of the given lengths (all by default) in a random order that spreads the batches of each
+        length evenly over the stream, so that any prefix of the stream is a stratified sample of the lengths
+        """
+        if lengths is None:
+            lengths = self.dataset.get_lengths()
+        keyed_batches = []
+        for length in lengths:
+            self.dataset.set_len(length)
+            ids = list(self.dataset.original_index)
+            ids = [ids[i] for i in torch.randperm(len(ids), generator=generator).tolist()]
+            batches = [ids[start : start + self.batch_size] for start in range(0, len(ids), self.batch_size)]
+            offset = torch.rand(1, generator=generator).item()
+            for k, batch_ids in enumerate(batches):
+                keyed_batches.append(((k + offset) / len(batches), batch_ids))
+        keyed_batches.sort(key=lambda keyed: keyed[0])
+        for _, batch_ids in keyed_batches:
+            yield self.dataset.store.select(batch_ids)
+
+    def get_length_groups(self) -> List[Optional[int]]:
+        """
+        Lengths to loop over: every length of the dataset, or a single group of mixed lengths (None) with a token budget
+        """
+        if self.token_budget is not None:
+            return [None]
+        return self.dataset.get_lengths()
+
+    def get_model_input(self, batch) -> Tuple[torch.Tensor, Dict]:
+        """
+        Input and kwargs for run_with_cache/run_with_hooks: the token ids already computed by the dataset (left-padded
+        for a mixed-length batch), so that prompts are never re-tokenized by the model.
+        For a left-padded batch, TransformerLens builds the attention mask and the offset position ids from the leading
+        pad tokens only when the tokenizer pads on the left: padding_side="left" overrides the tokenizer default for the
+        forward, and the mask it infers is checked against the attention_mask of the batch.
+        """
+        model_kwargs = {"prepend_bos": False}
+        if "attention_mask" in batch:
+            model_kwargs["padding_side"] = "left"
+            check_left_padding(batch["input_ids"], batch["attention_mask"], self.model.get_tokenizer().pad_token_id)
+        return batch["input_ids"].to(self.model.device), model_kwargs
+
+    def run_with_cache(self, batch, names: Optional[List[str]] = None):
+        """
+        Forward the batch caching only the declared activations (names overrides cached_activations)
+        """
+        model_input, model_kwargs = self.get_model_input(batch)
+        return self.model.run_with_cache(
+            model_input,
+            names=names if names is not None else self.cached_activations,
+            offload_to_cpu=self.offload_cache,
+            **model_kwargs,
+        )
+
     def get_basic_logit(
         self, normalize_logit: Literal["none", "softmax", "log_softmax"] = "none"
     ) -> tuple[torch.Tensor, torch.Tensor]:  # type: ignore
-        lengths = self.dataset.get_lengths()
-        for length in lengths:
+        """
+        Base logits of the targets for the first length of the dataset with at least one batch
+        """
+        for length in self.dataset.get_lengths():
             self.set_len(length, slice_to_fit_batch=False)
-            dataloader = DataLoader(
-                self.dataset, batch_size=self.batch_size, shuffle=False
-            )
+            dataloader = self.get_dataloader(shuffle=False)
             num_batches = len(dataloader)
             logit_mem_list, logit_cp_list = [], []
             if num_batches == 0:
                 continue
             for batch in dataloader:
-                logit, _ = self.model.run_with_cache(batch["prompt"], prepend_bos=False)
-                logit = logit[:, -1, :]  # type: ignore
-                logit_mem, logit_cp, _, _ = to_logit_token(
-                    logit, batch["target"], normalize=normalize_logit
-                )
+                model_input, model_kwargs = self.get_model_input(batch)
+                if normalize_logit == "none":
+                    # only the two target columns of the unembedding are needed
+                    logit, _ = self.model.readout(
+                        model_input, targets=batch["target"], **model_kwargs
+                    )
+                    logit_mem, logit_cp = logit[:, 0].cpu(), logit[:, 1].cpu()
+                else:
+                    logit, _ = self.model.readout(model_input, **model_kwargs)
+                    logit_mem, logit_cp, _, _ = to_logit_token(
+                        logit, batch["target"], normalize=normalize_logit
+                    )
                 logit_mem_list.append(logit_mem)
                 logit_cp_list.append(logit_cp)
 
@@ -135,5 +244,5 @@ class BaseExperiment:
             # take a random length
             len = random.choice(self.dataset.get_lengths())
         self.set_len(len, **kwargs)
-        dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=True)
+        dataloader = self.get_dataloader(shuffle=True)
         return next(iter(dataloader))
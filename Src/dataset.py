@@ -2,29 +2,34 @@ import random
 import re
 import os
 from click import Option
+import numpy as np
 import torch
-import gensim.downloader as api
 from torch.utils.data import Dataset
 import json
+import hashlib
 from tqdm import tqdm
-from typing import List, Dict, Tuple, Optional, Literal
+from typing import List, Dict, Tuple, Optional, Literal, Union
 from Src.model import BaseModel
+from Src.tokenization import BatchTokenizer, locate_char_spans, template_field_spans
+from Src.dataset_cache import TokenizationCache, file_fingerprint, tokenizer_fingerprint
+from Src.dataset_io import iter_records
+from Src.similarity import SimilarityScorer, assign_groups, token_pair_similarity
+from Src.dataset_index import RecordIndex
+from Src.dataset_columns import ColumnBatchLoader, ColumnStore, PaddedBatchLoader, RECORD_TENSORS
 
 REDC = "\033[91m"
 ENDC = "\033[0m"
 
 def load_dataset(path:str, model_name:str, start:Optional[int], end:Optional[int]) -> List[Dict]:
-    data = json.load(open(path, "r"))
-    if start is None:
-        start = 0
-    if end is None:
-        end = len(data)
-    return data[start:end]
+    # stream the file and keep only the requested slice: memory scales with the shard, not with the whole dataset
+    return list(iter_records(path, start, end))
+
+def get_similarity_score_path(model_name:str) -> str:
+    return f"../data/similarity_score_{get_family_name(model_name)}.pt"
 
 def load_similarity_score_dict(model_name:str) -> Optional[Dict]:
-    family_name = get_family_name(model_name)
-    if os.path.exists(f"../data/similarity_score_{family_name}.pt"):
-        return torch.load(f"../data/similarity_score_{family_name}.pt")
+    if os.path.exists(get_similarity_score_path(model_name)):
+        return torch.load(get_similarity_score_path(model_name))
     else:
         return None
 
@@ -50,6 +55,9 @@ class BaseDataset(Dataset):
         similarity: Tuple[bool, int, Literal["self-similarity", "modify-self-similarity"]] = (False, 0, "self-similarity"),
         premise:str = "Redefine",
         no_subject:bool = False,
+        device:str = "cpu",
+        similarity_source:Literal["word2vec", "unembed", "embed"] = "word2vec",
+        cache_dir:Optional[str] = None,
     ):
         if no_subject:
             print(f"{REDC} No subject found in the dataset {ENDC}, proceeding with no subject data")
@@ -58,14 +66,26 @@ class BaseDataset(Dataset):
         self.experiment = experiment
         self.similarity = similarity
         self.premise = premise
+        self.device = device
+        self.similarity_source = similarity_source
+        self.tokenizer = BatchTokenizer(model, device=device)
+        self.path = path
+        self.start = start
+        self.end = end
+        self.cache = TokenizationCache(cache_dir) if cache_dir is not None else None
+        self.full_data = load_dataset(path, self.model.cfg.model_name,start, end)
+        self._dataset_fingerprint = file_fingerprint(path)
+        for i, d in enumerate(self.full_data):
+            d["source_index"] = i
+        if similarity[0] and similarity_source == "word2vec":
+                self.similarity_scorer = SimilarityScorer(get_similarity_score_path(self.model.cfg.model_name))
+                self.similarity_score_dict = self.similarity_scorer.scores
         if similarity[0]:
-                self.full_data = load_dataset(path, self.model.cfg.model_name,start, end)
-                self.similarity_score_dict = load_similarity_score_dict(self.model.cfg.model_name)
                 self.full_data = self.generate_similarity_data(similarity[2])
-        else:
-            self.full_data = load_dataset(path, self.model.cfg.model_name,start, end)
-            
+
         self.lengths = self.__get_lenghts_and_tokenize__()
+        self.__build_columns__()
+        self.__build_index__()
         self.prompts = []
         self.tokenized_prompts = []
         self.targets = []
@@ -81,7 +101,9 @@ class BaseDataset(Dataset):
         if self.similarity[0] is True:
             self.similarity = (self.similarity[0], new_similarity_level, self.similarity[2])
 
-        self.lengths = self.__get_lenghts_and_tokenize__()
+        self.lengths = self.__get_lenghts_and_tokenize__(previous_premise=self.premise)
+        self.__build_columns__()
+        self.__build_index__()
         self.prompts = []
         self.tokenized_prompts = []
         self.targets = []
@@ -100,6 +122,7 @@ class BaseDataset(Dataset):
             f"Updating the dataset from {self.premise} to {premise} and the similarity level from {self.similarity[1]} to {new_similarity_level}"
         )
         self.similarity = (self.similarity[0], new_similarity_level, self.similarity[2])
+        previous_premise = self.premise
         self.premise = premise
         self.prompts = []
         self.tokenized_prompts = []
@@ -107,7 +130,9 @@ class BaseDataset(Dataset):
         self.obj_pos = []
         self.lengths = []
         self.subj_len = []
-        self.lengths = self.__get_lenghts_and_tokenize__()
+        self.lengths = self.__get_lenghts_and_tokenize__(previous_premise=previous_premise)
+        self.__build_columns__()
+        self.__build_index__()
         
     def __len__(self):
         return len(self.prompts)
@@ -166,7 +191,7 @@ class BaseDataset(Dataset):
         if self.no_subject:
             return -1, -1, -1
         subject_string = " " + d["subject"]
-        subject_token = self.model.tokenize(subject_string).squeeze(0).cuda()
+        subject_token = self.tokenizer.encode(subject_string)
         prompt_token = d["tokenized_prompt"]
         
         subject_token_len = subject_token.shape[0]
@@ -186,7 +211,7 @@ class BaseDataset(Dataset):
     
     def __find_obj_pos__(self, d:Dict) -> int:
         object_string = d["target_new"]
-        object_token = self.model.tokenize(object_string).cuda()
+        object_token = self.tokenizer.encode(object_string)
         prompt_token = d["tokenized_prompt"]
         
         #find the first occurence of the subject tokens in the prompt tokens
@@ -197,42 +222,240 @@ class BaseDataset(Dataset):
                 break
         return obj_pos
     
+    def __get_char_spans__(self, d:Dict, prompt:str) -> List[Tuple[int, int]]:
+        """
+        Character spans (start, exclusive end) of the first subject, the second subject and the object in the prompt, (-1, -1) if missing
+        """
+        missing = (-1, -1)
+
+        def find_word(word:str, start:int) -> int:
+            # look for the word preceded by a space (as it is tokenized inside the prompt) and not followed by a letter
+            # or a digit, fall back to the bare string
+            match = re.compile(" " + re.escape(word) + r"(?!\w)").search(prompt, start)
+            return match.start() + 1 if match is not None else prompt.find(word, start)
+
+        first_subj, second_subj = missing, missing
+        if not self.no_subject:
+            subject = d["subject"]
+            first = find_word(subject, 0)
+            if first != -1:
+                first_subj = (first, first + len(subject))
+                second = find_word(subject, first + len(subject))
+                if second != -1:
+                    second_subj = (second, second + len(subject))
+
+        target_new = d["target_new"]
+        obj = target_new.lstrip()
+        if self.experiment == "copyVSfact":
+            # the object is the first field of the template filled with target_new
+            starts = [
+                start for index, start, _ in template_field_spans(d["template"], (self.premise, target_new)) if index == 1
+            ]
+            obj_start = starts[0] + len(target_new) - len(obj) if len(starts) > 0 else -1
+        else:
+            obj_start = prompt.find(obj)
+        obj_span = (obj_start, obj_start + len(obj)) if obj_start != -1 and len(obj) > 0 else missing
+        return [first_subj, second_subj, obj_span]
+
+    def __subj_pos_from_spans__(self, d:Dict, token_spans:List[List[int]]) -> Tuple[int, int, int]:
+        """
+        Subject positions from the token spans returned by locate_char_spans: (first occurence, second occurence, n_subject_tokens - 1)
+        """
+        if self.no_subject:
+            return -1, -1, -1
+        (first_start, first_end), (second_start, _), _ = token_spans
+        if first_start == -1:
+            raise ValueError(f"Subject not found in the prompt: {d['subject']}")
+        return first_start, second_start, first_end - first_start
+
     def one_token(self, token:torch.Tensor) -> torch.Tensor:
         if token.shape[0] == 1:
             return token
         else:
             return token[0].unsqueeze(0)
         
-    def __get_lenghts_and_tokenize__(self):
+    def __get_cache_key__(self) -> str:
+        if not hasattr(self, "_tokenizer_fingerprint"):
+            self._tokenizer_fingerprint = tokenizer_fingerprint(self.model)
+        return TokenizationCache.get_key(
+            dataset=self._dataset_fingerprint,
+            tokenizer=self._tokenizer_fingerprint,
+            premise=self.premise,
+            experiment=self.experiment,
+            start=self.start,
+            end=self.end,
+            no_subject=self.no_subject,
+        )
+
+    def __get_lenghts_and_tokenize__(self, previous_premise:Optional[str] = None):
+        # on a warm start the token columns are built from the cache entry (see __build_columns__)
+        self._cache_entry = None
+        if self.cache is None:
+            return self.__tokenize__(previous_premise)
+
+        key = self.__get_cache_key__()
+        entry = self.cache.load(key)
+        if entry is None:
+            lengths = self.__tokenize__(previous_premise)
+            self.cache.save(
+                key,
+                sorted(self.full_data, key=lambda d: d["source_index"]),
+                meta={
+                    "path": self.path,
+                    "model_name": self.model.cfg.model_name,
+                    "premise": self.premise,
+                    "experiment": self.experiment,
+                    "start": self.start,
+                    "end": self.end,
+                    "no_subject": self.no_subject,
+                },
+            )
+            return lengths
+
+        cached = TokenizationCache.to_records(entry, self.full_data)
+        self._cache_entry = entry
+        if len(cached) < len(self.full_data):
+            print(f"{REDC} {len(self.full_data) - len(cached)} points were removed while tokenizing the prompts (cached) {ENDC}")
+            self.full_data = [d for d in self.full_data if d["source_index"] in cached]
         lengths = []
-        log_data = []
-        to_remove = []
-        
-        for d in tqdm(self.full_data, desc="Tokenizing and computing lengths"):
+        for d in self.full_data:
             d["prompt"] = self.__get_prompt__(d)
-            d["tokenized_prompt"] = self.model.tokenize(d["prompt"]).squeeze(0).cuda()
-            d["target_new_token"] = self.one_token(self.model.tokenize(d["target_new"]).squeeze(0).cuda())
-            d["target_true_token"] = self.one_token(self.model.tokenize(d["target_true"]).squeeze(0).cuda())
+            if d["length"] not in lengths:
+                lengths.append(d["length"])
+        return lengths
+
+    def __tokenize__(self, previous_premise:Optional[str] = None):
+        """
+        Splice the new premise onto the current tokenization if there is one (see __splice_premise__), otherwise tokenize from scratch
+        """
+        if previous_premise is not None and self.experiment == "copyVSfact" and hasattr(self, "store"):
+            return self.__splice_premise__(previous_premise)
+        return self.__tokenize_and_locate__()
+
+    def __premise_boundary_is_clean__(self, prefix_tokens:torch.Tensor, rest_head:torch.Tensor) -> bool:
+        """
+        Check that the tokenizer does not merge the end of the prefix with the beginning of the rest of the prompt.
+        The tokens are decoded together: decoding the rest alone drops its leading space on word-level and sentencepiece tokenizers
+        """
+        tokens = torch.cat([prefix_tokens.cpu(), rest_head.cpu()])
+        text = self.model.get_tokenizer().decode(tokens.tolist(), skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        probe = self.tokenizer.encode(text)
+        return torch.equal(probe.cpu(), tokens)
+
+    def __splice_premise__(self, previous_premise:str):
+        """
+        Re-encode only the premise prefix of each prompt and splice it onto the current token ids of the rest of the template,
+        shifting the subject and object positions after the premise by the change of the prefix length.
+        The prefix ends at the premise field of the parsed template (see template_field_spans).
+        Records whose tokenization merges across the premise boundary, or whose template repeats the premise, are re-encoded from scratch.
+        """
+        to_reencode = []
+        boundary_checks = {}
+        for bucket in self.store.buckets.values():
+            input_ids = bucket.columns["input_ids"]
+            targets = bucket.columns["target"]
+            for row, i in enumerate(bucket.ids.tolist()):
+                d = self.full_data[i]
+                premise_starts = [
+                    start for index, start, _ in template_field_spans(d["template"], (self.premise, d["target_new"])) if index == 0
+                ]
+                if len(premise_starts) != 1:
+                    # the premise is repeated (or missing): only a single prefix can be spliced
+                    to_reencode.append(i)
+                    continue
+                prefix = self.__get_prompt__(d)[: premise_starts[0]]
+                previous_prefix_tokens = self.tokenizer.encode(prefix + previous_premise)
+                prefix_tokens = self.tokenizer.encode(prefix + self.premise)
+                n_previous = previous_prefix_tokens.shape[0]
+                if not torch.equal(input_ids[row, :n_previous], previous_prefix_tokens.to(input_ids.device)):
+                    to_reencode.append(i)
+                    continue
+                rest = input_ids[row, n_previous:]
+                boundary_key = (prefix + self.premise, tuple(rest[:2].tolist()))
+                if boundary_key not in boundary_checks:
+                    boundary_checks[boundary_key] = self.__premise_boundary_is_clean__(prefix_tokens, rest[:2])
+                if not boundary_checks[boundary_key]:
+                    to_reencode.append(i)
+                    continue
+
+                delta = prefix_tokens.shape[0] - n_previous
+                d["prompt"] = self.__get_prompt__(d)
+                d["tokenized_prompt"] = torch.cat([prefix_tokens.to(rest.device), rest])
+                d["targets"] = targets[row]
+                d["target_true_token"] = d["targets"][:1]
+                d["target_new_token"] = d["targets"][1:]
+                for key in ["1_subj_pos", "2_subj_pos", "obj_pos"]:
+                    # only the positions after the premise move, missing positions stay -1
+                    d[key] = d[key] + delta if d[key] >= n_previous else d[key]
+                d["length"] = d["tokenized_prompt"].shape[0]
+
+        if len(to_reencode) > 0:
+            print(f"{REDC} {len(to_reencode)} prompts merge tokens across the premise boundary, re-encoding them {ENDC}")
+            order = {id(d): position for position, d in enumerate(self.full_data)}
+            reencode_ids = set(to_reencode)
+            spliced = [d for i, d in enumerate(self.full_data) if i not in reencode_ids]
+            self.full_data = [self.full_data[i] for i in to_reencode]
+            self.__tokenize_and_locate__()
+            self.full_data = sorted(spliced + self.full_data, key=lambda d: order[id(d)])
+
+        lengths = []
+        for d in self.full_data:
+            if d["length"] not in lengths:
+                lengths.append(d["length"])
+        return lengths
+
+    def __tokenize_and_locate__(self):
+        lengths = []
+        log_data = []
+        to_remove = set()
+
+        # encode the whole dataset with a few batched calls: prompts are (almost) unique, targets and subjects repeat a lot
+        prompts = [self.__get_prompt__(d) for d in self.full_data]
+        use_offsets = self.tokenizer.supports_offsets()
+        if use_offsets:
+            # a single pass over the prompts gives both the token ids and the character offsets used to locate subject and object
+            tokenized_prompts, offsets = self.tokenizer.encode_with_offsets(prompts, desc="Tokenizing prompts")
+            char_spans = np.array(
+                [self.__get_char_spans__(d, prompt) for d, prompt in zip(self.full_data, prompts)],
+                dtype=np.int64,
+            ).reshape(-1, 3, 2)
+            token_spans = locate_char_spans(offsets, char_spans).tolist()
+        else:
+            tokenized_prompts = self.tokenizer(prompts, memoize=False, desc="Tokenizing prompts")
+            if not self.no_subject:
+                self.tokenizer.prefetch([" " + d["subject"] for d in self.full_data])
+        target_new_tokens = self.tokenizer([d["target_new"] for d in self.full_data])
+        target_true_tokens = self.tokenizer([d["target_true"] for d in self.full_data])
+
+        for i, d in enumerate(tqdm(self.full_data, desc="Computing positions and lengths")):
+            d["prompt"] = prompts[i]
+            d["tokenized_prompt"] = tokenized_prompts[i]
+            d["target_new_token"] = self.one_token(target_new_tokens[i])
+            d["target_true_token"] = self.one_token(target_true_tokens[i])
             d["targets"] = torch.cat(
                 (d["target_true_token"], d["target_new_token"]), dim=0
             )
             # if find_subj_pod raises an error, add the point to the log data and continue
             try:
-                first_subj_pos, second_subj_pos, subj_len = self.__find_subj_pos__(d)
+                if use_offsets:
+                    first_subj_pos, second_subj_pos, subj_len = self.__subj_pos_from_spans__(d, token_spans[i])
+                else:
+                    first_subj_pos, second_subj_pos, subj_len = self.__find_subj_pos__(d)
                 d["1_subj_pos"] = first_subj_pos
                 d["2_subj_pos"] = second_subj_pos
                 d["subj_len"] = subj_len
                 
             except ValueError as e:
-                for key in d.keys():
-                    if isinstance(d[key], torch.Tensor):
-                        d[key] = d[key].tolist() 
-                log_data.append((d, str(e)))
+                log_d = {
+                    key: value.tolist() if isinstance(value, torch.Tensor) else value
+                    for key, value in d.items()
+                }
+                log_data.append((log_d, str(e)))
                 # remove the point from the full data
-                to_remove.append(d)
+                to_remove.add(i)
                 continue
 
-            d["obj_pos"] = self.__find_obj_pos__(d)
+            d["obj_pos"] = token_spans[i][2][0] if use_offsets else self.__find_obj_pos__(d)
             d["length"] = d["tokenized_prompt"].shape[0]
             if d["length"] not in lengths:
                 lengths.append(d["length"])
@@ -243,8 +466,8 @@ class BaseDataset(Dataset):
             with open(f"../logs/tokenization_errors_{self.model.cfg.model_name}.json", "w") as f:
                 json.dump(log_data, f, indent=4)
             
-        for d in to_remove:
-            self.full_data.remove(d)
+        if len(to_remove) > 0:
+            self.full_data = [d for i, d in enumerate(self.full_data) if i not in to_remove]
             
         return lengths
     
@@ -261,43 +484,39 @@ class BaseDataset(Dataset):
         else:
             raise NotImplementedError(f"Similarity type {similarity_type} is not supported")
         
+    def __compute_similarity_scores__(self):
+        """
+        Similarity between target_true and target_new of every record: word2vec (from the persisted scores when available)
+        or the cosine between the rows of the model's own unembedding/embedding matrix for the first token of the targets
+        """
+        if self.similarity_source == "word2vec":
+            scores = self.similarity_scorer([(d["target_true"], d["target_new"]) for d in self.full_data])
+        elif self.similarity_source in ["unembed", "embed"]:
+            target_true_tokens = self.tokenizer([d["target_true"] for d in self.full_data])
+            target_new_tokens = self.tokenizer([d["target_new"] for d in self.full_data])
+            pairs = torch.tensor(
+                [[true[0].item(), new[0].item()] for true, new in zip(target_true_tokens, target_new_tokens)],
+                dtype=torch.long,
+            ).reshape(-1, 2)
+            vectors = self.model.unembed().T if self.similarity_source == "unembed" else self.model.embed()
+            scores = token_pair_similarity(vectors, pairs).numpy()
+        else:
+            raise NotImplementedError(f"Similarity source {self.similarity_source} is not supported")
+        for d, score in zip(self.full_data, scores.tolist()):
+            d["similarity_score"] = score
+
     def __generate_modify_self_similarity_data__(self):
-        word2vec = api.load("word2vec-google-news-300")
-        similarity_score_list = []
-        for d in tqdm(
-            self.full_data,
-            desc="Generating self similarity tokens (word2vec)",
-            total=len(self.full_data),
-        ):
-            base_target = d["target_true"]
-            other_target = d["target_new"]
-            # remove first space if present
-            if other_target[0] == " ":
-                other_target = other_target[1:]
-            if base_target[0] == " ":
-                base_target = base_target[1:]
-
-            # compute similarity
-            try:
-                similarity_score = word2vec.similarity(base_target, other_target)  # type: ignore
-                similarity_score_list.append(similarity_score)
-            except:
-                similarity_score = -100
-            # save the similarity score
-            d["similarity_score"] = similarity_score
+        self.__compute_similarity_scores__()
 
         # sort full data by similarity score
         self.full_data = sorted(self.full_data, key=lambda x: x["similarity_score"], reverse=True)
-        group_intervals = [(0, 0.1), (0.1, 0.2), (0.2, 0.3), (0.3, 0.4), (0.4, 0.5), (0.5, 0.6), (0.6, 0.7), (0.7, 0.8)]
-        # divide the data into 8 groups based on the similarity score
-        for i, interval in enumerate(group_intervals):
-            for d in self.full_data:
-                if interval[0] <= d["similarity_score"] < interval[1]:
-                    d["similarity_group"] = i
-                if d["similarity_score"] >= 0.8:
-                    d["similarity_group"] = -100
-                if d["similarity_score"] < 0:
-                    d["similarity_group"] = -100
+        # divide the data into 8 groups of width 0.1 based on the similarity score, -100 outside [0, 0.8)
+        groups = assign_groups(
+            np.array([d["similarity_score"] for d in self.full_data], dtype=np.float32),
+            edges=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8],
+        )
+        for d, group in zip(self.full_data, groups.tolist()):
+            d["similarity_group"] = group
         
         # Count the number of points in each group in full data
         similarity_group_count = {}
@@ -314,29 +533,7 @@ class BaseDataset(Dataset):
         return self.full_data
         
     def __generate_self_similarity_data__(self):
-        word2vec = api.load("word2vec-google-news-300")
-        similarity_score_list = []
-        for d in tqdm(
-            self.full_data,
-            desc="Generating self similarity tokens (word2vec)",
-            total=len(self.full_data),
-        ):
-            base_target = d["target_true"]
-            other_target = d["target_new"]
-            # remove first space if present
-            if other_target[0] == " ":
-                other_target = other_target[1:]
-            if base_target[0] == " ":
-                base_target = base_target[1:]
-
-            # compute similarity
-            try:
-                similarity_score = word2vec.similarity(base_target, other_target)  # type: ignore
-                similarity_score_list.append(similarity_score)
-            except:
-                similarity_score = -100
-            # save the similarity score
-            d["similarity_score"] = similarity_score
+        self.__compute_similarity_scores__()
 
         # sort full data by similarity score
         self.full_data = sorted(self.full_data, key=lambda x: x["similarity_score"], reverse=True)
@@ -364,52 +561,129 @@ class BaseDataset(Dataset):
         print(similarity_group_count)
         return self.full_data
     
-    def filter_similarity_data(self):
+    def __build_columns__(self):
+        """
+        Stack the processed records (or gather the cached token ids) into per-length columns and drop the per-record tensors
+        """
+        self.store = ColumnStore(self.full_data, device=self.device, cache_entry=self._cache_entry)
+        self.columns = {"prompt": []}
+        for d in self.full_data:
+            for key in RECORD_TENSORS:
+                d.pop(key, None)
+
+    def __build_index__(self):
+        """
+        Build the (length, similarity_group, outcome) index over full_data
+        """
+        self.index = RecordIndex(self.full_data)
+        if len(self.index.duplicates) > 0:
+            first, second = self.index.duplicates[0]
+            print(f"{REDC} Found {len(self.index.duplicates)} duplicates, e.g. {self.full_data[first]['prompt']} (ids {first}, {second}) {ENDC}")
+
+    def set_outcomes(self, outcomes:Dict[int, str]):
+        """
+        Attach a prediction outcome (e.g. "target_true", "target_false", "other") to the records, keyed by their id in full_data
+        """
+        for i, outcome in outcomes.items():
+            self.full_data[i]["outcome"] = outcome
+        self.__build_index__()
+
+    def filter_similarity_data(self, length:Optional[int] = None, outcome:Optional[str] = None) -> List[int]:
+        """
+        Return the ids of the records in the current similarity group (optionally with the given length/outcome).
+        With modify-self-similarity, the group is subsampled to minimal_size records, redrawn on every call
+        """
         similarity_group = self.similarity[1]
-        data = [d for d in self.full_data if d["similarity_group"] == similarity_group]
+        if similarity_group is None:
+            # no group selected: the index treats None as a wildcard, but no record belongs to the None group
+            return []
+        ids = self.index.lookup(length=length, similarity_group=similarity_group, outcome=outcome)
         if self.similarity[2] == "modify-self-similarity":
             #random sample a subset of the data of size minimal_size
-            data = random.sample(data, self.minimal_size)
-        return data
+            sample = set(random.sample(self.index.lookup(similarity_group=similarity_group), self.minimal_size))
+            ids = [i for i in ids if i in sample]
+        return ids
     
+    def stratified_sample(self, n_per_stratum:int, by:Tuple[str, ...] = ("length",), **filters) -> Dict[Tuple, List[int]]:
+        """
+        Draw up to n_per_stratum record ids for each stratum (e.g. each length) of the index
+        """
+        if self.similarity[0]:
+            filters.setdefault("similarity_group", self.similarity[1])
+        return self.index.stratified_sample(n_per_stratum, by=by, **filters)
     
-    def set_len(self, length:int):
+    def set_len(self, length:Optional[int], outcome:Optional[str] = None):
+        """
+        Select the records with the given length (None selects every length, left-padded to the longest one)
+        """
         self.len = length
         
-        #filter for similarity group
+        #filter for similarity group and length
         if self.similarity[0]:
-            data = self.filter_similarity_data()
+            ids = self.filter_similarity_data(length=length, outcome=outcome)
         else:
-            data = self.full_data
-            
-        #filter for length
-        data = [d for d in data if d["length"] == length]
-        self.prompts = [d["prompt"] for d in data]
-        self.tokenized_prompts = [d["tokenized_prompt"] for d in data]
-        self.targets = [d["targets"] for d in data]
-        self.obj_pos = [d["obj_pos"] for d in data]
-        self.first_subj_pos = [d["1_subj_pos"] for d in data]
-        self.second_subj_pos = [d["2_subj_pos"] for d in data]
-        self.subj_len = [d["subj_len"] for d in data]
-        
-        self.original_index = [
-            i for i, d in enumerate(self.full_data) if d["length"] == length
-        ]
-        self.check_duplicates()
+            ids = self.index.lookup(length=length, outcome=outcome)
+        self.set_ids(ids)
+
+    def set_ids(self, ids:List[int]):
+        """
+        Select the records with the given ids (positions in full_data)
+        """
+        mixed_lengths = len({self.store.length_of[i] for i in ids}) > 1
+        self.columns = self.store.select(ids, pad_token_id=self.get_pad_token_id() if mixed_lengths else None)
+        self.prompts = self.columns["prompt"]
+        self.tokenized_prompts = self.columns.get("input_ids", [])
+        self.targets = self.columns.get("target", [])
+        self.obj_pos = self.columns.get("obj_pos", [])
+        self.first_subj_pos = self.columns.get("1_subj_pos", [])
+        self.second_subj_pos = self.columns.get("2_subj_pos", [])
+        self.subj_len = self.columns.get("subj_len", [])
+        self.original_index = list(ids)
+
+    def get_fingerprint(self) -> str:
+        """
+        Fingerprint of the records (file, start/end slice and ids of the records kept after tokenization) and of the
+        settings that change the prompts (premise, similarity, experiment)
+        """
+        record_ids = hashlib.sha256(json.dumps(sorted(d["source_index"] for d in self.full_data)).encode()).hexdigest()
+        settings = json.dumps(
+            [
+                self._dataset_fingerprint,
+                self.start,
+                self.end,
+                record_ids,
+                self.premise,
+                list(self.similarity),
+                self.experiment,
+                self.no_subject,
+            ]
+        )
+        return hashlib.sha256(settings.encode()).hexdigest()
+
+    def get_pad_token_id(self) -> int:
+        tokenizer = self.model.get_tokenizer()
+        if tokenizer.pad_token_id is not None:
+            return tokenizer.pad_token_id
+        return tokenizer.eos_token_id
+
+    def get_dataloader(
+        self, batch_size:int, shuffle:bool = False, token_budget:Optional[int] = None
+    ) -> Union[ColumnBatchLoader, PaddedBatchLoader]:
+        """
+        Batches of the current selection (see set_len) as slices of the columns.
+        With a token_budget, the selection (usually set_len(None)) is packed into left-padded batches of mixed lengths
+        with at most token_budget tokens and batch_size rows each.
+        """
+        if token_budget is not None:
+            return PaddedBatchLoader(
+                self.store,
+                self.original_index,
+                token_budget=token_budget,
+                pad_token_id=self.get_pad_token_id(),
+                max_batch_size=batch_size,
+                shuffle=shuffle,
+            )
+        return ColumnBatchLoader(self.columns, batch_size=batch_size, shuffle=shuffle)
 
-        
     def check_duplicates(self):
-        seen = set()
-        for i, d in enumerate(self.full_data):
-            if d["prompt"] in seen:
-                for j, d2 in enumerate(self.full_data):
-                    if j == i:
-                        continue
-                    if d["prompt"] == d2["prompt"]:
-                        if d["target_new"] == d2["target_new"]:
-                            if d["target_true"] == d2["target_true"]:
-                                print(f"duplicate found: {d}, {d2}")
-                                return False
-            seen.add(d["prompt"])
-        return True
-        
\ No newline at end of file
+        return len(self.index.duplicates) == 0
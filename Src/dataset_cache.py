@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from typing import Dict, List, Optional, Set
+from Src.model import BaseModel
+
+CACHE_VERSION = 3
+POSITION_FIELDS = ["1_subj_pos", "2_subj_pos", "subj_len", "obj_pos", "length"]
+
+
+def file_fingerprint(path: str) -> str:
+    """
+    sha256 of the path, size and modification time of the dataset file: a warm start never reads the whole file
+    """
+    stat = os.stat(path)
+    fields = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+
+def tokenizer_fingerprint(model: BaseModel) -> str:
+    """
+    Hash of the tokenizer vocabulary/merges and of the wrapper (which decides on special tokens).
+    Models sharing a tokenizer (e.g. all the gpt2 sizes) share the fingerprint.
+    """
+    tokenizer = model.get_tokenizer()
+    digest = hashlib.sha256()
+    digest.update(type(model).__name__.encode())
+    if getattr(tokenizer, "is_fast", False):
+        state = json.loads(tokenizer.backend_tokenizer.to_str())
+        # padding/truncation are runtime settings that change after a padded call, not part of the tokenizer identity
+        state.pop("padding", None)
+        state.pop("truncation", None)
+        digest.update(json.dumps(state, sort_keys=True).encode())
+    else:
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    return digest.hexdigest()
+
+
+class TokenizationCache:
+    """
+    Content-addressed on-disk cache of the processed dataset records (token ids, subject/object positions, lengths).
+    Each entry is a directory of .npy arrays that are memory-mapped on load:
+        - source_index: (N,) index of the record in the loaded slice of the json file
+        - input_ids: (total_tokens,) concatenated token ids of all the prompts
+        - offsets: (N + 1,) start of each prompt in input_ids
+        - targets: (N, 2) target_true and target_new tokens
+        - positions: (N, 5) 1_subj_pos, 2_subj_pos, subj_len, obj_pos, length
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def get_key(**fields) -> str:
+        fields["version"] = CACHE_VERSION
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self._entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        # copy-on-write mapping: pages are read lazily and the arrays can be wrapped by torch without copies
+        return {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c")
+            for name in ["source_index", "input_ids", "offsets", "targets", "positions"]
+        }
+
+    def save(self, key: str, records: List[Dict], meta: Dict) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        lengths = np.array([d["length"] for d in records], dtype=np.int64)
+        arrays = {
+            "source_index": np.array([d["source_index"] for d in records], dtype=np.int64),
+            "input_ids": np.concatenate(
+                [d["tokenized_prompt"].cpu().numpy() for d in records]
+            ).astype(np.int64)
+            if len(records) > 0
+            else np.zeros(0, dtype=np.int64),
+            "offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            "targets": np.array(
+                [d["targets"].tolist() for d in records], dtype=np.int64
+            ).reshape(-1, 2),
+            "positions": np.array(
+                [[d[field] for field in POSITION_FIELDS] for d in records],
+                dtype=np.int64,
+            ).reshape(-1, len(POSITION_FIELDS)),
+        }
+        # write in a temporary directory and move it in place, so that a crashed or concurrent job never leaves a half-written entry
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=4)
+        try:
+            os.replace(tmp_path, self._entry_path(key))
+        except OSError:
+            # another job wrote the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @staticmethod
+    def to_records(entry: Dict[str, np.ndarray], records: List[Dict]) -> Set[int]:
+        """
+        Set the positions and length of the records (matched by their source_index) and return the source indices found
+        in the cache. The token ids and targets stay in the memory-mapped arrays of the entry (see ColumnStore)
+        """
+        by_source = {d["source_index"]: d for d in records}
+        source_index = entry["source_index"].tolist()
+        for source, values in zip(source_index, entry["positions"].tolist()):
+            by_source[source].update(zip(POSITION_FIELDS, values))
+        return set(source_index)
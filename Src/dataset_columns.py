@@ -0,0 +1,264 @@
+import math
+import numpy as np
+import torch
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Sequence, Union
+
+POSITION_COLUMNS = ["obj_pos", "1_subj_pos", "2_subj_pos", "subj_len"]
+# positions that move right by the padding offset when a row is left-padded (subj_len is a length)
+SHIFTED_COLUMNS = ["obj_pos", "1_subj_pos", "2_subj_pos"]
+RECORD_TENSORS = ["tokenized_prompt", "targets", "target_true_token", "target_new_token"]
+
+Columns = Dict[str, Union[List[str], torch.Tensor]]
+
+
+class LengthBucket:
+    """
+    Columns of all the records with the same tokenized length:
+        - ids: (n,) id (position in full_data) of each row, also stored as a column
+        - prompt: list of the n prompts
+        - input_ids: (n, length) token matrix
+        - target: (n, 2) target_true and target_new tokens
+        - obj_pos, 1_subj_pos, 2_subj_pos, subj_len: (n,) positions
+        - similarity_group: (n,) similarity group, -1 if not computed
+    """
+
+    def __init__(
+        self,
+        records: List[Dict],
+        ids: List[int],
+        device: str = "cpu",
+        input_ids: Optional[torch.Tensor] = None,
+        target: Optional[torch.Tensor] = None,
+    ):
+        """
+        input_ids, target: the token columns if already gathered (e.g. from a cache entry), instead of stacking the
+            tokenized_prompt and targets of the records
+        """
+        self.ids = torch.tensor(ids, dtype=torch.long)
+        self.rows = {i: row for row, i in enumerate(ids)}
+        positions = torch.tensor(
+            [[d[column] for column in POSITION_COLUMNS] for d in records],
+            dtype=torch.long,
+            device=device,
+        )
+        if input_ids is None:
+            input_ids = torch.stack([d["tokenized_prompt"] for d in records])
+        if target is None:
+            target = torch.stack([d["targets"] for d in records])
+        self.columns: Columns = {
+            "ids": self.ids,
+            "prompt": [d["prompt"] for d in records],
+            "input_ids": input_ids.to(device),
+            "target": target.to(device),
+            **{column: positions[:, j] for j, column in enumerate(POSITION_COLUMNS)},
+            "similarity_group": torch.tensor(
+                [d.get("similarity_group", -1) for d in records],
+                dtype=torch.long,
+                device=device,
+            ),
+        }
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def select(self, rows: torch.Tensor) -> Columns:
+        """
+        Gather the given rows in one copy per column (no copy if rows is the whole bucket in order)
+        """
+        if len(rows) == len(self) and torch.equal(rows, torch.arange(len(self))):
+            return dict(self.columns)
+        prompts = self.columns["prompt"]
+        selected: Columns = {"prompt": [prompts[row] for row in rows.tolist()]}
+        for name, column in self.columns.items():
+            if name != "prompt":
+                selected[name] = column.index_select(0, rows.to(column.device))
+        return selected
+
+
+class ColumnStore:
+    """
+    Array-backed view of the processed dataset: one LengthBucket per tokenized length
+    """
+
+    def __init__(
+        self, records: List[Dict], device: str = "cpu", cache_entry: Optional[Dict[str, np.ndarray]] = None
+    ):
+        """
+        cache_entry: TokenizationCache entry with the token ids and targets of the records (matched by source_index),
+            gathered with one fancy index per length from the memory-mapped arrays instead of the per-record tensors
+        """
+        by_length: Dict[int, List[int]] = defaultdict(list)
+        for i, d in enumerate(records):
+            by_length[d["length"]].append(i)
+        if cache_entry is not None:
+            # the entry is sorted by source_index
+            cache_rows = np.searchsorted(
+                cache_entry["source_index"], np.array([d["source_index"] for d in records], dtype=np.int64)
+            )
+        self.buckets = {}
+        for length, ids in by_length.items():
+            input_ids, target = None, None
+            if cache_entry is not None:
+                rows = cache_rows[ids]
+                starts = cache_entry["offsets"][rows]
+                input_ids = torch.from_numpy(np.asarray(cache_entry["input_ids"][starts[:, None] + np.arange(length)]))
+                target = torch.from_numpy(np.asarray(cache_entry["targets"][rows]))
+            self.buckets[length] = LengthBucket(
+                [records[i] for i in ids], ids, device=device, input_ids=input_ids, target=target
+            )
+        self.length_of = {i: length for length, ids in by_length.items() for i in ids}
+
+    def select(self, ids: Sequence[int], pad_token_id: Optional[int] = None) -> Columns:
+        """
+        Columns of the records with the given ids, in the given order.
+        Without pad_token_id all the records must have the same length, otherwise see select_padded.
+        """
+        if pad_token_id is not None:
+            return self.select_padded(ids, pad_token_id)
+        lengths = {self.length_of[i] for i in ids}
+        if len(lengths) > 1:
+            raise ValueError(f"Cannot stack records with different lengths {sorted(lengths)} in the same columns: use a pad_token_id")
+        if len(lengths) == 0:
+            return {"prompt": []}
+        bucket = self.buckets[lengths.pop()]
+        rows = torch.tensor([bucket.rows[i] for i in ids], dtype=torch.long)
+        return bucket.select(rows)
+
+    def select_padded(self, ids: Sequence[int], pad_token_id: int) -> Columns:
+        """
+        Columns of records of (possibly) different lengths, left-padded to the longest one so that the last token is always at -1.
+        Adds attention_mask (n, max_length), pad_offset (n,) and length (n,) columns; obj_pos and subject positions
+        are shifted by pad_offset so that they index the padded input_ids.
+        """
+        if len(ids) == 0:
+            return {"prompt": []}
+        lengths = torch.tensor([self.length_of[i] for i in ids], dtype=torch.long)
+        max_length = int(lengths.max())
+        template = next(iter(self.buckets.values())).columns
+        device = template["input_ids"].device
+        n = len(ids)
+        columns: Columns = {
+            "prompt": [""] * n,
+            "input_ids": torch.full((n, max_length), pad_token_id, dtype=torch.long, device=device),
+            "attention_mask": torch.zeros((n, max_length), dtype=torch.long, device=device),
+        }
+        for name in ["ids", "target", *POSITION_COLUMNS, "similarity_group"]:
+            column = template[name]
+            columns[name] = torch.zeros((n, *column.shape[1:]), dtype=column.dtype, device=column.device)
+
+        # one gather per length bucket present in the batch
+        out_rows_by_length: Dict[int, List[int]] = defaultdict(list)
+        for out_row, i in enumerate(ids):
+            out_rows_by_length[self.length_of[i]].append(out_row)
+        for length, out_rows in out_rows_by_length.items():
+            bucket = self.buckets[length]
+            selected = bucket.select(torch.tensor([bucket.rows[ids[row]] for row in out_rows], dtype=torch.long))
+            for out_row, prompt in zip(out_rows, selected["prompt"]):
+                columns["prompt"][out_row] = prompt
+            out_rows = torch.tensor(out_rows, dtype=torch.long)
+            columns["input_ids"][out_rows.to(device), max_length - length :] = selected["input_ids"]
+            columns["attention_mask"][out_rows.to(device), max_length - length :] = 1
+            for name in ["ids", "target", *POSITION_COLUMNS, "similarity_group"]:
+                columns[name][out_rows.to(columns[name].device)] = selected[name]
+
+        pad_offset = (max_length - lengths).to(device)
+        for name in SHIFTED_COLUMNS:
+            # missing positions (-1) stay missing
+            columns[name] = torch.where(columns[name] >= 0, columns[name] + pad_offset, columns[name])
+        columns["pad_offset"] = pad_offset
+        columns["length"] = lengths.to(device)
+        return columns
+
+
+class TokenBudgetSampler:
+    """
+    Pack record ids into batches of at most token_budget padded tokens (rows x longest row) and max_batch_size rows.
+    The ids are sorted by length first, so that each batch only pads to close lengths.
+    """
+
+    def __init__(
+        self,
+        length_of: Dict[int, int],
+        ids: Sequence[int],
+        token_budget: int,
+        max_batch_size: Optional[int] = None,
+    ):
+        self.batches: List[List[int]] = []
+        batch: List[int] = []
+        for i in sorted(ids, key=lambda i: length_of[i]):
+            # ids are sorted by length: the new id sets the padded length of the batch
+            too_many_tokens = (len(batch) + 1) * length_of[i] > token_budget
+            too_many_rows = max_batch_size is not None and len(batch) >= max_batch_size
+            if len(batch) > 0 and (too_many_tokens or too_many_rows):
+                self.batches.append(batch)
+                batch = []
+            batch.append(i)
+        if len(batch) > 0:
+            self.batches.append(batch)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+
+class PaddedBatchLoader:
+    """
+    Iterate over left-padded batches of mixed lengths, filled up to a token budget (see TokenBudgetSampler)
+    """
+
+    def __init__(
+        self,
+        store: ColumnStore,
+        ids: Sequence[int],
+        token_budget: int,
+        pad_token_id: int,
+        max_batch_size: Optional[int] = None,
+        shuffle: bool = False,
+    ):
+        self.store = store
+        self.pad_token_id = pad_token_id
+        self.shuffle = shuffle
+        self.sampler = TokenBudgetSampler(store.length_of, ids, token_budget, max_batch_size)
+
+    def __len__(self) -> int:
+        return len(self.sampler)
+
+    def __iter__(self) -> Iterator[Columns]:
+        batches = list(self.sampler)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        for batch_ids in batches:
+            yield self.store.select_padded(batch_ids, self.pad_token_id)
+
+
+class ColumnBatchLoader:
+    """
+    Iterate over columns in batches of slices: no per-item dicts and no collation.
+    With shuffle=True the columns are permuted once per epoch and then sliced.
+    """
+
+    def __init__(self, columns: Columns, batch_size: int, shuffle: bool = False):
+        self.columns = columns
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.n_rows = len(columns["prompt"])
+
+    def __len__(self) -> int:
+        return math.ceil(self.n_rows / self.batch_size)
+
+    def _permuted(self) -> Columns:
+        permutation = torch.randperm(self.n_rows)
+        prompts = self.columns["prompt"]
+        permuted: Columns = {"prompt": [prompts[row] for row in permutation.tolist()]}
+        for name, column in self.columns.items():
+            if name != "prompt":
+                permuted[name] = column.index_select(0, permutation.to(column.device))
+        return permuted
+
+    def __iter__(self) -> Iterator[Columns]:
+        columns = self._permuted() if self.shuffle else self.columns
+        for start in range(0, self.n_rows, self.batch_size):
+            yield {name: column[start : start + self.batch_size] for name, column in columns.items()}
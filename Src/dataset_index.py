@@ -0,0 +1,107 @@
+import random
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+IndexKey = Tuple[int, Optional[int], Optional[str]]
+KEY_FIELDS = ("length", "similarity_group", "outcome")
+
+
+class RecordIndex:
+    """
+    Index over the dataset records, built once at load time.
+    Maps (length, similarity_group, outcome) to the ids (positions in full_data) of the records, in full_data order.
+    similarity_group and outcome are None for records without them.
+    Duplicates (same prompt, target_new and target_true) are detected with a hash set while building the index.
+    """
+
+    def __init__(self, records: List[Dict]):
+        self.buckets: Dict[IndexKey, List[int]] = defaultdict(list)
+        self.duplicates: List[Tuple[int, int]] = []
+        seen: Dict[Tuple[str, str, str], int] = {}
+        for i, d in enumerate(records):
+            duplicate_key = (d["prompt"], d["target_new"], d["target_true"])
+            if duplicate_key in seen:
+                self.duplicates.append((seen[duplicate_key], i))
+            else:
+                seen[duplicate_key] = i
+            self.buckets[
+                (d["length"], d.get("similarity_group"), d.get("outcome"))
+            ].append(i)
+
+    def _matching_keys(
+        self,
+        length: Optional[int] = None,
+        similarity_group: Optional[int] = None,
+        outcome: Optional[str] = None,
+    ) -> List[IndexKey]:
+        """
+        Keys matching the given values, None acts as a wildcard
+        """
+        return [
+            key
+            for key in self.buckets
+            if (length is None or key[0] == length)
+            and (similarity_group is None or key[1] == similarity_group)
+            and (outcome is None or key[2] == outcome)
+        ]
+
+    def lookup(
+        self,
+        length: Optional[int] = None,
+        similarity_group: Optional[int] = None,
+        outcome: Optional[str] = None,
+    ) -> List[int]:
+        """
+        Return the ids of the records matching the given values (None matches everything), in full_data order
+        """
+        keys = self._matching_keys(length, similarity_group, outcome)
+        if len(keys) == 1:
+            return list(self.buckets[keys[0]])
+        return sorted(i for key in keys for i in self.buckets[key])
+
+    def count(
+        self,
+        length: Optional[int] = None,
+        similarity_group: Optional[int] = None,
+        outcome: Optional[str] = None,
+    ) -> int:
+        return sum(
+            len(self.buckets[key])
+            for key in self._matching_keys(length, similarity_group, outcome)
+        )
+
+    def sample(
+        self,
+        n: int,
+        length: Optional[int] = None,
+        similarity_group: Optional[int] = None,
+        outcome: Optional[str] = None,
+        rng: Optional[random.Random] = None,
+    ) -> List[int]:
+        """
+        Random subset of size n of the matching records, in full_data order
+        """
+        rng = rng if rng is not None else random
+        ids = self.lookup(length, similarity_group, outcome)
+        return sorted(rng.sample(ids, min(n, len(ids))))
+
+    def stratified_sample(
+        self,
+        n_per_stratum: int,
+        by: Sequence[str] = ("length",),
+        rng: Optional[random.Random] = None,
+        **filters,
+    ) -> Dict[Tuple, List[int]]:
+        """
+        Group the records matching `filters` by the fields in `by` (subset of length, similarity_group, outcome)
+        and draw up to n_per_stratum ids from each stratum
+        """
+        rng = rng if rng is not None else random
+        positions = [KEY_FIELDS.index(field) for field in by]
+        strata: Dict[Tuple, List[int]] = defaultdict(list)
+        for key in self._matching_keys(**filters):
+            strata[tuple(key[p] for p in positions)].extend(self.buckets[key])
+        return {
+            stratum: sorted(rng.sample(ids, min(n_per_stratum, len(ids))))
+            for stratum, ids in strata.items()
+        }
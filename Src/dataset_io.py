@@ -0,0 +1,132 @@
+import json
+import os
+import numpy as np
+from itertools import islice
+from typing import Dict, Iterator, Optional
+
+JSONL_EXTENSIONS = (".jsonl", ".ndjson")
+
+
+def is_jsonl(path: str) -> bool:
+    return path.endswith(JSONL_EXTENSIONS)
+
+
+def iter_json_array(path: str, chunk_size: int = 1 << 16) -> Iterator[Dict]:
+    """
+    Lazily yield the elements of a file containing a top-level json array, reading it in chunks.
+    Only the element being decoded is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} does not contain a json array")
+        position = 1
+        eof = False
+        while True:
+            # skip the separators between elements
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                record, position_end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # the element is split across chunks: drop what was already decoded, read more and retry
+                chunk = f.read(chunk_size)
+                eof = len(chunk) == 0
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            position = position_end
+            yield record
+
+
+def get_line_index_path(path: str) -> str:
+    return f"{path}.idx.npy"
+
+
+def build_line_index(path: str) -> np.ndarray:
+    """
+    Byte offset of the start of each record of a jsonl file, plus the file size as last element.
+    Empty lines are skipped.
+    """
+    offsets = []
+    position = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                offsets.append(position)
+            position += len(line)
+    offsets.append(position)
+    return np.array(offsets, dtype=np.int64)
+
+
+def load_line_index(path: str) -> np.ndarray:
+    """
+    Load the sidecar byte-offset index of a jsonl file, (re)building it if missing or older than the file
+    """
+    index_path = get_line_index_path(path)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+        offsets = np.load(index_path, mmap_mode="r")
+        if offsets[-1] == os.path.getsize(path):
+            return offsets
+    offsets = build_line_index(path)
+    try:
+        np.save(index_path, offsets)
+    except OSError:
+        # read-only dataset directory: keep the index in memory only
+        pass
+    return offsets
+
+
+def iter_jsonl(path: str, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[Dict]:
+    """
+    Yield the records [start:end] of a jsonl file, seeking directly to the first one with the sidecar index
+    """
+    offsets = load_line_index(path)
+    n_records = len(offsets) - 1
+    start, end, _ = slice(start, end).indices(n_records)
+    if start >= end:
+        return
+    with open(path, "rb") as f:
+        f.seek(int(offsets[start]))
+        for _ in range(end - start):
+            line = f.readline()
+            while not line.strip():
+                line = f.readline()
+            yield json.loads(line)
+
+
+def count_records(path: str) -> int:
+    if is_jsonl(path):
+        return len(load_line_index(path)) - 1
+    return sum(1 for _ in iter_json_array(path))
+
+
+def iter_records(path: str, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[Dict]:
+    """
+    Stream the records [start:end] of a json array or jsonl file without loading the whole file.
+    Negative indices on a json array require a first pass to count the records.
+    """
+    if is_jsonl(path):
+        yield from iter_jsonl(path, start, end)
+        return
+    if (start is not None and start < 0) or (end is not None and end < 0):
+        start, end, _ = slice(start, end).indices(count_records(path))
+    yield from islice(iter_json_array(path), start, end)
+
+
+def json_to_jsonl(path: str, out_path: Optional[str] = None) -> str:
+    """
+    Convert a json array dataset to jsonl (one record per line) and build its index, return the new path
+    """
+    if out_path is None:
+        out_path = os.path.splitext(path)[0] + ".jsonl"
+    with open(out_path, "w") as f:
+        for record in iter_json_array(path):
+            f.write(json.dumps(record) + "\n")
+    load_line_index(out_path)
+    return out_path
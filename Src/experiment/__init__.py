@@ -2,4 +2,6 @@ from Src.experiment.logit_attribution import LogitAttribution
 from Src.experiment.logit_lens import LogitLens, LogitStorage, HeadLogitStorage
 from Src.experiment.ablation import Ablate
 from Src.experiment.head_pattern import HeadPattern
-from Src.experiment.ablator import Ablator
\ No newline at end of file
+from Src.experiment.ablator import Ablator
+from Src.experiment.incremental import IncrementalRunner
+from Src.experiment.screening import Screening
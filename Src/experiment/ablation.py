@@ -1,15 +1,20 @@
 from re import sub
 import torch
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from Src.dataset import BaseDataset
-from Src.model import WrapHookedTransformer
+from Src.model import WrapHookedTransformer, normalize_readout
 from Src.base_experiment import BaseExperiment, to_logit_token
 from typing import Optional, Tuple, Dict, Any, Literal, Union, List
 import pandas as pd
 from Src.experiment import LogitStorage, HeadLogitStorage
+from Src.experiment.incremental import IncrementalRunner
+from Src.experiment.interventions import Edit, FusedHook, compile_edits, bind_hooks
+from Src.accumulator import RunningStats
+from Src.experiment.checkpoint import AblationCheckpoint
+from Src.utils import aggregate_result
+import json
 from functools import partial
-from copy import deepcopy
+from itertools import product
 
 WINDOW = 1
 
@@ -20,21 +25,120 @@ class Ablate(BaseExperiment):
         model: WrapHookedTransformer,
         batch_size: int,
         experiment: Literal["copyVSfact", "contextVSfact"] = "copyVSfact",
+        sweep_budget_mb: Optional[int] = None,
+        checkpoint_dir: Optional[str] = None,
+        resume: bool = False,
     ):
+        """
+        sweep_budget_mb: if set, the interventions of the same layer are evaluated K at a time by stacking K copies of
+            the batch in a single forward, with K as large as fits in this many MB of activations
+        checkpoint_dir: if set, the logits of each (component, length, batch) are saved there as they are computed, and
+            the batches already saved are loaded instead of recomputed (resume=True to continue an existing run)
+        """
         super().__init__(dataset, model, batch_size, experiment)
+        self.sweep_budget_mb = sweep_budget_mb
+        self.candidates: Optional[Dict[int, Optional[List[int]]]] = None
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
+        self.checkpoint: Optional[AblationCheckpoint] = None
+        self.compiled_edits: Dict[Tuple[str, int], List[FusedHook]] = {}
         self.position_component = ["mlp_out", "attn_out", "attn_out_pattern"]
         # self.position_component = ["attn_out", "resid_pre", "mlp_out", "resid_pre"]
         self.head_component = ["head", "head_object_pos"]
         self.first_mech_winners = 0
         self.second_mech_winners = 0
 
+    def _get_checkpoint(self, **run_config) -> Optional[AblationCheckpoint]:
+        """
+        Checkpoint of the run with the given options, opened once and shared by the components of run_all
+        """
+        if self.checkpoint_dir is None:
+            return None
+        config = {
+            "model_name": self.model.cfg.model_name,
+            "experiment": self.experiment,
+            "batch_size": self.batch_size,
+            "dataset": self.dataset.get_fingerprint(),
+            "candidates": self.candidates,
+            **run_config,
+        }
+        if self.checkpoint is not None and self.checkpoint.config == json.loads(json.dumps(config, default=str)):
+            return self.checkpoint
+        # the first component of a new run creates the directory, the next ones resume it
+        resume = self.resume or self.checkpoint is not None
+        self.checkpoint = AblationCheckpoint(self.checkpoint_dir, config, resume=resume)
+        return self.checkpoint
+
+    def set_candidates(self, candidates: Optional[Dict[int, Optional[List[int]]]] = None):
+        """
+        Restrict the exact ablation to some interventions: {layer: indices}, with the heads of the layer for the head
+        components and the aggregated positions of the layer (the positions of run) for the position components, None
+        for all the heads/positions of the layer. The skipped interventions are stored with the clean logits (assumed
+        to have no effect) and flagged in the skipped column of run. None (default) to ablate everything.
+        """
+        self.candidates = candidates
+
+    def _get_aggregated_positions(self, batch) -> torch.Tensor:
+        """
+        (length, aggregated position) boolean mask of the positions that enter each aggregated position of run for at
+        least one example of the batch, read from the aggregation itself (one-hot pattern of each position)
+        """
+        length = batch["input_ids"].shape[1]
+        columns = ["obj_pos", "1_subj_pos", "2_subj_pos", "subj_len"]
+        # the examples with the same positions share the same mask
+        positions = torch.unique(torch.stack([batch[name].cpu() for name in columns], dim=1), dim=0)
+        positions = positions.repeat_interleave(length, dim=0)
+        one_hot = torch.eye(length).repeat(positions.shape[0] // length, 1)
+        aggregated = aggregate_result(self.experiment, one_hot[None], *positions.T, length=length)[0]
+        # empty spans aggregate to nan: nan > 0 is False
+        return (aggregated > 0).view(-1, length, aggregated.shape[-1]).any(dim=0)
+
+    def _split_candidates(
+        self,
+        layer: int,
+        interventions: List[Tuple[Optional[int], Optional[int]]],
+        aggregated_positions: Optional[torch.Tensor] = None,
+    ):
+        """
+        (interventions to run, interventions to skip) of a layer according to the candidates. A position is run if it
+        enters one of the candidate aggregated positions (aggregated_positions, see _get_aggregated_positions)
+        """
+        if self.candidates is None:
+            return interventions, []
+        if layer not in self.candidates:
+            return [], interventions
+        indices = self.candidates[layer]
+        if indices is None:
+            return interventions, []
+        kept, skipped = [], []
+        for position, head in interventions:
+            if head is not None:
+                selected = head in indices
+            else:
+                selected = bool(aggregated_positions[position, indices].any())  # type: ignore
+            (kept if selected else skipped).append((position, head))
+        return kept, skipped
+
+    def _is_skipped(self, layer: int, index: int) -> bool:
+        """
+        Whether the intervention of run at (layer, aggregated position or head) was skipped by the candidates
+        """
+        if self.candidates is None:
+            return False
+        return layer not in self.candidates or (
+            self.candidates[layer] is not None and index not in self.candidates[layer]  # type: ignore
+        )
+
     def _get_freezed_attn(self, cache) -> Dict[str, Tuple[torch.Tensor, Any]]:
         """
         Return the hooks to freeze the attention (i.e. the attention activations)
         """
 
         def freeze_hook(attn_activation, hook, clean_attn_activation):
-            attn_activation = clean_attn_activation
+            # incremental runs only cover the last positions of the sequence, sweeps stack copies of the batch
+            clean_attn_activation = clean_attn_activation[:, -attn_activation.shape[1] :]
+            n_copies = attn_activation.shape[0] // clean_attn_activation.shape[0]
+            attn_activation = clean_attn_activation.repeat(n_copies, 1, 1)
             return attn_activation
 
         hooks = {}
@@ -56,7 +160,10 @@ class Ablate(BaseExperiment):
         """
 
         def freeze_hook(attn_activation, hook, clean_attn_activation):
-            attn_activation = clean_attn_activation
+            # incremental runs only cover the last query positions of the sequence, sweeps stack copies of the batch
+            clean_attn_activation = clean_attn_activation[:, :, -attn_activation.shape[2] :]
+            n_copies = attn_activation.shape[0] // clean_attn_activation.shape[0]
+            attn_activation = clean_attn_activation.repeat(n_copies, 1, 1, 1)
             return attn_activation
 
         hooks = {}
@@ -72,6 +179,48 @@ class Ablate(BaseExperiment):
 
         return hooks
 
+    def _get_compiled_edits(self, layer: int, component: str) -> List[FusedHook]:
+        """
+        Fused hooks of the ablations of a (component, layer), compiled once: the ablated position or head is read from
+        the sweep_position or sweep_head column bound to each batch
+        """
+        if (component, layer) in self.compiled_edits:
+            return self.compiled_edits[(component, layer)]
+        if component == "attn_out_pattern":
+            # all the heads of the two layers in one hook per layer
+            edits = [
+                Edit(f"blocks.{layer + i}.attn.hook_pattern", query=-1, key="sweep_position")
+                for i in range(2)
+            ]
+        elif component in self.position_component:
+            edits = [Edit(f"blocks.{layer}.hook_{component}", query="sweep_position")]
+        elif component in self.head_component:
+            # per-example object positions
+            key = "obj_pos" if component == "head_object_pos" else None
+            edits = [Edit(f"blocks.{layer}.attn.hook_pattern", heads="sweep_head", query=-1, key=key)]
+        else:
+            raise ValueError(f"component {component} not supported")
+        self.compiled_edits[(component, layer)] = compile_edits(edits)
+        return self.compiled_edits[(component, layer)]
+
+    def _bind_edits(
+        self,
+        layer: int,
+        component: str,
+        freezed_attn: Dict[str, Tuple[torch.Tensor, Any]],
+        columns: Dict[str, torch.Tensor],
+    ):
+        """
+        The compiled edits of the (component, layer) bound to the columns, with the freeze hooks of the other layers
+        """
+        new_hooks = bind_hooks(self._get_compiled_edits(layer, component), columns)
+        if component == "attn_out_pattern":
+            return new_hooks
+        # the freeze hooks are shared and never modified: no need to copy the cached activations
+        hooks = dict(freezed_attn)
+        (hooks[f"L{layer}"],) = new_hooks  # type: ignore
+        return list(hooks.values())
+
     def _get_current_hooks(
         self,
         layer: int,
@@ -80,90 +229,86 @@ class Ablate(BaseExperiment):
         head: Optional[int] = None,
         position: Optional[int] = None,
         object_position: Optional[torch.Tensor] = None,
+        length: Optional[int] = None,
     ):
         """
-        Apply the ablation pattern to the model
+        Apply the ablation pattern to the model.
+        With length, positions are indexed from the end of the sequence so that the hooks also apply to incremental runs.
         """
-        hooks = deepcopy(freezed_attn)
-        if component in self.position_component:
-            if component == "attn_out_pattern":
-                hooks = []
-                def head_ablation_hook(activation, hook, head):
-                    activation[:, head, -1, position] = 0
-                    return activation
-                
-                for head in range(self.model.cfg.n_heads):
-                    hooks.append(
-                        (f"blocks.{layer}.attn.hook_pattern", partial(head_ablation_hook, head=head))
-                    )
-                    hooks.append(
-                        (f"blocks.{layer + 1}.attn.hook_pattern", partial(head_ablation_hook, head=head))
-                    )
-                return hooks
-            hook_name = f"blocks.{layer}.hook_{component}"
-
-            def pos_ablation_hook(activation, hook, position):
-                activation[:, position, :] = 0
-                return activation
-
-            new_hook = (hook_name, partial(pos_ablation_hook, position=position))
-
-        if component in self.head_component:
-            hook_name = f"blocks.{layer}.attn.hook_pattern"
-            if component == "head_object_pos":
-                object_position= object_position[0]
-                def head_ablation_hook(activation, hook, head):
-                    activation[:, head, -1, object_position] = 0
-                    return activation
-            
-            else:
-                def head_ablation_hook(activation, hook, head):
-                    activation[:, head, -1, :] = 0
-                    return activation
+        columns = {} if object_position is None else {"obj_pos": object_position}
+        if component == "attn_out_pattern":
+            columns["sweep_position"] = torch.tensor([position])
+        elif component in self.position_component:
+            columns["sweep_position"] = torch.tensor([position if length is None else position - length])  # type: ignore
+        elif component in self.head_component:
+            columns["sweep_head"] = torch.tensor([head])
+        return self._bind_edits(layer, component, freezed_attn, columns)
 
-            new_hook = (hook_name, partial(head_ablation_hook, head=head))
+    def _get_sweep_hooks(
+        self,
+        layer: int,
+        component: str,
+        freezed_attn: Dict[str, Tuple[torch.Tensor, Any]],
+        interventions: List[Tuple[Optional[int], Optional[int]]],
+        batch_size: int,
+        length: int,
+        object_position: Optional[torch.Tensor] = None,
+    ):
+        """
+        Same ablations as _get_current_hooks for a list of (position, head) interventions at the same layer, applied to
+        a batch stacked len(interventions) times: a single hook per hook point, each copy of the batch masked by row
+        """
 
-        hooks[f"L{layer}"] = new_hook  # type: ignore
+        def per_row(values: List[int]) -> torch.Tensor:
+            return torch.tensor(values, dtype=torch.long).repeat_interleave(batch_size)
 
-        list_hooks = list(hooks.values())
-        return list_hooks
+        # the position or head of each copy of the batch is a column read by the compiled edits
+        columns = {} if object_position is None else {"obj_pos": object_position}
+        if component == "attn_out_pattern":
+            columns["sweep_position"] = per_row([position for position, _ in interventions])  # type: ignore
+        elif component in self.position_component:
+            # positions indexed from the end of the sequence, as the activations of incremental runs
+            columns["sweep_position"] = per_row([position - length for position, _ in interventions])  # type: ignore
+        elif component in self.head_component:
+            columns["sweep_head"] = per_row([head for _, head in interventions])  # type: ignore
+        return self._bind_edits(layer, component, freezed_attn, columns)
 
-    def _run_with_hooks(self, batch, hooks):
+    def _get_sweep_size(self, batch_size: int, length: int, component: str) -> int:
         """
-        launch the model with the given hooks
+        Number of copies of the batch that fit in sweep_budget_mb: the replicated keys/values of the prefix, and the
+        residual stream, MLP activations, attention pattern and logits of the resumed positions
         """
-        self.model.reset_hooks()
-        # hooks = []
-        with torch.no_grad():
-            logit = self.model.run_with_hooks(
-                batch["prompt"],
-                prepend_bos=False,
-                fwd_hooks=hooks,
+        if self.sweep_budget_mb is None:
+            return 1
+        cfg = self.model.model.cfg
+        element_size = torch.finfo(cfg.dtype).bits // 8
+        n_positions = length if component in ["mlp_out", "attn_out"] else 1
+        d_mlp = cfg.d_mlp if cfg.d_mlp is not None else 4 * cfg.d_model
+        per_copy = (
+            element_size
+            * batch_size
+            * (
+                2 * cfg.n_layers * length * cfg.d_model
+                + n_positions * (4 * cfg.d_model + d_mlp + cfg.n_heads * length)
+                + cfg.d_vocab
             )
-        return logit[:, -1, :]  # type: ignore
+        )
+        return max(1, (self.sweep_budget_mb * 2**20) // per_copy)
 
-    def _process_model_run(
+    def _store_logit(
         self,
         layer,
         position,
         head,
         component,
+        logit,
         batch,
-        freezed_attn,
         storage,
         normalize_logit,
-        object_position=None,
     ):
-        """
-        run the model with the given hooks and store the logit in the storage
-        """
-        hooks = self._get_current_hooks(
-            layer, component, freezed_attn, head=head, position=position, object_position=object_position
-        )
-        logit = self._run_with_hooks(batch, hooks)  #!more performance
         logit_token = to_logit_token(
-            logit, batch["target"], 
-            normalize=normalize_logit, 
+            logit, batch["target"],
+            normalize=normalize_logit,
             return_winners=True
         )
 
@@ -185,103 +330,529 @@ class Ablate(BaseExperiment):
                 cp_winners=logit_token[5],
             )
 
+    def _process_model_sweep(
+        self,
+        layer,
+        interventions,
+        component,
+        batch,
+        freezed_attn,
+        storage,
+        normalize_logit,
+        runner: IncrementalRunner,
+        object_position=None,
+    ):
+        """
+        run the (position, head) interventions of a layer in a single forward on the stacked batch and scatter the
+        logit of each copy of the batch in the storage
+        """
+        batch_size, length = batch["input_ids"].shape
+        hooks = self._get_sweep_hooks(
+            layer,
+            component,
+            freezed_attn,
+            interventions,
+            batch_size,
+            length,
+            object_position=object_position,
+        )
+        start_position = min(
+            self._get_first_affected_position(component, position, length)
+            for position, _ in interventions
+        )
+        logit, _ = runner.run(layer, start_position, hooks, repeat=len(interventions))
+        for (position, head), copy_logit in zip(
+            interventions, logit.split(batch_size, dim=0)
+        ):
+            self._store_logit(
+                layer, position, head, component, copy_logit, batch, storage, normalize_logit
+            )
+
+    def _run_with_hooks(self, batch, hooks):
+        """
+        launch the model with the given hooks
+        """
+        self.model.reset_hooks()
+        model_input, model_kwargs = self.get_model_input(batch)
+        with torch.no_grad():
+            # only the last position is unembedded
+            logit, _ = self.model.readout(model_input, fwd_hooks=hooks, **model_kwargs)
+        return logit
+
+    def _process_model_run(
+        self,
+        layer,
+        position,
+        head,
+        component,
+        batch,
+        freezed_attn,
+        storage,
+        normalize_logit,
+        object_position=None,
+        runner: Optional[IncrementalRunner] = None,
+    ):
+        """
+        run the model with the given hooks and store the logit in the storage.
+        With a prepared runner, the forward pass is resumed from the first (layer, position) the ablation can change.
+        """
+        if runner is None:
+            hooks = self._get_current_hooks(
+                layer, component, freezed_attn, head=head, position=position, object_position=object_position
+            )
+            logit = self._run_with_hooks(batch, hooks)
+        else:
+            length = batch["input_ids"].shape[1]
+            hooks = self._get_current_hooks(
+                layer,
+                component,
+                freezed_attn,
+                head=head,
+                position=position,
+                object_position=object_position,
+                length=length,
+            )
+            logit, _ = runner.run(
+                layer, self._get_first_affected_position(component, position, length), hooks
+            )
+        self._store_logit(
+            layer, position, head, component, logit, batch, storage, normalize_logit
+        )
+
+    def _get_first_affected_position(
+        self, component: str, position: Optional[int], length: int
+    ) -> int:
+        """
+        First position whose residual stream can be changed by the ablation: the ablated position for the position
+        components, the last position for the edits of the last query row of the attention pattern
+        """
+        if component in ["mlp_out", "attn_out"]:
+            return position  # type: ignore
+        return length - 1
+
+    def _get_storage(self, component: str, length: int, n_examples: Optional[int] = None):
+        if component in self.position_component:
+            return LogitStorage(
+                n_layers=self.model.cfg.n_layers-1,
+                length=length,
+                experiment=self.experiment,
+                n_examples=n_examples,
+            )
+        if component in self.head_component:
+            return HeadLogitStorage(
+                n_layers=self.model.cfg.n_layers -1,
+                length=1,
+                n_heads=self.model.cfg.n_heads,
+                experiment=self.experiment,
+                n_examples=n_examples,
+            )
+        raise ValueError(f"component {component} not supported")
+
+    def _ablate_batch(
+        self,
+        batch,
+        component: str,
+        storage,
+        normalize_logit: Literal["none", "softmax", "log_softmax"],
+        total_effect: bool,
+        runner: IncrementalRunner,
+    ):
+        """
+        Run every (layer, position) or (layer, head) intervention of the component on a batch and store the logits
+        """
+        batch_size, length = batch["input_ids"].shape
+        if component not in self.position_component + self.head_component:
+            raise ValueError(f"component {component} not supported")
+        if component in ("mlp_out", "attn_out") and not total_effect:
+            clean_names = ["attn.hook_pattern"]
+            get_freezed_attn = self._get_freezed_attn_pattern
+        elif component in ("head", "head_object_pos") and not total_effect:
+            clean_names = ["hook_attn_out"]
+            get_freezed_attn = self._get_freezed_attn
+        else:
+            # total effect, or attn_out_pattern that ablates the pattern itself: nothing to freeze
+            clean_names = []
+            get_freezed_attn = lambda cache: {}  # noqa: E731
+
+        # a single clean forward per batch: the activations to freeze and the states to resume from
+        batch_runner = runner if IncrementalRunner.supports(self.model, batch) else None
+        cache = None
+        if batch_runner is not None:
+            model_input, model_kwargs = self.get_model_input(batch)
+            cache = batch_runner.prepare(model_input, names=clean_names, **model_kwargs)
+        elif len(clean_names) > 0:
+            _, cache = self.run_with_cache(batch, names=clean_names)
+        freezed_attn = get_freezed_attn(cache)
+        aggregated_positions = None
+        if self.candidates is not None:
+            # logits of the skipped interventions
+            model_input, model_kwargs = self.get_model_input(batch)
+            clean_logit, _ = self.model.readout(model_input, **model_kwargs)
+            if component in self.position_component:
+                aggregated_positions = self._get_aggregated_positions(batch)
+
+        sweep_size = (
+            self._get_sweep_size(batch_size, length, component)
+            if batch_runner is not None
+            else 1
+        )
+        for layer in range(self.model.cfg.n_layers - 1):
+            if component in self.position_component:
+                interventions = [(position, None) for position in range(length)]
+            else:
+                interventions = [(None, head) for head in range(self.model.cfg.n_heads)]
+            interventions, skipped = self._split_candidates(layer, interventions, aggregated_positions)
+            for position, head in skipped:
+                self._store_logit(
+                    layer, position, head, component, clean_logit, batch, storage, normalize_logit
+                )
+            if sweep_size > 1:
+                for start in range(0, len(interventions), sweep_size):
+                    self._process_model_sweep(
+                        layer,
+                        interventions[start : start + sweep_size],
+                        component,
+                        batch,
+                        freezed_attn,
+                        storage,
+                        normalize_logit,
+                        batch_runner,  # type: ignore
+                        object_position=batch["obj_pos"],
+                    )
+            else:
+                for position, head in interventions:
+                    self._process_model_run(
+                        layer,
+                        position,
+                        head,
+                        component,
+                        batch,
+                        freezed_attn,
+                        storage,
+                        normalize_logit,
+                        batch["obj_pos"],
+                        runner=batch_runner,
+                    )
+
+            if f"L{layer}" in freezed_attn:
+                freezed_attn.pop(
+                    f"L{layer}"
+                )  # to speed up the process (no need to freeze the previous layer)
+
     def ablate_single_len(
         self,
         length: int,
         component: str,
         normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
         total_effect: bool = False,
+        checkpoint: Optional[AblationCheckpoint] = None,
     ):
         """
-        Ablate the dataset with a specific length and component
+        Ablate the dataset with a specific length and component.
+        With a checkpoint, the batches already saved are loaded and the new ones are saved as soon as they are computed.
         """
 
         self.set_len(length, slice_to_fit_batch=False)
-        dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False)
+        dataloader = self.get_dataloader(shuffle=False)
         num_batches = len(dataloader)
 
         if num_batches == 0:
             return None
 
+        storage = self._get_storage(component, length, n_examples=len(self.dataset))
+        first_subject_positions = []
+        second_subject_positions = []
+        subject_lengths = []
+        object_position = []
+        runner = IncrementalRunner(self.model)
+        for batch_index, batch in enumerate(tqdm(dataloader, total=num_batches)):
+            first_subject_positions.append(batch["1_subj_pos"])
+            second_subject_positions.append(batch["2_subj_pos"])
+            subject_lengths.append(batch["subj_len"])
+            object_position.append(batch["obj_pos"])
+            if checkpoint is None:
+                self._ablate_batch(batch, component, storage, normalize_logit, total_effect, runner)
+                continue
+            logits = checkpoint.load_batch(component, length, batch_index)
+            if logits is None:
+                batch_storage = self._get_storage(component, length, n_examples=batch["input_ids"].shape[0])
+                self._ablate_batch(batch, component, batch_storage, normalize_logit, total_effect, runner)
+                logits = batch_storage.get_state()
+                checkpoint.save_batch(component, length, batch_index, logits)
+            storage.merge(logits)
+
+        runner.clear()
         if component in self.position_component:
-            storage = LogitStorage(
-                n_layers=self.model.cfg.n_layers-1,
-                length=length,
-                experiment=self.experiment,
+            return storage.get_aggregate_logit(
+                object_position=torch.cat(object_position, dim=0),
+                first_subject_positions=torch.cat(first_subject_positions, dim=0),
+                second_subject_positions=torch.cat(second_subject_positions, dim=0),
+                subject_lengths=torch.cat(subject_lengths, dim=0),
             )
-        elif component in self.head_component:
-            storage = HeadLogitStorage(
-                n_layers=self.model.cfg.n_layers -1,
-                length=1,
-                n_heads=self.model.cfg.n_heads,
-                experiment=self.experiment,
+
+        if component in self.head_component:
+            return storage.get_logit()
+
+    def ablate_adaptive(
+        self,
+        component: str,
+        normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+        tolerance: Optional[float] = 0.1,
+        z: float = 1.96,
+        min_examples: int = 100,
+        total_effect: bool = False,
+        generator: Optional[torch.Generator] = None,
+    ) -> Tuple[RunningStats, RunningStats, RunningStats, RunningStats, RunningStats]:
+        """
+        Ablate with sequential early stopping: the batches are drawn in stratified random order across lengths, and an
+        intervention stops being run once the confidence interval of its mem - cp effect has a half width of at most
+        tolerance or clearly excludes zero (after min_examples). Position components are aggregated per batch and
+        stop per layer, once all the aggregated positions of the layer have settled.
+        Return the running stats of mem, cp, diff, mem_winners and cp_winners, of shape (layer, position) or
+        (layer, 1, head). Overrides set_candidates while running.
+        With tolerance=None nothing stops early: every batch is ablated and only the running stats are kept (streaming).
+        """
+        lengths = self.dataset.get_lengths()
+        if 11 in lengths:
+            lengths.remove(11)
+        user_candidates = self.candidates
+        runner = IncrementalRunner(self.model)
+        stats: Optional[List[RunningStats]] = None
+        active: Optional[torch.Tensor] = None
+        for batch in tqdm(self.get_stratified_batches(lengths, generator=generator), desc=f"Ablating {component}"):
+            if stats is not None and tolerance is not None:
+                active = ~stats[2].converged(tolerance, z, min_examples)
+                if not active.any():
+                    break
+                if component in self.position_component:
+                    self.candidates = {layer: None for layer in range(active.shape[0]) if active[layer].any()}
+                else:
+                    self.candidates = {
+                        layer: active[layer, 0].nonzero()[:, 0].tolist()
+                        for layer in range(active.shape[0])
+                        if active[layer].any()
+                    }
+            storage = self._get_storage(
+                component, batch["input_ids"].shape[1], n_examples=batch["input_ids"].shape[0]
             )
+            self._ablate_batch(batch, component, storage, normalize_logit, total_effect, runner)
+            if component in self.position_component:
+                mem, cp, mem_winners, cp_winners = storage.get_aggregate_logit(
+                    object_position=batch["obj_pos"].cpu(),
+                    first_subject_positions=batch["1_subj_pos"].cpu(),
+                    second_subject_positions=batch["2_subj_pos"].cpu(),
+                    subject_lengths=batch["subj_len"].cpu(),
+                )
+            else:
+                mem, cp, mem_winners, cp_winners = storage.get_logit()
+            if stats is None:
+                stats = [RunningStats(mem.shape[:-1]) for _ in range(5)]
+            for stat, values in zip(stats, [mem, cp, mem - cp, mem_winners, cp_winners]):
+                stat.update(values, mask=active)
+        runner.clear()
+        self.candidates = user_candidates
+        if stats is None:
+            raise ValueError("No examples to ablate")
+        return tuple(stats)  # type: ignore
+
+    def run_adaptive(
+        self,
+        component: str,
+        normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+        tolerance: Optional[float] = 0.1,
+        **kwargs,
+    ) -> Tuple[pd.DataFrame, Dict[str, torch.Tensor]]:
+        """
+        Same as run with the early stopping of ablate_adaptive: the dataframe has the same columns plus n_examples,
+        the number of examples each intervention was evaluated on (tolerance=None: no early stopping, streaming).
+        The tensors are mem_mean, cp_mean and n_examples of shape (layer, position) or (layer, 1, head), with the
+        per-example base_mem and base_cp (run returns the per-example mem and cp instead)
+        """
+        mem, cp, diff, mem_winners, cp_winners = self.ablate_adaptive(
+            component, normalize_logit, tolerance=tolerance, **kwargs
+        )
+        base_logit_mem, base_logit_cp = self.get_basic_logit(normalize_logit=normalize_logit)
+
+        data = []
+        is_head = component in self.head_component
+        for index in product(*[range(size) for size in mem.shape]):
+            data.append(
+                {
+                    "component": component,
+                    "layer": index[0],
+                    "position": "not applicable" if is_head else index[1],
+                    "head": index[2] if is_head else "not applicable",
+                    "mem": mem.mean[index].item(),
+                    "cp": cp.mean[index].item(),
+                    "diff": diff.mean[index].item(),
+                    "mem_sum": mem_winners.sum()[index].item(),
+                    "cp_sum": cp_winners.sum()[index].item(),
+                    "mem_std": mem.std()[index].item(),
+                    "cp_std": cp.std()[index].item(),
+                    "diff_std": diff.std()[index].item(),
+                    "n_examples": int(diff.count[index].item()),
+                }
+            )
+        data.append(
+            {
+                "component": "base",
+                "layer": "not applicable",
+                "position": "not applicable",
+                "head": "not applicable",
+                "mem": base_logit_mem.mean().item(),
+                "cp": base_logit_cp.mean().item(),
+                "diff": (base_logit_mem - base_logit_cp).mean().item(),
+                "mem_std": base_logit_mem.std().item(),
+                "cp_std": base_logit_cp.std().item(),
+                "diff_std": (base_logit_mem - base_logit_cp).std().item(),
+                "n_examples": base_logit_mem.shape[0],
+            }
+        )
+        # means, not per-example logits: keyed apart from the results of run so that they are never mixed up
+        return pd.DataFrame(data), {
+            "mem_mean": mem.mean,
+            "cp_mean": cp.mean,
+            "n_examples": diff.count,
+            "base_mem": base_logit_mem,
+            "base_cp": base_logit_cp,
+        }
+
+    def attribution_patching_single_len(
+        self,
+        length: int,
+        component: str,
+        normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+        total_effect: bool = False,
+    ):
+        """
+        First-order estimate of ablate_single_len with one forward and one backward per batch (attribution patching):
+        zeroing an activation a changes a target logit by about -a . d(logit)/da.
+        Without total_effect, the gradient does not flow through what ablate_single_len freezes: the attention patterns
+        for mlp_out and attn_out, the attention outputs of the other layers for the heads.
+        The winners are not estimated (stored as nan, so the mem_sum and cp_sum columns of run are nan).
+        """
+        self.set_len(length, slice_to_fit_batch=False)
+        dataloader = self.get_dataloader(shuffle=False)
+        num_batches = len(dataloader)
+
+        if num_batches == 0:
+            return None
+
+        storage = self._get_storage(component, length, n_examples=len(self.dataset))
+        n_layers = self.model.cfg.n_layers - 1
+        if component in ["mlp_out", "attn_out"]:
+            hook_names = [f"blocks.{layer}.hook_{component}" for layer in range(n_layers)]
         else:
-            raise ValueError(f"component {component} not supported")
-        subject_positions = []
+            # attn_out_pattern also edits the pattern of the next layer
+            n_pattern_layers = n_layers + 1 if component == "attn_out_pattern" else n_layers
+            hook_names = [f"blocks.{layer}.attn.hook_pattern" for layer in range(n_pattern_layers)]
+        # the activations frozen by _ablate_batch are cut from the graph of the gradient forward
+        frozen_names = []
+        if component in ["mlp_out", "attn_out"] and not total_effect:
+            frozen_names = [f"blocks.{layer}.attn.hook_pattern" for layer in range(n_layers)]
+        elif component in self.head_component and not total_effect:
+            # the attention output of a layer only depends on its own (saved) pattern: the heads of the other layers
+            # see clean values and patterns, as with frozen attention outputs
+            frozen_names = [f"blocks.{layer}.attn.hook_v" for layer in range(n_layers)] + hook_names
+
+        first_subject_positions = []
+        second_subject_positions = []
+        subject_lengths = []
         object_position = []
         for batch in tqdm(dataloader, total=num_batches):
-            subject_positions.append(batch["subj_pos"])
+            first_subject_positions.append(batch["1_subj_pos"])
+            second_subject_positions.append(batch["2_subj_pos"])
+            subject_lengths.append(batch["subj_len"])
             object_position.append(batch["obj_pos"])
-            _, cache = self.model.run_with_cache(batch["prompt"], prepend_bos=False)
-            if (
-                component == "mlp_out"
-                or component == "attn_out"
-                and total_effect is False
-            ):
-                freezed_attn = self._get_freezed_attn_pattern(cache)
-            elif component == "head" and total_effect is False:
-                freezed_attn = self._get_freezed_attn(cache)
-            elif total_effect is True:
-                freezed_attn = {}
-            else:
-                raise ValueError(f"component {component} not supported")
 
-            for layer in range(self.model.cfg.n_layers - 1):
-                if component in self.position_component:
-                    for position in range(length):
-                        self._process_model_run(
-                            layer,
-                            position,
-                            None,
-                            component,
-                            batch,
-                            freezed_attn,
-                            storage,
-                            normalize_logit,
-                        )
-                if component in self.head_component:
-                    for head in range(self.model.cfg.n_heads):
-                        self._process_model_run(
-                            layer,
-                            None,
-                            head,
-                            component,
-                            batch,
-                            freezed_attn,
-                            storage,
-                            normalize_logit,
-                            batch["obj_pos"]
-                        )
+            activations = {}
 
-                if f"L{layer}" in freezed_attn:
-                    freezed_attn.pop(
-                        f"L{layer}"
-                    )  # to speed up the process (no need to freeze the previous layer)
+            def save_hook(activation, hook):
+                if hook.name in frozen_names:
+                    activation = activation.detach()
+                if not activation.requires_grad:
+                    activation.requires_grad_(True)
+                activations[hook.name] = activation
+                return activation
 
-        if component in self.position_component:
-            if self.experiment == "contextVSfact":
-                subject_positions = torch.cat(subject_positions, dim=0)
-                object_position = torch.cat(object_position, dim=0)
-                return storage.get_aggregate_logit(
-                    object_position=object_position,
-                    subj_positions=subject_positions,
-                    batch_dim=0,
+            def freeze_hook(activation, hook):
+                return activation.detach()
+
+            model_input, model_kwargs = self.get_model_input(batch)
+            self.model.reset_hooks()
+            # the module sets torch.set_grad_enabled(False) globally: enable it only for this forward/backward
+            with torch.enable_grad():
+                logit, logsumexp = self.model.readout(
+                    model_input,
+                    targets=batch["target"],
+                    normalize=normalize_logit,
+                    fwd_hooks=[(name, save_hook) for name in hook_names]
+                    + [(name, freeze_hook) for name in frozen_names if name not in hook_names],
+                    **model_kwargs,
+                )
+                logit = normalize_readout(logit, logsumexp, normalize_logit)
+                saved = [activations[name] for name in hook_names]
+                # mem and cp need separate gradients: two backward passes through the graph of the same forward
+                mem_grads = torch.autograd.grad(logit[:, 0].sum(), saved, retain_graph=True)
+                cp_grads = torch.autograd.grad(logit[:, 1].sum(), saved)
+            logit = logit.detach().cpu()
+            saved = [activation.detach() for activation in saved]
+            no_winners = torch.full((logit.shape[0],), float("nan"))
+
+            def store(layer, position, head, mem_effect, cp_effect):
+                estimate = (
+                    logit[:, 0] + mem_effect.cpu(),
+                    logit[:, 1] + cp_effect.cpu(),
+                    None,
+                    None,
+                )
+                storage.store(
+                    layer=layer,
+                    position=position,
+                    head=head,
+                    logit=estimate,
+                    mem_winners=no_winners,
+                    cp_winners=no_winners,
                 )
-            return storage.get_aggregate_logit(object_position=self.dataset.obj_pos[0])
 
-        if component in self.head_component:
-            return storage.get_logit()
+            rows = torch.arange(logit.shape[0])
+            for layer in range(n_layers):
+                if component in ["mlp_out", "attn_out"]:
+                    # (batch, pos): effect of zeroing each position
+                    mem_effect = -(saved[layer] * mem_grads[layer]).sum(-1)
+                    cp_effect = -(saved[layer] * cp_grads[layer]).sum(-1)
+                    for position in range(length):
+                        store(layer, position, 0, mem_effect[:, position], cp_effect[:, position])
+                elif component == "attn_out_pattern":
+                    # (batch, key): effect of zeroing the last query row at each key, for all the heads of two layers
+                    mem_effect, cp_effect = 0, 0
+                    for i in range(2):
+                        pattern = saved[layer + i][:, :, -1, :]
+                        mem_effect = mem_effect - (pattern * mem_grads[layer + i][:, :, -1, :]).sum(1)
+                        cp_effect = cp_effect - (pattern * cp_grads[layer + i][:, :, -1, :]).sum(1)
+                    for position in range(length):
+                        store(layer, position, 0, mem_effect[:, position], cp_effect[:, position])  # type: ignore
+                else:
+                    mem_effect = -saved[layer][:, :, -1, :] * mem_grads[layer][:, :, -1, :]
+                    cp_effect = -saved[layer][:, :, -1, :] * cp_grads[layer][:, :, -1, :]
+                    if component == "head_object_pos":
+                        # (batch, head) at the object position of each example
+                        key = batch["obj_pos"].to(mem_effect.device)
+                        mem_effect = mem_effect[rows.to(key.device), :, key]
+                        cp_effect = cp_effect[rows.to(key.device), :, key]
+                    else:
+                        mem_effect, cp_effect = mem_effect.sum(-1), cp_effect.sum(-1)
+                    for head in range(self.model.cfg.n_heads):
+                        store(layer, 0, head, mem_effect[:, head], cp_effect[:, head])
+
+        if component in self.position_component:
+            return storage.get_aggregate_logit(
+                object_position=torch.cat(object_position, dim=0),
+                first_subject_positions=torch.cat(first_subject_positions, dim=0),
+                second_subject_positions=torch.cat(second_subject_positions, dim=0),
+                subject_lengths=torch.cat(subject_lengths, dim=0),
+            )
+        return storage.get_logit()
 
     def ablate_single_len_component_attn_pythia(
         self,
@@ -291,7 +862,7 @@ class Ablate(BaseExperiment):
         total_effect: bool = False,
     ):
         self.set_len(length, slice_to_fit_batch=False)
-        dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False)
+        dataloader = self.get_dataloader(shuffle=False)
         num_batches = len(dataloader)
         
         if num_batches == 0:
@@ -309,7 +880,6 @@ class Ablate(BaseExperiment):
         for batch in tqdm(dataloader, total=num_batches):
             subject_positions.append(batch["subj_pos"])
             object_position.append(batch["obj_pos"])
-            _, cache = self.model.run_with_cache(batch["prompt"], prepend_bos=False)
             
             for layer in range(0, self.model.cfg.n_layers+1-WINDOW, 1):
                 for position in range(length):
@@ -324,15 +894,15 @@ class Ablate(BaseExperiment):
                             cp_winners=place_holder_tensor,
                         )
                     else:
-                        def head_ablation_hook(activation, hook, head):
-                            activation[:, head, -1, position ] = 0
-                            return activation
-                        hooks = []
-                        for head in range(self.model.cfg.n_heads):
-                            for i in range(WINDOW):
-                                hooks.append(
-                                    (f"blocks.{layer +i}.attn.hook_pattern", partial(head_ablation_hook, head=head))
-                                )
+                        # all the heads of each layer of the window in one hook per layer
+                        hooks = bind_hooks(
+                            compile_edits(
+                                [
+                                    Edit(f"blocks.{layer + i}.attn.hook_pattern", query=-1, key=position)
+                                    for i in range(WINDOW)
+                                ]
+                            )
+                        )
 
                         logit = self._run_with_hooks(batch, hooks)
                         logit_token = to_logit_token(
@@ -355,7 +925,7 @@ class Ablate(BaseExperiment):
         total_effect: bool = False,
     ):
         self.set_len(length, slice_to_fit_batch=False)
-        dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False)
+        dataloader = self.get_dataloader(shuffle=False)
         num_batches = len(dataloader)
         
         if num_batches == 0:
@@ -373,7 +943,6 @@ class Ablate(BaseExperiment):
         for batch in tqdm(dataloader, total=num_batches):
             subject_positions.append(batch["subj_pos"])
             object_position.append(batch["obj_pos"])
-            _, cache = self.model.run_with_cache(batch["prompt"], prepend_bos=False)
             
             for layer in range(0, self.model.cfg.n_layers, 1):
                 for position in range(length):
@@ -541,19 +1110,27 @@ class Ablate(BaseExperiment):
         self,
         component: str,
         normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+        approximate: bool = False,
+        checkpoint: Optional[AblationCheckpoint] = None,
         **kwargs,
     ):
         """
-        Ablate the model by ablating each position in the sequence
+        Ablate the model by ablating each position in the sequence.
+        With approximate=True the effects are estimated with attribution patching (see attribution_patching_single_len)
         """
         lengths = self.dataset.get_lengths()
         if 11 in lengths:
             lengths.remove(11)
         result = {}
         for length in tqdm(lengths, desc=f"Ablating {component}", total=len(lengths)):
-            result[length] = self.ablate_factual_head(
-                length, component, normalize_logit, **kwargs
-            )
+            if approximate:
+                result[length] = self.attribution_patching_single_len(
+                    length, component, normalize_logit, **kwargs
+                )
+            else:
+                result[length] = self.ablate_single_len(
+                    length, component, normalize_logit, checkpoint=checkpoint, **kwargs
+                )
 
         tuple_shape = len(result[lengths[0]])
         aggregated_result = [
@@ -569,13 +1146,42 @@ class Ablate(BaseExperiment):
         normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
         total_effect: bool = False,
         load_from_pt: Optional[str] = None,
+        approximate: bool = False,
+        streaming: bool = False,
     ) -> Tuple[pd.DataFrame, Dict[str, torch.Tensor]]:
         """
-        Run ablation for a specific component
+        Run ablation for a specific component (estimated with attribution patching if approximate=True)
+        The skipped column flags the interventions left out by set_candidates (clean logits, not ablated)
+        streaming: keep only the running statistics of each intervention, not the per-example logits (run_adaptive
+            without early stopping): the tensors returned are mem_mean, cp_mean and n_examples instead of mem and cp
         """
+        if streaming:
+            if approximate or load_from_pt is not None or self.checkpoint_dir is not None:
+                raise ValueError("streaming does not support approximate, load_from_pt and checkpoint_dir")
+            return self.run_adaptive(
+                component, normalize_logit, tolerance=None, total_effect=total_effect
+            )
         print(load_from_pt)
-        if load_from_pt is None:
-            result = self.ablate(component, normalize_logit, total_effect=total_effect)
+        checkpoint = self._get_checkpoint(
+            normalize_logit=normalize_logit, total_effect=total_effect, approximate=approximate
+        )
+        if load_from_pt is None and checkpoint is not None:
+            # assemble from the checkpoint: only the missing batches are computed
+            result = checkpoint.load_result(f"{component}/result")
+            if result is None:
+                result = self.ablate(
+                    component, normalize_logit, approximate=approximate, total_effect=total_effect, checkpoint=checkpoint
+                )
+                checkpoint.save_result(f"{component}/result", result)
+            base = checkpoint.load_result("base")
+            if base is None:
+                base = self.get_basic_logit(normalize_logit=normalize_logit)
+                checkpoint.save_result("base", base)
+            base_logit_mem, base_logit_cp = base
+        elif load_from_pt is None:
+            result = self.ablate(
+                component, normalize_logit, approximate=approximate, total_effect=total_effect
+            )
 
             base_logit_mem, base_logit_cp = self.get_basic_logit(
                 normalize_logit=normalize_logit
@@ -590,7 +1196,7 @@ class Ablate(BaseExperiment):
 
         if component in self.position_component:
             data = []
-            for layer in range(0,self.model.cfg.n_layers-WINDOW+1):
+            for layer in range(result[0].shape[0]):
                 for position in range(result[0][layer].shape[0]):
                     data.append(
                         {
@@ -614,12 +1220,13 @@ class Ablate(BaseExperiment):
                             )
                             .std()
                             .item(),
+                            "skipped": not approximate and self._is_skipped(layer, position),
                         }
                     )
 
         elif component in self.head_component:
             data = []
-            for layer in range(self.model.cfg.n_layers-WINDOW+1):
+            for layer in range(result[0].shape[0]):
 
                 for head in range(self.model.cfg.n_heads):
                     data.append(
@@ -646,6 +1253,7 @@ class Ablate(BaseExperiment):
                             )
                             .std()
                             .item(),
+                            "skipped": not approximate and self._is_skipped(layer, head),
                         }
                     )
         else:
@@ -684,16 +1292,15 @@ class Ablate(BaseExperiment):
         Run ablation for all components
         """
         dataframe_list = []
-        tuple_results_cat = {"mem": [], "cp": [], "base_mem": [], "base_cp": []}
+        # the keys of run (mem, cp, ...) or of the streaming run (mem_mean, cp_mean, n_examples, ...)
+        tuple_results_cat: Dict[str, List[torch.Tensor]] = {}
         for component in self.position_component + self.head_component:
             print(f"Running ablation for {component}")
             dataset, tuple_results = self.run(
                 component, normalize_logit, load_from_pt=load_from_pt, **kwargs
             )
             dataframe_list.append(dataset)
-            tuple_results_cat["mem"].append(tuple_results["mem"])
-            tuple_results_cat["cp"].append(tuple_results["cp"])
-            tuple_results_cat["base_mem"].append(tuple_results["base_mem"])
-            tuple_results_cat["base_cp"].append(tuple_results["base_cp"])
+            for key, value in tuple_results.items():
+                tuple_results_cat.setdefault(key, []).append(value)
 
         return pd.concat(dataframe_list), tuple_results_cat
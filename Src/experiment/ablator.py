@@ -3,7 +3,6 @@ from re import sub
 import re
 from more_itertools import prepend
 import torch
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from Src.dataset import BaseDataset
 from Src.model import BaseModel
@@ -12,33 +11,9 @@ from typing import Callable, Optional, Tuple, Dict, Any, Literal, Union, List
 import pandas as pd
 from Src.experiment import LogitStorage, HeadLogitStorage
 from functools import partial
-from copy import deepcopy
 import inspect
-
-def get_partial_arg_names(partial_func):
-    # Get the original function from the partial object
-    original_func = partial_func.func
-    
-    # Get the signature of the original function
-    sig = inspect.signature(original_func)
-    
-    # Get a list of the parameter names of the original function
-    param_names = list(sig.parameters.keys())
-    
-    # Initialize lists to hold the names of fixed positional and keyword arguments
-    fixed_positional_arg_names = []
-    fixed_keyword_arg_names = list(partial_func.keywords.keys())
-    
-    # Iterate over the fixed positional arguments
-    for i, arg in enumerate(partial_func.args):
-        if i < len(param_names):
-            fixed_positional_arg_names.append(param_names[i])
-        else:
-            # This handles cases where there are more positional arguments than the original function expects
-            fixed_positional_arg_names.append(f"arg_{i}")
-    
-    return fixed_positional_arg_names, fixed_keyword_arg_names
-
+from Src.experiment.interventions import Edit, FusedHook, compile_edits, bind_hooks
+from Src.accumulator import RunningStats
 
 class Ablator(BaseExperiment):
     def __init__(
@@ -48,10 +23,11 @@ class Ablator(BaseExperiment):
         batch_size: int,
         experiment: Literal["copyVSfact"],
         total_effect: bool = True,
+        token_budget: Optional[int] = None,
     ):
-        super().__init__(dataset, model, batch_size, experiment)
+        super().__init__(dataset, model, batch_size, experiment, token_budget=token_budget)
         self.total_effect = total_effect
-        self.hooks = []
+        self.reset_hooks()
 
     def set_heads(self, heads:List[Tuple[int,int]], position: Literal["all", "attribute"] = "attribute", value: float = 0.0):
         """
@@ -59,52 +35,60 @@ class Ablator(BaseExperiment):
         position: "all" or "attribute" to ablate all the entries or only the attribute entries
         value: value to multiply the ablated entries (default 0.0) pattern <- value * pattern
         """
+        if position not in ["all", "attribute"]:
+            raise ValueError("position must be 'all' or 'attribute'")
         self.reset_hooks()
-        def hook_fn(attention_pattern:torch.Tensor,hook, value:float, position: Literal["all", "attribute"], batch, head:int):
-            if position == "all":
-                attention_pattern[:,head, -1, :] = value * attention_pattern[:,head, -1, :]
-                return attention_pattern
-            elif position == "attribute":
-                attribute_positions = batch["obj_pos"]
-                #for each element in the batch and for each head, ablate the attention pattern with the corresponding position of the attribute
-                for i, pos in enumerate(attribute_positions):
-                    attention_pattern[i, head, -1, pos] = value * attention_pattern[i, head, -1, pos]
-                return attention_pattern
-            else:
-                raise ValueError("position must be 'all' or 'attribute'")
-            
-        for layer, head in heads:
-            self.hooks.append((f"blocks.{layer}.attn.hook_attn_scores", partial(hook_fn, value=value, position=position, head=head)))
-            
-                
+        # the attribute position of each example is read from the obj_pos column of the batch
+        key = "obj_pos" if position == "attribute" else None
+        edits = [
+            Edit(f"blocks.{layer}.attn.hook_attn_scores", heads=(head,), query=-1, key=key, scale=value)
+            for layer, head in heads
+        ]
+        self.set_hooks(compile_edits(edits))
+
     def reset_hooks(self):
-        self.hooks = []            
-    
+        self.set_hooks([])
+
     def set_hooks(self, hooks) -> None:
+        """
+        hooks: list of (hook_name, hook), FusedHook or hooks with a batch argument are given the current batch
+        """
         self.hooks = hooks
+        self._bind_hooks()
+
+    def _bind_hooks(self):
+        """
+        Split the hooks once into batch-independent ones and ones to rebind to each batch
+        """
+        self.static_hooks, self.batch_hooks, self.fused_hooks = [], [], []
+        for hook in self.hooks:
+            if isinstance(hook, FusedHook):
+                self.fused_hooks.append(hook)
+                continue
+            hook_name, hook_fn = hook
+            if "batch" in inspect.signature(hook_fn).parameters:
+                self.batch_hooks.append((hook_name, hook_fn))
+            else:
+                self.static_hooks.append((hook_name, hook_fn))
 
     def __run_with_hooks__(self, batch):
         self.model.reset_hooks()
-        # with torch.no_grad():
-            #re-write hooks: if the hook are batch dependent, we should pass the batch to the hook, otherwise we can just pass the hook
-        def hook_fn(hook, batch):
-            #if batch is a argument of the hook, we pass it
-            if "batch" in list(inspect.signature(hook).parameters.keys()):
-                return partial(hook, batch=batch)
-            else:
-                return hook
-        actual_hooks = []
-        for hook_name, hook in self.hooks:
-            actual_hooks.append((hook_name, hook_fn(hook, batch)))
-        
-        logit = self.model.run_with_hooks(
-            batch["prompt"], prepend_bos=False, fwd_hooks=actual_hooks
+        # only the per-batch hooks are rebound to the batch
+        actual_hooks = (
+            self.static_hooks
+            + [(hook_name, partial(hook_fn, batch=batch)) for hook_name, hook_fn in self.batch_hooks]
+            + bind_hooks(self.fused_hooks, batch)
         )
 
-        return logit[:, -1, :]
-    
+        model_input, model_kwargs = self.get_model_input(batch)
+        # only the last position is unembedded
+        logit, _ = self.model.readout(
+            model_input, fwd_hooks=actual_hooks, **model_kwargs
+        )
+        return logit
+
     def ablate_length(
-        self, length: int, normalize_logit: Literal["none", "softmax", "sigmoid"] = "none"
+        self, length: Optional[int], normalize_logit: Literal["none", "softmax", "sigmoid"] = "none"
     ):
         """
         Apply the hooks to the model for the given length and return the logit of the model
@@ -115,11 +99,7 @@ class Ablator(BaseExperiment):
         mem_winners = []
         cp_winners = []
         self.dataset.set_len(length)
-        for batch in DataLoader(
-                self.dataset,
-                batch_size=self.batch_size,
-                shuffle=False,
-        ):
+        for batch in self.get_dataloader(shuffle=False):
             logit = self.__run_with_hooks__(batch)
             logit_mem, logit_cp, _, _, mem_winner, cp_winner = to_logit_token(
                 logit, batch["target"], normalize=normalize_logit, return_winners=True
@@ -133,6 +113,37 @@ class Ablator(BaseExperiment):
         return torch.cat(mem), torch.cat(cp), torch.cat(diff), torch.cat(mem_winners), torch.cat(cp_winners)
         
     
+    def ablate_adaptive(
+        self,
+        normalize_logit: Literal["none", "softmax", "sigmoid"] = "none",
+        tolerance: float = 0.1,
+        z: float = 1.96,
+        min_examples: int = 100,
+        generator: Optional[torch.Generator] = None,
+    ):
+        """
+        Same as ablate, but the batches are drawn in stratified random order across lengths and the loop stops once the
+        confidence interval of the mean mem - cp difference has a half width of at most tolerance or clearly excludes zero
+        (after min_examples). Returns the results of the examples evaluated so far.
+        """
+        result = {"mem": [], "cp": [], "diff": [], "mem_win": [], "cp_win": []}
+        diff_stats = RunningStats()
+        for batch in tqdm(self.get_stratified_batches(generator=generator), desc="Ablating"):
+            logit = self.__run_with_hooks__(batch)
+            logit_mem, logit_cp, _, _, mem_winner, cp_winner = to_logit_token(
+                logit, batch["target"], normalize=normalize_logit, return_winners=True
+            )
+            result["mem"].append(logit_mem)
+            result["cp"].append(logit_cp)
+            result["diff"].append(logit_mem - logit_cp)
+            result["mem_win"].append(mem_winner)
+            result["cp_win"].append(cp_winner)
+            diff_stats.update(logit_mem - logit_cp)
+            if diff_stats.converged(tolerance, z, min_examples).item():
+                break
+
+        return {key: torch.cat(values) for key, values in result.items()}
+
     def ablate(self, normalize_logit: Literal["none", "softmax", "sigmoid"] = "none"):
         """
         Apply the hooks to the model for all the lengths and return the logit of the model along with the count of the examples where the model predicted the factual and counterfactual token
@@ -144,9 +155,8 @@ class Ablator(BaseExperiment):
         - mem_win: count of the examples where the model predicted the factual token
         - cp_win: count of the examples where the model predicted the counterfactual token
         """
-        lengths = self.dataset.get_lengths()
         result = {"mem": [], "cp": [], "diff": [], "mem_win": [], "cp_win": []}
-        for length in tqdm(lengths, desc="Ablating"):
+        for length in tqdm(self.get_length_groups(), desc="Ablating"):
             mem, cp, diff, mem_win, cp_win = self.ablate_length(length, normalize_logit)
             result["mem"].append(mem)
             result["cp"].append(cp)
@@ -166,6 +176,8 @@ class Ablator(BaseExperiment):
         self,
         normalize_logit: Literal["none", "softmax", "sigmoid"] = "none",
         save_name: Optional[str] = None,
+        tolerance: Optional[float] = None,
+        **kwargs,
     ):
         """
         Run the attention ablation/modification experiment and return the results
@@ -179,8 +191,12 @@ class Ablator(BaseExperiment):
         - diff_std: standard deviation of the difference between the logit of the model for the factual and counterfactual token
         - mem_win: count of the examples where the model predicted the factual token
         - cp_win: count of the examples where the model predicted the counterfactual token
+        - n_examples: number of examples evaluated (fewer than the dataset with a tolerance, see ablate_adaptive)
         """
-        result = self.ablate(normalize_logit)
+        if tolerance is not None:
+            result = self.ablate_adaptive(normalize_logit, tolerance=tolerance, **kwargs)
+        else:
+            result = self.ablate(normalize_logit)
 
         data = {
             "mem": result["mem"].mean().item(),
@@ -191,6 +207,7 @@ class Ablator(BaseExperiment):
             "diff_std": result["diff"].std().item(),
             "mem_win": result["mem_win"].sum().item(),
             "cp_win": result["cp_win"].sum().item(),
+            "n_examples": result["mem"].shape[0],
         }
         
         return pd.DataFrame(data, index=[0])
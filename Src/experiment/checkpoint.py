@@ -0,0 +1,64 @@
+import os
+import json
+import torch
+from typing import Any, Dict, Optional
+
+MANIFEST = "manifest.json"
+
+
+def atomic_save(obj: Any, path: str):
+    """
+    torch.save through a temporary file, so that a killed job never leaves a truncated checkpoint
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class AblationCheckpoint:
+    """
+    Directory of the partial results of an ablation run:
+        - manifest.json: the config and dataset fingerprint of the run
+        - {component}/{length}/{batch}.pt: the logits stored for each batch
+        - {component}/result.pt, base.pt: the assembled results of each component and the clean logits
+    A directory can only be resumed with the same config and dataset fingerprint.
+    """
+
+    def __init__(self, directory: str, config: Dict[str, Any], resume: bool = False):
+        self.directory = directory
+        self.config = json.loads(json.dumps(config, default=str))
+        manifest_path = os.path.join(directory, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                saved_config = json.load(f)
+            if not resume:
+                raise ValueError(f"{directory} already contains an ablation run: resume it or use another directory")
+            mismatched = sorted(
+                key
+                for key in set(saved_config) | set(self.config)
+                if saved_config.get(key) != self.config.get(key)
+            )
+            if len(mismatched) > 0:
+                raise ValueError(f"Cannot resume {directory}: {', '.join(mismatched)} do not match the checkpoint")
+        else:
+            os.makedirs(directory, exist_ok=True)
+            with open(manifest_path, "w") as f:
+                json.dump(self.config, f, indent=2)
+
+    def _path(self, *parts) -> str:
+        return os.path.join(self.directory, *[str(part) for part in parts])
+
+    def load_batch(self, component: str, length: int, batch_index: int) -> Optional[Dict]:
+        path = self._path(component, length, f"{batch_index}.pt")
+        return torch.load(path) if os.path.exists(path) else None
+
+    def save_batch(self, component: str, length: int, batch_index: int, logits: Dict):
+        atomic_save(logits, self._path(component, length, f"{batch_index}.pt"))
+
+    def load_result(self, name: str) -> Optional[Any]:
+        path = self._path(f"{name}.pt")
+        return torch.load(path) if os.path.exists(path) else None
+
+    def save_result(self, name: str, result: Any):
+        atomic_save(result, self._path(f"{name}.pt"))
@@ -1,23 +1,28 @@
 from math import isnan
 from tomlkit import value
 import torch
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from Src.dataset import BaseDataset
 from Src.model import BaseModel
 from Src.base_experiment import BaseExperiment
-from typing import  Dict, Literal
+from typing import  Dict, Literal, Optional, Union
 import pandas as pd
 
 from Src.utils import AGGREGATED_DIMS
+from Src.accumulator import RunningStats
 AGGREGATED_DIMS = 14
 
 class HeadPatternStorage():
-    def __init__(self, n_layers:int, n_heads:int, experiment:Literal["copyVSfact", "contextVSfact"]):
+    def __init__(self, n_layers:int, n_heads:int, experiment:Literal["copyVSfact", "contextVSfact"], streaming:bool = False):
+        """
+        streaming: keep only the running statistics of the aggregated pattern of each head (see get_stats)
+        """
         self.n_layers = n_layers
         self.n_heads = n_heads
         self.experiment:Literal["copyVSfact", "contextVSfact"] = experiment
+        self.streaming = streaming
         self.storage = {f"L{i}H{j}":[] for i in range(n_layers) for j in range(n_heads)}
+        self.stats: Dict[str, RunningStats] = {}
         
         
     def _get_position_to_aggregate_copyVSfact(self,
@@ -26,10 +31,11 @@ class HeadPatternStorage():
                                             first_subject_position:torch.Tensor,
                                             second_subject_position:torch.Tensor,
                                             subject_lengths:torch.Tensor, 
-                                            length:int):
+                                            length:int,
+                                            pad_offset:Union[torch.Tensor, int] = 0):
         
-        if i == 0: # pre subject
-            return slice(0, first_subject_position -1)
+        if i == 0: # pre subject (after the left padding, if any)
+            return slice(pad_offset, first_subject_position -1)
         if i == 1: # first subject token
             return first_subject_position 
         if i == 2: # between first and second subject
@@ -130,10 +136,12 @@ class HeadPatternStorage():
                         first_subject_position:torch.Tensor,
                         second_subject_position:torch.Tensor,
                         subject_lengths,
-                        length:int
+                        length:int,
+                        pad_offsets:Optional[torch.Tensor] = None,
                         ) -> torch.Tensor:    
         """
         pattern shape: (batch_size, seq_len, seq_len)
+        pad_offsets: (batch_size) left padding of each example in a mixed-length batch
         return shape:(batch_size, 13, 13)
         """
 
@@ -149,7 +157,8 @@ class HeadPatternStorage():
                                                 first_subject_position[i],
                                                 second_subject_position[i],
                                                 subject_lengths[i],
-                                                length 
+                                                length,
+                                                pad_offsets[i] if pad_offsets is not None else 0,
                                                 )
             return return_pattern
         else:
@@ -163,6 +172,7 @@ class HeadPatternStorage():
                                     second_subject_position:torch.Tensor,
                                     subject_lengths:torch.Tensor,
                                     length:int,
+                                    pad_offset:Union[torch.Tensor, int] = 0,
                                     ) -> torch.Tensor:
         
         assert pattern.ndim == 2, "pattern should be 2D, (seq_len, seq_len) NOT (batch_size, seq_len, seq_len)"
@@ -180,14 +190,16 @@ class HeadPatternStorage():
                                                                                 first_subject_position = first_subject_position,
                                                                                 second_subject_position = second_subject_position,
                                                                                 subject_lengths = subject_lengths,    
-                                                                                length = length)
+                                                                                length = length,
+                                                                                pad_offset = pad_offset)
             for j in range(AGGREGATED_DIMS):
                 position_to_aggregate_col = self._get_position_to_aggregate_copyVSfact(j, 
                                                                                     object_position = object_position,
                                                                                     first_subject_position = first_subject_position, 
                                                                                     second_subject_position = second_subject_position,
                                                                                     subject_lengths = subject_lengths,
-                                                                                    length= length,)
+                                                                                    length= length,
+                                                                                    pad_offset = pad_offset)
                 if position_to_aggregate_row == -100 or position_to_aggregate_col == -100:
                     aggregate_result[i, j] = 0
                     continue
@@ -209,7 +221,8 @@ class HeadPatternStorage():
             first_subject_position:torch.Tensor,
             second_subject_position:torch.Tensor,
             subject_lengths:torch.Tensor,
-            length:int):
+            length:int,
+            pad_offsets:Optional[torch.Tensor] = None):
         
         aggregate_pattern = self._aggregate_pattern(
                         pattern = pattern,
@@ -217,40 +230,59 @@ class HeadPatternStorage():
                         first_subject_position = first_subject_position,
                         second_subject_position = second_subject_position,
                         subject_lengths = subject_lengths,
-                        length = length
+                        length = length,
+                        pad_offsets = pad_offsets,
                         ) # (batch_size, 13, 13)
+        if self.streaming:
+            key = f"L{layer}H{head}"
+            if key not in self.stats:
+                self.stats[key] = RunningStats(aggregate_pattern.shape[1:])
+            self.stats[key].update(aggregate_pattern.permute(1, 2, 0))
+            return
         self.storage[f"L{layer}H{head}"].append(aggregate_pattern)
 
     def stack(self):
         """
         from a dict of list of tensors to a dict of tensor
         """
+        if self.streaming:
+            raise ValueError("The per-example patterns are not kept in streaming mode: use get_stats")
         stacked_result = {}
         for keys in self.storage.keys():
             stacked_result[keys] = torch.cat(self.storage[keys], dim=0)
         
         return stacked_result
+
+    def get_stats(self) -> Dict[str, RunningStats]:
+        """
+        Running statistics of the aggregated pattern of each head, of shape (source_position, dest_position)
+        """
+        if self.streaming:
+            return self.stats
+        return {key: RunningStats.from_values(value.permute(1, 2, 0)) for key, value in self.stack().items()}
     
 
 class HeadPattern(BaseExperiment):
+    cached_activations = ["attn.hook_pattern"]
+    # the patterns are aggregated on the cpu
+    offload_cache = True
+
     def __init__(
         self, dataset: BaseDataset, model: BaseModel, batch_size: int, experiment: Literal["copyVSfact", "contextVSfact"],
+        token_budget: Optional[int] = None,
     ):
-        super().__init__(dataset, model, batch_size, experiment)
+        super().__init__(dataset, model, batch_size, experiment, token_budget=token_budget)
         
     def _extract_pattern(self, cache, layer: int, head: int):
         pattern = cache[f"blocks.{layer}.attn.hook_pattern"][:, head, :, :]
         return pattern
     
-    def extract_single_len(self, length:int, storage:HeadPatternStorage):
+    def extract_single_len(self, length:Optional[int], storage:HeadPatternStorage):
         self.set_len(length)
-        dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False)
+        dataloader = self.get_dataloader(shuffle=False)
         
-        # initialize storage
-    
-        object_position = self.dataset.obj_pos[0]
         for batch in tqdm(dataloader, total=len(dataloader)):
-            _, cache = self.model.run_with_cache(batch["prompt"], prepend_bos=False)
+            _, cache = self.run_with_cache(batch)
             for layer in range(self.model.cfg.n_layers):
                 for head in range(self.model.cfg.n_heads):
                     pattern = self._extract_pattern(cache, layer, head)
@@ -262,21 +294,34 @@ class HeadPattern(BaseExperiment):
                         first_subject_position=batch["1_subj_pos"],
                         second_subject_position=batch["2_subj_pos"],
                         subject_lengths=batch["subj_len"],
-                        length=length
+                        length=batch["input_ids"].shape[1],
+                        pad_offsets=batch.get("pad_offset"),
                     )
                             
         torch.cuda.empty_cache()
 
-    def extract(self) -> Dict[str, torch.Tensor]:
-        self.storage = HeadPatternStorage(self.model.cfg.n_layers, self.model.cfg.n_heads, self.experiment)
-        for length in tqdm(self.dataset.lengths):
+    def extract(self, streaming: bool = False) -> Dict[str, Union[torch.Tensor, RunningStats]]:
+        """
+        Aggregated pattern of each head: (examples, source_position, dest_position) tensors, or their RunningStats with
+        streaming=True
+        """
+        self.storage = HeadPatternStorage(
+            self.model.cfg.n_layers, self.model.cfg.n_heads, self.experiment, streaming=streaming
+        )
+        for length in tqdm(self.get_length_groups()):
             if length == 11:
                 continue
             self.extract_single_len(length, self.storage)
-        return self.storage.stack()
+        if streaming:
+            return self.storage.get_stats()  # type: ignore
+        return self.storage.stack()  # type: ignore
 
-    def run(self):
-        patter_all_heads = self.extract()
+    def run(self, streaming: bool = False):
+        """
+        streaming: keep only the running mean of the aggregated pattern of each head, not the per-example patterns
+        """
+        self.extract(streaming=streaming)
+        patter_all_heads = self.storage.get_stats()
         
         data = []
         if "contextVSfact" in self.experiment:
@@ -295,7 +340,7 @@ class HeadPattern(BaseExperiment):
                             "head":head,
                             "source_position":source_position,
                             "dest_position":dest_position,
-                            "value":patter_all_heads[f"L{layer}H{head}"][:, source_position, dest_position].mean().item()
+                            "value":patter_all_heads[f"L{layer}H{head}"].mean[source_position, dest_position].item()
                         })
                         
         df = pd.DataFrame(data)
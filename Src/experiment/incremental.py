@@ -0,0 +1,97 @@
+import torch
+from typing import Dict, List, Literal, Optional, Tuple
+from transformer_lens.past_key_value_caching import HookedTransformerKeyValueCacheEntry
+from Src.model import WrapHookedTransformer, unembed_last_position
+
+
+class IncrementalRunner:
+    """
+    Re-run only the part of the forward pass that an intervention can change.
+    An edit at layer L cannot change the residual stream below L, and an edit at position p cannot change the positions
+    before p (causal attention). prepare() caches, once per batch, the clean residual stream entering each layer and the
+    keys/values of each layer; run(layer, position, hooks) resumes the forward pass from blocks.{layer} for the positions
+    [position:] only, attending to the clean keys/values of the positions before.
+    Hooks see the activations of the resumed positions only: the last position is always at -1, position p of the
+    sequence is at p - length.
+    """
+
+    def __init__(self, model: WrapHookedTransformer):
+        self.model = model
+        self.resid_pre: List[torch.Tensor] = []
+        self.keys: List[torch.Tensor] = []
+        self.values: List[torch.Tensor] = []
+        self.length = 0
+
+    @staticmethod
+    def supports(model: WrapHookedTransformer, batch: Dict) -> bool:
+        """
+        Left-padded batches and shortformer positional embeddings (added at every layer) are not supported
+        """
+        return (
+            "attention_mask" not in batch
+            and model.model.cfg.positional_embedding_type != "shortformer"
+        )
+
+    def prepare(self, input: torch.Tensor, names: Optional[List[str]] = None, **kwargs):
+        """
+        Clean forward of the batch caching the residual stream, keys and values of each layer (plus the optional names).
+        Return the cache, so that the clean activations needed by the hooks do not require another forward.
+        """
+        names = ["hook_resid_pre", "attn.hook_k", "attn.hook_v"] + (names or [])
+        _, cache = self.model.run_with_cache(input, names=names, **kwargs)
+        n_layers = self.model.cfg.n_layers
+        self.resid_pre = [cache[f"blocks.{layer}.hook_resid_pre"] for layer in range(n_layers)]
+        self.keys = [cache[f"blocks.{layer}.attn.hook_k"] for layer in range(n_layers)]
+        self.values = [cache[f"blocks.{layer}.attn.hook_v"] for layer in range(n_layers)]
+        self.length = input.shape[1]
+        return cache
+
+    def _cache_entry(
+        self, layer: int, position: int, repeat: int = 1
+    ) -> Optional[HookedTransformerKeyValueCacheEntry]:
+        if position == 0:
+            return None
+        # frozen: the clean prefix is shared by all the runs of the batch and must not grow
+        return HookedTransformerKeyValueCacheEntry(
+            past_keys=self.keys[layer][:, :position].repeat(repeat, 1, 1, 1),
+            past_values=self.values[layer][:, :position].repeat(repeat, 1, 1, 1),
+            frozen=True,
+        )
+
+    def run(
+        self,
+        layer: int,
+        position: int,
+        fwd_hooks: Optional[List[Tuple]] = None,
+        targets: Optional[torch.Tensor] = None,
+        normalize: Literal["none", "softmax", "log_softmax"] = "none",
+        repeat: int = 1,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Resume the forward pass from blocks.{layer} for the positions [position:] with the given hooks.
+        With repeat=K the batch is stacked K times along the batch dimension (rows k*batch_size:(k+1)*batch_size are the
+        k-th copy), so that K interventions masked by row are evaluated in a single forward.
+        Return the last-position logits and logsumexp as BaseModel.readout.
+        """
+        if len(self.resid_pre) == 0:
+            raise ValueError("prepare must be called before run")
+        if position < 0 or position >= self.length:
+            raise ValueError(f"position must be in [0, {self.length}), got {position}")
+        hooked_model = self.model.model
+        resid = self.resid_pre[layer][:, position:].repeat(repeat, 1, 1)
+        if targets is not None:
+            targets = targets.repeat(repeat, 1)
+        with hooked_model.hooks(fwd_hooks=fwd_hooks or []):
+            for block_index in range(layer, self.model.cfg.n_layers):
+                resid = hooked_model.blocks[block_index](
+                    resid,
+                    past_kv_cache_entry=self._cache_entry(block_index, position, repeat),
+                )
+            resid = hooked_model.ln_final(resid[:, -1:, :])[:, 0, :]
+        return unembed_last_position(
+            resid, hooked_model.W_U, hooked_model.b_U, targets=targets, normalize=normalize
+        )
+
+    def clear(self):
+        self.resid_pre, self.keys, self.values = [], [], []
+        self.length = 0
@@ -0,0 +1,144 @@
+import torch
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# a position: None for all the positions, an int (negative from the end), or the name of a batch column with one
+# position per example (e.g. "obj_pos", negative values also from the end)
+Position = Union[None, int, str]
+# heads: None for all the heads, a tuple of heads, or the name of a batch column with one head per example
+Heads = Union[None, Tuple[int, ...], str]
+
+
+@dataclass(frozen=True)
+class Edit:
+    """
+    Declarative edit of the activation of a hook point: entries <- scale * entries, or entries <- value if value is set.
+    - hook_name: full name of the hook point, e.g. "blocks.3.attn.hook_pattern"
+    - heads: heads to edit for [batch, head, query, key] activations (attention scores/pattern), None for all the heads,
+        or a batch column with one head per example. Must be None for [batch, pos, d_model] activations
+    - query: query position of [batch, head, query, key] activations, position of [batch, pos, d_model] activations
+    - key: key position of [batch, head, query, key] activations
+    """
+
+    hook_name: str
+    heads: Heads = None
+    query: Position = None
+    key: Position = None
+    scale: float = 0.0
+    value: Optional[float] = None
+
+
+def _column(name: str, columns: Dict[str, torch.Tensor], n_rows: int, device) -> torch.Tensor:
+    """
+    (n_rows,) values of a batch column
+    """
+    per_example = columns[name].to(device)
+    # sweeps stack several copies of the batch along the batch dimension
+    return per_example.repeat(n_rows // per_example.shape[0])
+
+
+def _position_mask(
+    position: Position, size: int, columns: Dict[str, torch.Tensor], n_rows: int, device
+) -> Optional[torch.Tensor]:
+    """
+    (n_rows or 1, size) boolean mask of the selected positions, None if all the positions are selected
+    """
+    if position is None:
+        return None
+    if isinstance(position, str):
+        per_example = _column(position, columns, n_rows, device)
+        per_example = torch.where(per_example < 0, per_example + size, per_example)
+        return torch.arange(size, device=device)[None, :] == per_example[:, None]
+    position = position + size if position < 0 else position
+    return (torch.arange(size, device=device) == position)[None, :]
+
+
+class FusedHook:
+    """
+    All the edits of a hook point applied by a single hook with broadcast masks (no loop over the batch).
+    Per-example positions are read from the columns of the batch bound with bind().
+    """
+
+    def __init__(self, hook_name: str, edits: List[Edit]):
+        self.hook_name = hook_name
+        self.edits = edits
+        self.columns: Dict[str, torch.Tensor] = {}
+
+    def bind(self, batch: Optional[Dict] = None) -> "FusedHook":
+        self.columns = {} if batch is None else batch
+        return self
+
+    def _mask(self, edit: Edit, activation: torch.Tensor) -> torch.Tensor:
+        n_rows, device = activation.shape[0], activation.device
+        mask = torch.ones((1,) * activation.ndim, dtype=torch.bool, device=device)
+        if activation.ndim == 4:
+            # [batch, head, query, key]
+            if isinstance(edit.heads, str):
+                per_example = _column(edit.heads, self.columns, n_rows, device)
+                heads = torch.arange(activation.shape[1], device=device)[None, :] == per_example[:, None]
+                mask = mask & heads[:, :, None, None]
+            elif edit.heads is not None:
+                heads = torch.zeros(activation.shape[1], dtype=torch.bool, device=device)
+                heads[list(edit.heads)] = True
+                mask = mask & heads[None, :, None, None]
+            query = _position_mask(edit.query, activation.shape[2], self.columns, n_rows, device)
+            if query is not None:
+                mask = mask & query[:, None, :, None]
+            key = _position_mask(edit.key, activation.shape[3], self.columns, n_rows, device)
+            if key is not None:
+                mask = mask & key[:, None, None, :]
+        elif activation.ndim == 3:
+            # [batch, pos, d_model]
+            if edit.heads is not None or edit.key is not None:
+                raise ValueError(f"{self.hook_name}: heads and key are only supported for attention activations")
+            position = _position_mask(edit.query, activation.shape[1], self.columns, n_rows, device)
+            if position is not None:
+                mask = mask & position[:, :, None]
+        else:
+            raise ValueError(f"{self.hook_name}: unsupported activation of shape {tuple(activation.shape)}")
+        return mask
+
+    def __call__(self, activation: torch.Tensor, hook) -> torch.Tensor:
+        for edit in self.edits:
+            mask = self._mask(edit, activation)
+            if edit.value is not None:
+                activation.masked_fill_(mask, edit.value)
+            else:
+                # scale only the masked entries, -inf scores (padding, causal mask) are left alone: -inf * 0 is nan
+                mask = mask & (activation != float("-inf"))
+                activation = torch.where(mask, activation * edit.scale, activation)
+        return activation
+
+
+def compile_edits(edits: Sequence[Edit]) -> List[FusedHook]:
+    """
+    One FusedHook per hook point. Edits that differ only by their heads are merged into a single edit (per-example
+    heads read from a column are kept as they are).
+    """
+    by_hook: Dict[str, Dict[Tuple, List[Edit]]] = defaultdict(lambda: defaultdict(list))
+    for edit in edits:
+        column_heads = edit.heads if isinstance(edit.heads, str) else None
+        by_hook[edit.hook_name][(edit.query, edit.key, edit.scale, edit.value, column_heads)].append(edit)
+    fused = []
+    for hook_name, groups in by_hook.items():
+        merged = []
+        for group in groups.values():
+            if isinstance(group[0].heads, str):
+                merged.append(group[0])
+            elif any(edit.heads is None for edit in group):
+                merged.append(replace(group[0], heads=None))
+            else:
+                heads = sorted({head for edit in group for head in edit.heads})  # type: ignore
+                merged.append(replace(group[0], heads=tuple(heads)))
+        fused.append(FusedHook(hook_name, merged))
+    return fused
+
+
+def bind_hooks(
+    fused_hooks: Sequence[FusedHook], batch: Optional[Dict] = None
+) -> List[Tuple[str, Callable]]:
+    """
+    (hook_name, hook) list for run_with_hooks, with the per-example positions of the given batch
+    """
+    return [(hook.hook_name, hook.bind(batch)) for hook in fused_hooks]
@@ -1,7 +1,6 @@
 from turtle import up
 from typing import Callable, List, Optional, Union
 import torch
-from torch.utils.data import DataLoader
 import einops
 from tqdm import tqdm
 from Src.dataset import BaseDataset
@@ -9,6 +8,7 @@ from Src.model import BaseModel
 from Src.base_experiment import BaseExperiment
 from typing import Tuple, Literal
 from Src.utils import aggregate_result
+from Src.accumulator import RunningStats
 import pandas as pd
 import ipdb
 
@@ -16,14 +16,19 @@ import ipdb
 class AttributeStorage:
     """
     Class to store the attributes of the logit attribution
+    With streaming=True only the running statistics of each (component, position) are kept (see stats)
     """
 
     def __init__(
-        self, experiment: Literal["copyVSfact", "contextVSfact", "copyVSfact_factual"]
+        self,
+        experiment: Literal["copyVSfact", "contextVSfact", "copyVSfact_factual"],
+        streaming: bool = False,
     ):
         self.mem_attribute = []
         self.cp_attribute = []
         self.diff_attribute = []
+        self.streaming = streaming
+        self.running_stats: Optional[Tuple[RunningStats, RunningStats, RunningStats]] = None
         self.labels:List[str] = []
         self.experiment: Literal[
             "copyVSfact", "contextVSfact", "copyVSfact_factual"
@@ -39,6 +44,7 @@ class AttributeStorage:
         first_subject_positions: torch.Tensor,
         second_subject_positions: torch.Tensor,
         subject_lengths: torch.Tensor,
+        pad_offsets: Optional[torch.Tensor] = None,
     ):
         mem_attribute, cp_attribute, diff_attribute = self.aggregate(
             mem_attribute,
@@ -48,10 +54,19 @@ class AttributeStorage:
             first_subject_positions,
             second_subject_positions,
             subject_lengths,
+            pad_offsets,
         )
-        self.mem_attribute.append(mem_attribute.cpu())
-        self.cp_attribute.append(cp_attribute.cpu())
-        self.diff_attribute.append(diff_attribute.cpu())
+        if self.streaming:
+            if self.running_stats is None:
+                shape = (mem_attribute.shape[0], mem_attribute.shape[-1])
+                self.running_stats = (RunningStats(shape), RunningStats(shape), RunningStats(shape))
+            for stats, attribute in zip(self.running_stats, [mem_attribute, cp_attribute, diff_attribute]):
+                # (component, batch, position) -> (component, position, batch)
+                stats.update(attribute.transpose(1, 2))
+        else:
+            self.mem_attribute.append(mem_attribute.cpu())
+            self.cp_attribute.append(cp_attribute.cpu())
+            self.diff_attribute.append(diff_attribute.cpu())
         if len(self.labels) == 0:
             self.labels = labels
 
@@ -64,6 +79,7 @@ class AttributeStorage:
         first_subject_positions,
         second_subject_positions,
         subject_lengths,
+        pad_offsets=None,
     ):
         length = mem_attribute.shape[-1]
         aggregated_mem = aggregate_result(
@@ -73,7 +89,8 @@ class AttributeStorage:
             first_subject_positions=first_subject_positions,
             second_subject_positions=second_subject_positions,
             subject_lengths=subject_lengths,
-            length=length,   
+            length=length,
+            pad_offsets=pad_offsets,
         )
         aggregated_cp = aggregate_result(
             experiment=self.experiment,
@@ -83,6 +100,7 @@ class AttributeStorage:
             second_subject_positions=second_subject_positions,
             subject_lengths=subject_lengths,
             length=length,
+            pad_offsets=pad_offsets,
         )
         aggregated_diff = aggregate_result(
             experiment=self.experiment,
@@ -92,6 +110,7 @@ class AttributeStorage:
             second_subject_positions=second_subject_positions,
             subject_lengths=subject_lengths,
             length=length,
+            pad_offsets=pad_offsets,
         )
         return aggregated_mem, aggregated_cp, aggregated_diff
 
@@ -100,21 +119,46 @@ class AttributeStorage:
         from a list of tensors of shape (batch, component, position) to a tensor of shape (component, batch, position)
         Concatenate the tensors along the batch dimension
         """
+        if self.streaming:
+            raise ValueError("The per-example attributes are not kept in streaming mode: use stats")
         stacked_mem = torch.cat(self.mem_attribute, dim=1)
         stacked_cp = torch.cat(self.cp_attribute, dim=1)
         stacked_diff = torch.cat(self.diff_attribute, dim=1)
         return stacked_mem, stacked_cp, stacked_diff
 
+    def stats(self) -> Tuple[RunningStats, RunningStats, RunningStats]:
+        """
+        Running statistics of mem, cp and diff of shape (component, position)
+        """
+        if self.running_stats is not None:
+            return self.running_stats
+        if self.streaming:
+            raise ValueError("No attributes stored")
+        return tuple(  # type: ignore
+            RunningStats.from_values(attribute.transpose(1, 2)) for attribute in self.stack()
+        )
+
 
 class LogitAttribution(BaseExperiment):
+    # what decompose_resid and get_full_resid_decomposition read (heads from hook_z), plus the final layer norm scale
+    cached_activations = [
+        "hook_embed",
+        "hook_pos_embed",
+        "attn.hook_z",
+        "hook_attn_out",
+        "hook_mlp_out",
+        "ln_final.hook_scale",
+    ]
+
     def __init__(
         self,
         dataset: BaseDataset,
         model: BaseModel,
         batch_size: int,
         experiment: Literal["copyVSfact", "contextVSfact"],
+        token_budget: Optional[int] = None,
     ):
-        super().__init__(dataset, model, batch_size, experiment)
+        super().__init__(dataset, model, batch_size, experiment, token_budget=token_budget)
 
     def slice_target(
         self, target: torch.Tensor, length: int
@@ -136,7 +180,7 @@ class LogitAttribution(BaseExperiment):
 
     def attribute_single_len(
         self,
-        length: int,
+        length: Optional[int],
         storage: AttributeStorage,
         component: str,
         up_to_layer: Union[int, str] = "all",
@@ -154,7 +198,7 @@ class LogitAttribution(BaseExperiment):
             )
 
         self.set_len(length, slice_to_fit_batch=False)
-        dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False)
+        dataloader = self.get_dataloader(shuffle=False)
 
         # Create a storage object to store the logits
         for batch in dataloader:
@@ -164,9 +208,7 @@ class LogitAttribution(BaseExperiment):
             #         batch["prompt"], hooks=hooks, return_cache=True
             #     )
             # else:
-            logits, cache = self.model.run_with_cache(
-                batch["prompt"], prepend_bos=False
-            )
+            logits, cache = self.run_with_cache(batch)
 
             if normalize_logit != "none":
                 raise NotImplementedError
@@ -179,7 +221,9 @@ class LogitAttribution(BaseExperiment):
                 return_labels=True,
                 layer=up_to_layer,
             )  # return a tensor of shape (component_size, batch_size, seq_len, hidden_size)
-            target_mem, target_cp = self.slice_target(batch["target"], length=length)
+            target_mem, target_cp = self.slice_target(
+                batch["target"], length=batch["input_ids"].shape[1]
+            )
 
             labels = labels + resid_labels
             stack_of_component = torch.cat([stack_of_component, stack_of_resid], dim=0)
@@ -200,36 +244,44 @@ class LogitAttribution(BaseExperiment):
                 batch["1_subj_pos"].cpu(),
                 batch["2_subj_pos"].cpu(),
                 batch["subj_len"].cpu(),
+                batch["pad_offset"].cpu() if "pad_offset" in batch else None,
             )
             
         # clear the cuda cache
         torch.cuda.empty_cache()
 
-    def attribute(self, apply_ln: bool = False, **kwargs) -> Tuple[Tuple[torch.Tensor, torch.Tensor, torch.Tensor], List[str]]:
+    def attribute(self, apply_ln: bool = False, streaming: bool = False, **kwargs) -> Tuple[Tuple, List[str]]:
         """
         run the logit attribution for all the lengths in the dataset and return a tuple of (mem, cp, diff) of shape (component, batch, position)
+        With streaming=True, return their RunningStats of shape (component, position) instead
         """
-        storage = AttributeStorage(self.experiment)
-        lengths = self.dataset.get_lengths()
-        for length in tqdm(lengths, desc="Attributing"):
+        storage = AttributeStorage(self.experiment, streaming=streaming)
+        for length in tqdm(self.get_length_groups(), desc="Attributing"):
             self.attribute_single_len(
                 length, storage, "logit", apply_ln=apply_ln, **kwargs
             )
 
+        if streaming:
+            return storage.stats(), storage.labels
         return storage.stack(), storage.labels
 
     def run(
         self,
         apply_ln: bool = False,
         normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+        streaming: bool = False,
         **kwargs,
     ):
         """
         Run the logit attribution and return a dataframe
+        streaming: keep only the running mean and std of each (component, position), not the per-example attributes
         """
         (mem, cp, diff), labels = self.attribute(
-            apply_ln=apply_ln, normalize_logit=normalize_logit, **kwargs
+            apply_ln=apply_ln, normalize_logit=normalize_logit, streaming=streaming, **kwargs
         )
+        if not streaming:
+            mem, cp, diff = (RunningStats.from_values(values.transpose(1, 2)) for values in (mem, cp, diff))
+        mem_std, cp_std, diff_std = mem.std(), cp.std(), diff.std()
 
         data = []
         for i, label in enumerate(labels):  # type: ignore
@@ -238,113 +290,37 @@ class LogitAttribution(BaseExperiment):
                     {
                         "label": label,
                         "position": position,
-                        "mem_mean": mem[i, :, position].mean().item(),
-                        "cp_mean": cp[i, :, position].mean().item(),
-                        "diff_mean": diff[i, :, position].mean().item(),
-                        "mem_std": mem[i, :, position].std().item(),
-                        "cp_std": cp[i, :, position].std().item(),
-                        "diff_std": diff[i, :, position].std().item(),
+                        "mem_mean": mem.mean[i, position].item(),
+                        "cp_mean": cp.mean[i, position].item(),
+                        "diff_mean": diff.mean[i, position].item(),
+                        "mem_std": mem_std[i, position].item(),
+                        "cp_std": cp_std[i, position].item(),
+                        "diff_std": diff_std[i, position].item(),
                     }
                 )
-        # index of head
-        head_indexes = [i for i, label in enumerate(labels) if "H" in label]
-        # sum all the head at position 12
-        mem_all = mem[head_indexes, :, 12].mean()
-        cp_all = cp[head_indexes, :, 12].mean()
-        mem_all_std = mem[head_indexes, :, 12].std()
-        cp_all_std = cp[head_indexes, :, 12].std()
-        data.append(
-            {
-                "label": "all_heads",
-                "position": 12,
-                "mem_mean": mem_all.item(),
-                "cp_mean": cp_all.item(),
-                "diff_mean": 0,
-                "mem_std": mem_all_std.item(),
-                "cp_std": cp_all_std.item(),
-                "diff_std": 0,
-            }
-        )
-        # doing the same but just for layer 10 and 11
-        head_indexes = [
-            i for i, label in enumerate(labels) if ("H" in label and "L10" in label)
-        ]
-        mem_all = mem[head_indexes, :, 12].mean()
-        cp_all = cp[head_indexes, :, 12].mean()
-        mem_all_std = mem[head_indexes, :, 12].std()
-        cp_all_std = cp[head_indexes, :, 12].std()
-        data.append(
-            {
-                "label": "all_heads_L10",
-                "position": 12,
-                "mem_mean": mem_all.item(),
-                "cp_mean": cp_all.item(),
-                "diff_mean": 0,
-                "mem_std": mem_all_std.item(),
-                "cp_std": cp_all_std.item(),
-                "diff_std": 0,
-            }
-        )
-        # doing the same but just for layer 11
-        head_indexes = [
-            i for i, label in enumerate(labels) if ("H" in label and "L11" in label)
-        ]
-        mem_all = mem[head_indexes, :, 12].mean()
-        cp_all = cp[head_indexes, :, 12].mean()
-        mem_all_std = mem[head_indexes, :, 12].std()
-        cp_all_std = cp[head_indexes, :, 12].std()
-        data.append(
-            {
-                "label": "all_heads_L11",
-                "position": 12,
-                "mem_mean": mem_all.item(),
-                "cp_mean": cp_all.item(),
-                "diff_mean": 0,
-                "mem_std": mem_all_std.item(),
-                "cp_std": cp_all_std.item(),
-                "diff_std": 0,
-            }
-        )
-
-        # doint the same for layer 7
-        head_indexes = [
-            i for i, label in enumerate(labels) if ("H" in label and "L7" in label)
-        ]
-        mem_all = mem[head_indexes, :, 12].mean()
-        cp_all = cp[head_indexes, :, 12].mean()
-        mem_all_std = mem[head_indexes, :, 12].std()
-        cp_all_std = cp[head_indexes, :, 12].std()
-        data.append(
-            {
-                "label": "all_heads_L7",
-                "position": 12,
-                "mem_mean": mem_all.item(),
-                "cp_mean": cp_all.item(),
-                "diff_mean": 0,
-                "mem_std": mem_all_std.item(),
-                "cp_std": cp_all_std.item(),
-                "diff_std": 0,
-            }
-        )
-        # doint the same for layer 9
-        head_indexes = [
-            i for i, label in enumerate(labels) if ("H" in label and "L9" in label)
-        ]
-        mem_all = mem[head_indexes, :, 12].mean()
-        cp_all = cp[head_indexes, :, 12].mean()
-        mem_all_std = mem[head_indexes, :, 12].std()
-        cp_all_std = cp[head_indexes, :, 12].std()
-        data.append(
-            {
-                "label": "all_heads_L9",
-                "position": 12,
-                "mem_mean": mem_all.item(),
-                "cp_mean": cp_all.item(),
-                "diff_mean": 0,
-                "mem_std": mem_all_std.item(),
-                "cp_std": cp_all_std.item(),
-                "diff_std": 0,
-            }
-        )
+        # all the heads (or the heads of a layer) pooled together at position 12
+        for group, layer_name in [
+            ("all_heads", ""),
+            ("all_heads_L10", "L10"),
+            ("all_heads_L11", "L11"),
+            ("all_heads_L7", "L7"),
+            ("all_heads_L9", "L9"),
+        ]:
+            head_indexes = [
+                i for i, label in enumerate(labels) if ("H" in label and layer_name in label)
+            ]
+            mem_all, cp_all = mem.pool(0, head_indexes), cp.pool(0, head_indexes)
+            data.append(
+                {
+                    "label": group,
+                    "position": 12,
+                    "mem_mean": mem_all.mean[12].item(),
+                    "cp_mean": cp_all.mean[12].item(),
+                    "diff_mean": 0,
+                    "mem_std": mem_all.std()[12].item(),
+                    "cp_std": cp_all.std()[12].item(),
+                    "diff_std": 0,
+                }
+            )
 
         return pd.DataFrame(data)
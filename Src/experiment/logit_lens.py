@@ -2,41 +2,50 @@ import re
 from numpy import dtype
 from sympy import sec
 import torch
-from torch.utils.data import DataLoader
 import einops
 from tqdm import tqdm
 from Src.dataset import BaseDataset
 from Src.model import BaseModel
 from Src.base_experiment import BaseExperiment, to_logit_token
-from typing import Optional, Tuple, Literal, Union
+from typing import Dict, List, Optional, Tuple, Literal, Union
 from Src.utils import aggregate_result
+from Src.accumulator import RunningStats
 # import ipdb
 
 class LogitStorage:
     """
     store logits and return shape (layers, position, examples) or (layers, position, heads, examples)
+    Each metric is a dense (layers, position, heads, examples) tensor allocated at the first store of the metric (with
+    n_examples columns if known, grown by doubling otherwise); each store writes a batch with a single slice assignment.
     """
 
+    # metrics of the logit tuple given to store, in order
+    logit_metrics = ("mem_logit", "cp_logit")
+
     def __init__(
         self,
         n_layers: int,
         length: int,
         experiment: Literal["copyVSfact", "contextVSfact"],
         n_heads: int = 1,
+        n_examples: Optional[int] = None,
     ):
         self.n_layers = n_layers
         self.length = length
         self.n_heads = n_heads
         self.size = n_layers * length * n_heads
+        self.n_examples = n_examples
         self.experiment: Literal["copyVSfact", "contextVSfact"] = experiment
 
-        # Using a dictionary to store logit values
-        self.logits = {
-            "mem_logit": [[] for _ in range(self.size)],
-            "cp_logit": [[] for _ in range(self.size)],
-            "mem_winners": [[] for _ in range(self.size)],
-            "cp_winners": [[] for _ in range(self.size)],
+        # metric -> (layers, position, heads, capacity) tensor, None until stored
+        self.logits: Dict[str, Optional[torch.Tensor]] = {
+            "mem_logit": None,
+            "cp_logit": None,
+            "mem_winners": None,
+            "cp_winners": None,
         }
+        # number of examples written in each (layer, position, head)
+        self.n_stored = [0] * self.size
 
     def _get_index(self, layer: int, position: int, head: int = 0):
         return (layer * self.length + position) * self.n_heads + head
@@ -72,6 +81,27 @@ class LogitStorage:
         )
         return self._reshape_tensor_back(intermediate_aggregate)
 
+    def _reserve(self, key: str, n_examples: int) -> torch.Tensor:
+        """
+        Tensor of the metric with room for at least n_examples examples
+        """
+        tensor = self.logits[key]
+        shape = (self.n_layers, self.length, self.n_heads)
+        if tensor is None:
+            capacity = max(self.n_examples or 0, n_examples)
+            tensor = torch.zeros((*shape, capacity), dtype=torch.float32)
+        elif tensor.shape[-1] < n_examples:
+            grown = torch.zeros((*shape, max(n_examples, 2 * tensor.shape[-1])), dtype=torch.float32)
+            grown[..., : tensor.shape[-1]] = tensor
+            tensor = grown
+        self.logits[key] = tensor
+        return tensor
+
+    def _metrics(self, logit, mem_winners, cp_winners) -> Dict[str, torch.Tensor]:
+        values = dict(zip(self.logit_metrics, logit))
+        values.update(mem_winners=mem_winners, cp_winners=cp_winners)
+        return {key: value for key, value in values.items() if value is not None}
+
     def store(
         self,
         layer: int,
@@ -83,33 +113,55 @@ class LogitStorage:
         mem_winners: Optional[torch.Tensor] = None,
         cp_winners: Optional[torch.Tensor] = None,
     ):
-        mem_logit, cp_logit, _, _ = logit
-        mem_logit, cp_logit = mem_logit.to("cpu"), cp_logit.to("cpu")
         index = self._get_index(layer, position, head)
-        self.logits["mem_logit"][index].append(mem_logit)
-        self.logits["cp_logit"][index].append(cp_logit)
-        if mem_winners is not None:
-            self.logits["mem_winners"][index].append(mem_winners.cpu())
-        if cp_winners is not None:
-            self.logits["cp_winners"][index].append(cp_winners.cpu())
-
-    def _reshape_logits(self, logits_list, shape):
-        return (
-            torch.stack([torch.cat(logits, dim=0) for logits in logits_list])
-            .view(shape)
-            .to(torch.float32)
-        )
+        start = self.n_stored[index]
+        for key, value in self._metrics(logit, mem_winners, cp_winners).items():
+            end = start + value.shape[0]
+            self._reserve(key, end)[layer, position, head, start:end] = value.to("cpu", torch.float32)
+        self.n_stored[index] = end
+
+    def store_stack(
+        self,
+        logit: Tuple[
+            torch.Tensor, torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]
+        ],
+        mem_winners: Optional[torch.Tensor] = None,
+        cp_winners: Optional[torch.Tensor] = None,
+    ):
+        """
+        Store a batch for all the (layer, position, head) at once: tensors of shape (layers, position, heads, batch)
+        """
+        start = self.n_stored[0]
+        if any(n_stored != start for n_stored in self.n_stored):
+            raise ValueError("store_stack requires the same number of examples stored in every (layer, position, head)")
+        for key, value in self._metrics(logit, mem_winners, cp_winners).items():
+            end = start + value.shape[-1]
+            self._reserve(key, end)[..., start:end] = value.to("cpu", torch.float32)
+        self.n_stored = [end] * self.size
+
+    def get_state(self) -> Dict[str, torch.Tensor]:
+        """
+        The stored metrics, (layers, position, heads, examples) each, e.g. to be saved in a checkpoint
+        """
+        n_examples = max(self.n_stored)
+        return {
+            key: tensor[..., :n_examples]
+            for key, tensor in self.logits.items()
+            if tensor is not None
+        }
+
+    def merge(self, state: Dict[str, torch.Tensor]):
+        """
+        Append the metrics returned by get_state of another storage with the same layout (e.g. a checkpointed batch)
+        """
+        mem_winners, cp_winners = state.get("mem_winners"), state.get("cp_winners")
+        logit = tuple(state.get(key) for key in self.logit_metrics)
+        self.store_stack(logit, mem_winners=mem_winners, cp_winners=cp_winners)  # type: ignore
 
     def get_logit(self):
-        shape = (self.n_layers, self.length, -1)
-        if self.logits["mem_winners"][0] == []:
-            return tuple(
-                self._reshape_logits(self.logits[key], shape)
-                for key in self.logits
-                if key != "mem_winners" and key != "cp_winners"
-            )
+        # views of the stored metrics (the winners only if stored), no copy
         return tuple(
-            self._reshape_logits(self.logits[key], shape) for key in self.logits
+            tensor.flatten(1, 2) for tensor in self.get_state().values()
         )
 
     def get_aggregate_logit(self, 
@@ -135,51 +187,24 @@ class LogitStorage:
 
 
 class IndexLogitStorage(LogitStorage):
+    logit_metrics = ("mem_logit", "cp_logit", "mem_logit_idx", "cp_logit_idx")
+
     def __init__(
         self,
         n_layers: int,
         length: int,
         experiment: Literal["copyVSfact", "contextVSfact"],
         n_heads: int = 1,
+        n_examples: Optional[int] = None,
     ):
-        super().__init__(n_layers, length, experiment, n_heads)
+        super().__init__(n_layers, length, experiment, n_heads, n_examples)
         self.logits.update(
             {
-                "mem_logit_idx": [[] for _ in range(self.size)],
-                "cp_logit_idx": [[] for _ in range(self.size)],
+                "mem_logit_idx": None,
+                "cp_logit_idx": None,
             }
         )
 
-    def store(
-        self,
-        layer: int,
-        position: int,
-        logit: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
-        head: int = 0,
-        mem_winners: Optional[torch.Tensor] = None,
-        cp_winners: Optional[torch.Tensor] = None,
-    ):
-        mem_logit, cp_logit, mem_logit_idx, cp_logit_idx = logit
-        if mem_logit_idx is not None:
-            mem_logit_idx = mem_logit_idx.to("cpu")
-        if cp_logit_idx is not None:
-            cp_logit_idx = cp_logit_idx.to("cpu")
-        mem_logit, cp_logit = mem_logit.to("cpu"), cp_logit.to("cpu")
-        index = self._get_index(layer, position, head)
-        self.logits["mem_logit"][index].append(mem_logit)
-        self.logits["cp_logit"][index].append(cp_logit)
-        # Handle None values for mem_logit_idx and cp_logit_idx
-        self.logits["mem_logit_idx"][index].append(
-            mem_logit_idx if mem_logit_idx is not None else torch.tensor([])
-        )
-        self.logits["cp_logit_idx"][index].append(
-            cp_logit_idx if cp_logit_idx is not None else torch.tensor([])
-        )
-        if mem_winners is not None:
-            self.logits["mem_winners"][index].append(mem_winners)
-        if cp_winners is not None:
-            self.logits["cp_winners"][index].append(cp_winners)
-
 
 class HeadLogitStorage(IndexLogitStorage, LogitStorage):
     def __init__(
@@ -188,8 +213,9 @@ class HeadLogitStorage(IndexLogitStorage, LogitStorage):
         length: int,
         experiment: Literal["copyVSfact", "contextVSfact"],
         n_heads: int,
+        n_examples: Optional[int] = None,
     ):
-        super().__init__(n_layers, length, experiment, n_heads)
+        super().__init__(n_layers, length, experiment, n_heads, n_examples)
 
     @classmethod
     def from_logit_storage(cls, logit_storage: LogitStorage, n_heads: int):
@@ -198,6 +224,7 @@ class HeadLogitStorage(IndexLogitStorage, LogitStorage):
             logit_storage.length,
             logit_storage.experiment,
             n_heads,
+            logit_storage.n_examples,
         )
 
     @classmethod
@@ -209,23 +236,23 @@ class HeadLogitStorage(IndexLogitStorage, LogitStorage):
             index_logit_storage.length,
             index_logit_storage.experiment,
             n_heads,
+            index_logit_storage.n_examples,
         )
 
     def _reshape_tensor(self, tensor: torch.Tensor):
+        # aggregate_result expects the examples on the second dimension and the positions on the last one
         return einops.rearrange(
-            tensor, "layer position head examples -> examples layer head position"
+            tensor, "layer position head examples -> layer examples head position"
         )
 
     def _reshape_tensor_back(self, tensor: torch.Tensor):
         return einops.rearrange(
-            tensor, "examples layer head position -> layer head position examples"
+            tensor, "layer examples head position -> layer head position examples"
         )
 
     def get_logit(self):
-        shape = (self.n_layers, self.length, self.n_heads, -1)
-        return tuple(
-            self._reshape_logits(self.logits[key], shape) for key in self.logits
-        )
+        # (layers, position, heads, examples) views of the stored metrics
+        return tuple(self.get_state().values())
 
 
 class LogitLens(BaseExperiment):
@@ -235,8 +262,14 @@ class LogitLens(BaseExperiment):
         model: BaseModel,
         batch_size: int,
         experiment: Literal["copyVSfact", "contextVSfact"],
+        vocab_chunk_size: Optional[int] = None,
     ):
+        """
+        vocab_chunk_size: when the full vocabulary is needed (normalization or ranks), reduce it this many columns at a
+            time (see to_logit_token)
+        """
         super().__init__(dataset, model, batch_size, experiment)
+        self.vocab_chunk_size = vocab_chunk_size
         self.valid_blocks = [
             "mlp_out",
             "resid_pre",
@@ -247,24 +280,124 @@ class LogitLens(BaseExperiment):
         self.valid_heads = ["head"]
         self.mean_logit_per_layer = None
 
-    def project_per_position(self, component, layer, cache, length: int):
-        # assert that the activation name is a f-string with a single placeholder for the layer
-        # assert (
-        #     component_cached.shape[1] == length
-        # ), f"component_cached.shape[1] = {component_cached.shape[1]}, self.model.cfg.n_heads = {self.model.cfg.n_heads}"
-        # assert (
-        #     component_cached.shape[2] == self.model.cfg.d_model
-        # ), f"component_cached.shape[2] = {component_cached.shape[2]}, self.model.cfg.d_model = {self.model.cfg.d_model}"
-
-        cached_component = cache.apply_ln_to_stack(cache[component,layer], layer=-1)
-        for position in range(length):
-            # component_cached = self.model.ln_final(component_cached)
-            # TODO apply the linear norm differently
-            #cached_component = normalized_component[component, layer]
+    def get_cached_activations(self, component: str):
+        """
+        Activations read to project the component, plus the final layer norm scale used by apply_ln_final
+        """
+        if component in self.valid_heads:
+            return ["attn.hook_z", "ln_final.hook_scale"]
+        return [f"hook_{component}", "ln_final.hook_scale"]
+
+    def apply_ln_final(self, cache, stack: torch.Tensor) -> torch.Tensor:
+        """
+        Final layer norm of a (component, batch, pos, d_model) stack: centering for LN/LNPre, division by the scale of
+        ln_final for LN/LNPre/RMS/RMSPre (apply_ln_to_stack of TransformerLens 1.14 leaves RMS norms out)
+        """
+        normalization_type = self.model.model.cfg.normalization_type
+        if normalization_type in ["LN", "LNPre"]:
+            stack = stack - stack.mean(dim=-1, keepdim=True)
+        if normalization_type in ["LN", "LNPre", "RMS", "RMSPre"]:
+            stack = stack / cache["ln_final.hook_scale"]
+        return stack
+
+    def project_stack(
+        self,
+        stack: torch.Tensor,
+        target: torch.Tensor,
+        return_index: bool = False,
+        normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        Lens of a (component, batch, pos, d_model) stack already scaled by the final layer norm.
+        Return the mem and cp logits (and ranks if return_index) of shape (component, pos, batch), on the cpu.
+        Without normalization and ranks only the two target columns of the unembedding are computed, in a single
+        contraction; otherwise the full vocabulary is reduced one component at a time by to_logit_token.
+        """
+        n_components, batch_size, length, _ = stack.shape
+        target = target[:, :2].to(stack.device)
+        if normalize_logit == "none" and not return_index:
+            # (d_model, batch, 2): the unembedding directions of the targets of each example
+            target_directions = self.model.unembed()[:, target]
             logit = einops.einsum(
-                self.model.unembed(), cached_component[:, position, :], "d d_v, b d -> b d_v"
+                stack, target_directions, "c b p d, d b t -> t c p b"
+            ).cpu()
+            return logit[0], logit[1], None, None
+
+        # (component, pos, batch, d_model) -> one row per (pos, batch) for each component
+        rows = einops.rearrange(stack, "c b p d -> c (p b) d")
+        row_target = target.repeat(length, 1)
+        per_component = [
+            to_logit_token(
+                einops.einsum(rows[component], self.model.unembed(), "r d, d v -> r v"),
+                row_target,
+                normalize=normalize_logit,
+                return_index=return_index,
+                vocab_chunk_size=self.vocab_chunk_size,
+            )
+            for component in range(n_components)
+        ]
+        result = []
+        for idx in range(4):
+            if per_component[0][idx] is None:
+                result.append(None)
+                continue
+            values = torch.stack([logit_token[idx] for logit_token in per_component])
+            result.append(values.view(n_components, length, batch_size))
+        return tuple(result)  # type: ignore
+
+    def project_heads(
+        self,
+        cache,
+        target: torch.Tensor,
+        return_index: bool = False,
+        normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        Lens of the output of each head. Return tensors of shape (layer, pos, head, batch), on the cpu.
+        Without normalization and ranks, the W_O[layer, head] @ W_U[:, targets] directions of the batch are contracted with
+        hook_z of all the layers, heads and positions in a single einsum (the final layer norm centering is applied to the
+        directions, its scale to the result, see apply_ln_final). Otherwise the output of the heads of each layer is
+        projected by project_stack.
+        """
+        hooked_model = self.model.model
+        z = cache.stack_activation("z")  # layer batch pos head d_head
+        if normalize_logit == "none" and not return_index:
+            target = target[:, :2].to(z.device)
+            target_directions = self.model.unembed()[:, target]  # d_model batch 2
+            if hooked_model.cfg.normalization_type in ["LN", "LNPre"]:
+                # centering the head output over d_model is centering the directions
+                target_directions = target_directions - target_directions.mean(dim=0, keepdim=True)
+            head_directions = einops.einsum(
+                hooked_model.W_O, target_directions, "l h e d, d b t -> l h e b t"
             )
-            yield logit
+            logit = einops.einsum(z, head_directions, "l b p h e, l h e b t -> t l p h b")
+            if hooked_model.cfg.normalization_type in ["LN", "LNPre", "RMS", "RMSPre"]:
+                scale = cache["ln_final.hook_scale"][..., 0]
+                logit = logit / einops.rearrange(scale, "b p -> p 1 b")
+            logit = logit.cpu()
+            return logit[0], logit[1], None, None
+
+        per_layer = []
+        for layer in range(self.model.cfg.n_layers):
+            output = einops.einsum(
+                z[layer], hooked_model.W_O[layer], "b p h e, h e d -> h b p d"
+            )
+            per_layer.append(
+                self.project_stack(
+                    self.apply_ln_final(cache, output),
+                    target,
+                    return_index=return_index,
+                    normalize_logit=normalize_logit,
+                )
+            )
+        result = []
+        for idx in range(4):
+            if per_layer[0][idx] is None:
+                result.append(None)
+                continue
+            values = torch.stack([logit_token[idx] for logit_token in per_layer])
+            result.append(einops.rearrange(values, "l h p b -> l p h b"))
+        return tuple(result)  # type: ignore
 
     def project_length(
         self,
@@ -272,89 +405,88 @@ class LogitLens(BaseExperiment):
         component: str,
         return_index: bool = False,
         normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+        streaming: bool = False,
     ):
+        """
+        Aggregated lens of the examples of the given length, or with streaming=True the RunningStats of mem, cp,
+        mem - cp (and of the ranks if return_index), updated batch by batch
+        """
         # ipdb.set_trace()
         self.set_len(length, slice_to_fit_batch=False)
-        dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False)
+        dataloader = self.get_dataloader(shuffle=False)
         num_batches = len(dataloader)
         if num_batches == 0:
             return None
 
-        if return_index:
-            storer = IndexLogitStorage(self.model.cfg.n_layers, length, self.experiment)
-            if component in self.valid_heads:
-                storer = HeadLogitStorage.from_index_logit_storage(
-                    storer, self.model.cfg.n_heads
+        def get_storer(n_examples: int) -> LogitStorage:
+            if return_index:
+                storer = IndexLogitStorage(
+                    self.model.cfg.n_layers, length, self.experiment, n_examples=n_examples
                 )
-        else:
-            storer = LogitStorage(self.model.cfg.n_layers, length, self.experiment)
-            if component in self.valid_heads:
-                storer = HeadLogitStorage.from_logit_storage(
-                    storer, self.model.cfg.n_heads
+                if component in self.valid_heads:
+                    storer = HeadLogitStorage.from_index_logit_storage(
+                        storer, self.model.cfg.n_heads
+                    )
+            else:
+                storer = LogitStorage(
+                    self.model.cfg.n_layers, length, self.experiment, n_examples=n_examples
                 )
+                if component in self.valid_heads:
+                    storer = HeadLogitStorage.from_logit_storage(
+                        storer, self.model.cfg.n_heads
+                    )
+            return storer
+
+        storer = get_storer(len(self.dataset))
+        stats: Optional[List[RunningStats]] = None
         first_subject_positions = []
         second_subject_positions = []
         object_positions = []
         subject_lengths = []
         for batch in dataloader:
-            _, cache = self.model.run_with_cache(batch["prompt"], prepend_bos=False)
+            _, cache = self.run_with_cache(batch, names=self.get_cached_activations(component))
             first_subject_positions.append(batch["1_subj_pos"])
             second_subject_positions.append(batch["2_subj_pos"])
             subject_lengths.append(batch["subj_len"])
             object_positions.append(batch["obj_pos"])
             
-            for layer in range(self.model.cfg.n_layers):
-                if component in self.valid_blocks:
-
-                    for position, logit in enumerate(
-                        self.project_per_position( component,layer, cache, length)
-                    ):
-                        logit_token = to_logit_token(
-                            logit,
-                            batch["target"],
-                            normalize=normalize_logit,
-                            return_index=return_index,
-                        )
-                        # logit_token = list(logit_token)
-                        # logit_mean = logit.mean(-1).cpu()
-                        # logit_token[0] = (logit_token[0].cpu() - logit.mean(-1).cpu()) / logit.mean(-1).cpu() #! MEAN
-                        # logit_token[1] = (logit_token[1].cpu() - logit.mean(-1).cpu()) / logit.mean(-1).cpu() #! MEAN
-                        storer.store(  #! MEAN
-                            layer=layer,
-                            position=position,
-                            # logit=tuple(logit_token),  # type: ignore
-                            logit=logit_token,  # type: ignore
-                        )
-                        # storer.store(layer=layer, position=position, logit=logit_token)  # type: ignore
-                elif component in self.valid_heads:
-                    cached_component = cache[f"blocks.{layer}.attn.hook_z"]
-                    for head in range(self.model.cfg.n_heads):
-                        output_head = einops.einsum(
-                            cached_component[:, :, head, :],
-                            self.model.blocks[layer].attn.W_O[head, :, :],  # type: ignore
-                            "batch pos d_head, d_head d_model -> batch pos d_model",
-                        )  # type: ignore
-                        for position, logit in enumerate(
-                            self.project_per_position(output_head, length)
-                        ):
-                            logit_token = to_logit_token(
-                                logit,
-                                batch["target"],
-                                normalize=normalize_logit,
-                                return_index=return_index,
-                            )
-                            storer.store(
-                                layer=layer,
-                                position=position,
-                                head=head,
-                                logit=logit_token,  # type: ignore
-                            )
-                else:
-                    raise ValueError(
-                        f"component must be one of {self.valid_blocks + self.valid_heads}"
-                    )
-                    
-                    
+            if component in self.valid_blocks:
+                # all the layers at once: (layer, batch, pos, d_model) with the final layer norm applied in one pass
+                stack = self.apply_ln_final(cache, cache.stack_activation(component))
+                logit_token = self.project_stack(
+                    stack, batch["target"], return_index=return_index, normalize_logit=normalize_logit
+                )
+                # a single "head" for the storage
+                logit_token = tuple(
+                    None if values is None else values.unsqueeze(2) for values in logit_token
+                )
+            elif component in self.valid_heads:
+                logit_token = self.project_heads(
+                    cache, batch["target"], return_index=return_index, normalize_logit=normalize_logit
+                )
+            else:
+                raise ValueError(
+                    f"component must be one of {self.valid_blocks + self.valid_heads}"
+                )
+            if streaming:
+                batch_storer = get_storer(batch["target"].shape[0])
+                batch_storer.store_stack(logit_token)  # type: ignore
+                mem, cp, *index = batch_storer.get_aggregate_logit(
+                    first_subject_positions=batch["1_subj_pos"],
+                    second_subject_positions=batch["2_subj_pos"],
+                    object_position=batch["obj_pos"],
+                    subject_lengths=batch["subj_len"],
+                )
+                if stats is None:
+                    stats = [RunningStats(mem.shape[:-1]) for _ in range(3 + len(index))]
+                for stat, values in zip(stats, [mem, cp, mem - cp, *index]):
+                    stat.update(values)
+                continue
+            storer.store_stack(logit_token)  # type: ignore
+
+        if streaming:
+            return tuple(stats)  # type: ignore
+
         first_subject_positions = torch.cat(first_subject_positions, dim=0)
         second_subject_positions = torch.cat(second_subject_positions, dim=0)
         object_positions = torch.cat(object_positions, dim=0)
@@ -374,7 +506,12 @@ class LogitLens(BaseExperiment):
         component: str,
         return_index: bool = False,
         normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+        streaming: bool = False,
     ):
+        """
+        Aggregated lens of all the lengths, concatenated on the examples, or with streaming=True their RunningStats
+        (mem, cp, mem - cp and the ranks if return_index) merged across lengths
+        """
         lengths = self.dataset.get_lengths()
         # remove 11 from lengths
         if 11 in lengths:
@@ -382,9 +519,21 @@ class LogitLens(BaseExperiment):
         result = {}
         for l in tqdm(lengths, desc="Logit lens:"):
             result[l] = self.project_length(
-                l, component, return_index=return_index, normalize_logit=normalize_logit
+                l, component, return_index=return_index, normalize_logit=normalize_logit, streaming=streaming
             )
 
+        if streaming:
+            merged_stats = None
+            for l in lengths:
+                if result[l] is None:
+                    continue
+                if merged_stats is None:
+                    merged_stats = result[l]
+                    continue
+                for stats, length_stats in zip(merged_stats, result[l]):
+                    stats.merge(length_stats)
+            return merged_stats
+
         # select a random key to get the shape of the result
         tuple_shape = len(result[lengths[0]])
         # result is a dict {lenght: }
@@ -409,81 +558,74 @@ class LogitLens(BaseExperiment):
         component: str,
         return_index: bool = False,
         normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+        streaming: bool = False,
     ):
+        """
+        streaming: keep only the running mean and std of each cell, not the per-example logits
+        """
         result = self.project(
-            component, return_index=return_index, normalize_logit=normalize_logit
+            component, return_index=return_index, normalize_logit=normalize_logit, streaming=streaming
         )
+        if not streaming:
+            mem_logit, cp_logit, *index = result
+            result = tuple(
+                RunningStats.from_values(values) for values in [mem_logit, cp_logit, mem_logit - cp_logit, *index]
+            )
+        mem, cp, diff = result[0], result[1], result[2]
+        mem_std, cp_std = mem.std(), cp.std()
+        # average of each layer over the positions and the examples
+        mem_avg, cp_avg, diff_avg = (stats.pool(dim=-1).mean for stats in (mem, cp, diff))
 
         import pandas as pd
 
         data = []
         for layer in range(self.model.cfg.n_layers):
-            # compute the avarage over the layers
-            mem_avg_layer = result[0][layer].mean()
-            cp_avg_layer = result[1][layer].mean()
-            diff_avg_layer = (result[0][layer] - result[1][layer]).mean()
-            for position in range(result[0][layer].shape[0]):
-                if component in self.valid_heads:
-                    for head in range(self.model.cfg.n_heads):
+            if component in self.valid_heads:
+                for head in range(self.model.cfg.n_heads):
+                    for position in range(mem.shape[-1]):
                         data.append(
                             {
                                 "component": f"H{head}",
                                 "layer": layer,
                                 "position": position,
-                                "mem": result[0][layer][head][position].mean().item(),
-                                "cp": result[1][layer][head][position].mean().item(),
-                                "mem_std": result[0][layer][head][position]
-                                .std()
-                                .item(),
-                                "cp_std": result[1][layer][head][position].std().item(),
+                                "mem": mem.mean[layer, head, position].item(),
+                                "cp": cp.mean[layer, head, position].item(),
+                                "mem_std": mem_std[layer, head, position].item(),
+                                "cp_std": cp_std[layer, head, position].item(),
                                 "mem_idx": None
                                 if not return_index
-                                else result[2][layer][head][position].mean().item(),
+                                else result[3].mean[layer, head, position].item(),
                                 "cp_idx": None
                                 if not return_index
-                                else result[3][layer][head][position].mean().item(),
+                                else result[4].mean[layer, head, position].item(),
                             }
                         )
-                else:
-                    mem_perc = (
-                        100
-                        * (result[0][layer][position].mean().item() - mem_avg_layer)
-                        / mem_avg_layer
-                    )
-                    cp_perc = (
-                        100
-                        * (result[1][layer][position].mean().item() - cp_avg_layer)
-                        / cp_avg_layer
-                    )
-                    diff_perc = (
-                        result[0][layer][position] - result[1][layer][position]
-                    ).mean()
-                    diff_perc = 100 * (diff_perc - diff_avg_layer) / diff_avg_layer
-
-                    data.append(
-                        {
-                            "component": f"{component}",
-                            "layer": layer,
-                            "position": position,
-                            "mem": result[0][layer][position].mean().item(),
-                            "cp": result[1][layer][position].mean().item(),
-                            "diff": (
-                                result[0][layer][position] - result[1][layer][position]
-                            )
-                            .mean()
-                            .item(),
-                            "mem_perc": mem_perc.item(),
-                            "cp_perc": cp_perc.item(),
-                            "diff_perc": diff_perc.item(),
-                            "mem_std": result[0][layer][position].std().item(),
-                            "cp_std": result[1][layer][position].std().item(),
-                            "mem_idx": None
-                            if not return_index
-                            else result[2][layer][position].mean().item(),
-                            "cp_idx": None
-                            if not return_index
-                            else result[3][layer][position].mean().item(),
-                        }
-                    )
+                continue
+            for position in range(mem.shape[-1]):
+                mem_perc = 100 * (mem.mean[layer, position] - mem_avg[layer]) / mem_avg[layer]
+                cp_perc = 100 * (cp.mean[layer, position] - cp_avg[layer]) / cp_avg[layer]
+                diff_perc = 100 * (diff.mean[layer, position] - diff_avg[layer]) / diff_avg[layer]
+
+                data.append(
+                    {
+                        "component": f"{component}",
+                        "layer": layer,
+                        "position": position,
+                        "mem": mem.mean[layer, position].item(),
+                        "cp": cp.mean[layer, position].item(),
+                        "diff": diff.mean[layer, position].item(),
+                        "mem_perc": mem_perc.item(),
+                        "cp_perc": cp_perc.item(),
+                        "diff_perc": diff_perc.item(),
+                        "mem_std": mem_std[layer, position].item(),
+                        "cp_std": cp_std[layer, position].item(),
+                        "mem_idx": None
+                        if not return_index
+                        else result[3].mean[layer, position].item(),
+                        "cp_idx": None
+                        if not return_index
+                        else result[4].mean[layer, position].item(),
+                    }
+                )
 
         return pd.DataFrame(data)
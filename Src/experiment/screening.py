@@ -0,0 +1,152 @@
+import torch
+import pandas as pd
+from typing import Dict, List, Literal, Optional, Tuple
+from Src.dataset import BaseDataset
+from Src.model import WrapHookedTransformer
+from Src.experiment.logit_attribution import LogitAttribution
+from Src.experiment.ablation import Ablate
+
+# index of the object among the aggregated positions (see Src.utils.aggregate_result)
+OBJECT_POSITION = 6
+
+
+class Screening:
+    """
+    Two-stage ablation: the components are ranked by the |mean| direct effect on the mem - cp logit difference computed
+    by LogitAttribution (one cached forward per batch), then the exact Ablate is run only on the top_k candidates of each
+    component, or on the candidates with a score of at least threshold. The skipped interventions are stored with the
+    clean logits and flagged in the skipped column.
+    Scores, per (layer, aggregated position) for the position components and per (layer, head) for the heads:
+        - mlp_out, attn_out: direct effect of the layer output at the position
+        - attn_out_pattern: largest attn_out score of the two ablated layers at the position
+        - head: direct effect of the head at the last position
+        - head_object_pos: direct effect of the head at the object position
+    """
+
+    def __init__(
+        self,
+        dataset: BaseDataset,
+        model: WrapHookedTransformer,
+        batch_size: int,
+        experiment: Literal["copyVSfact", "contextVSfact"] = "copyVSfact",
+        top_k: Optional[int] = None,
+        threshold: Optional[float] = None,
+        token_budget: Optional[int] = None,
+        **ablate_kwargs,
+    ):
+        if (top_k is None) == (threshold is None):
+            raise ValueError("Exactly one of top_k and threshold must be set")
+        self.top_k = top_k
+        self.threshold = threshold
+        self.attributor = LogitAttribution(
+            dataset, model, batch_size, experiment, token_budget=token_budget
+        )
+        self.ablator = Ablate(dataset, model, batch_size, experiment, **ablate_kwargs)
+        # the layers swept by Ablate
+        self.n_layers = model.cfg.n_layers - 1
+        self.n_heads = model.cfg.n_heads
+
+    def screen(self) -> pd.DataFrame:
+        """
+        Score of each candidate intervention: DataFrame with columns component, layer, position, head, score
+        """
+        (_, _, diff), labels = self.attributor.attribute()
+        # (component, aggregated position), labels may repeat (mlp_out): keep the first one
+        diff_mean = diff.mean(dim=1).abs()
+        index: Dict[str, int] = {}
+        for i, label in enumerate(labels):
+            index.setdefault(label, i)
+        head_positions = {"head": -1, "head_object_pos": OBJECT_POSITION}
+
+        data = []
+        for layer in range(self.n_layers):
+            for position in range(diff_mean.shape[-1]):
+                attn_scores = [
+                    diff_mean[index[f"{layer}_attn_out"], position].item(),
+                    diff_mean[index[f"{layer + 1}_attn_out"], position].item(),
+                ]
+                scores = {
+                    "mlp_out": diff_mean[index[f"{layer}_mlp_out"], position].item(),
+                    "attn_out": attn_scores[0],
+                    "attn_out_pattern": max(attn_scores),
+                }
+                for component, score in scores.items():
+                    data.append(
+                        {"component": component, "layer": layer, "position": position, "head": None, "score": score}
+                    )
+            for head in range(self.n_heads):
+                for component, position in head_positions.items():
+                    score = diff_mean[index[f"L{layer}H{head}"], position].item()
+                    data.append(
+                        {"component": component, "layer": layer, "position": None, "head": head, "score": score}
+                    )
+        return pd.DataFrame(data)
+
+    def _index_column(self, component: str) -> str:
+        """
+        Column of the scores with the index of the interventions in the candidates: head or position
+        """
+        return "head" if component in self.ablator.head_component else "position"
+
+    def select(self, scores: pd.DataFrame, component: str) -> Dict[int, Optional[List[int]]]:
+        """
+        Candidates of the component in the Ablate.set_candidates format: {layer: heads} or {layer: positions}
+        """
+        component_scores = scores[scores["component"] == component]
+        if self.top_k is not None:
+            selected = component_scores.nlargest(self.top_k, "score")
+        else:
+            selected = component_scores[component_scores["score"] >= self.threshold]
+        column = self._index_column(component)
+        candidates: Dict[int, Optional[List[int]]] = {}
+        for _, row in selected.iterrows():
+            candidates.setdefault(int(row["layer"]), []).append(int(row[column]))  # type: ignore
+        return candidates
+
+    def report(
+        self, scores: pd.DataFrame, component: str, candidates: Dict[int, Optional[List[int]]]
+    ) -> Dict:
+        """
+        How much of the total direct effect the skipped interventions could hide
+        """
+        component_scores = scores[scores["component"] == component]
+        column = self._index_column(component)
+        selected = component_scores.apply(
+            lambda row: int(row[column]) in (candidates.get(int(row["layer"])) or []), axis=1
+        ).astype(bool)
+        skipped = component_scores[~selected]
+        total = component_scores["score"].sum()
+        return {
+            "component": component,
+            "n_candidates": len(component_scores),
+            "n_ablated": int(selected.sum()),
+            "ablated_score": component_scores[selected]["score"].sum(),
+            "skipped_score": skipped["score"].sum(),
+            "skipped_fraction": skipped["score"].sum() / total if total > 0 else 0.0,
+            "max_skipped_score": skipped["score"].max() if len(skipped) > 0 else 0.0,
+        }
+
+    def run(
+        self,
+        components: Optional[List[str]] = None,
+        normalize_logit: Literal["none", "softmax", "log_softmax"] = "none",
+        **kwargs,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame, Dict[str, Dict[str, torch.Tensor]]]:
+        """
+        Screen, then ablate the candidates of each component (all the Ablate components by default).
+        Return the Ablate.run dataframes concatenated, the screening report of each component and the Ablate.run tensors
+        """
+        if components is None:
+            components = self.ablator.position_component + self.ablator.head_component
+        scores = self.screen()
+        dataframes, reports, results = [], [], {}
+        for component in components:
+            candidates = self.select(scores, component)
+            reports.append(self.report(scores, component, candidates))
+            self.ablator.set_candidates(candidates)
+            dataframe, results[component] = self.ablator.run(
+                component, normalize_logit, **kwargs
+            )
+            dataframes.append(dataframe)
+        self.ablator.set_candidates(None)
+        return pd.concat(dataframes), pd.DataFrame(reports), results
@@ -1,13 +1,82 @@
 from ast import arg
 import torch
+import einops
 from transformer_lens import HookedTransformer
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from .utils import get_predictions
 from abc import abstractmethod
+from typing import Callable, List, Literal, Optional, Tuple
 
 torch.set_grad_enabled(False)
 
 
+def get_names_filter(names: List[str]) -> Callable[[str], bool]:
+    """
+    Filter for run_with_cache matching the hook points that end with one of the given names (e.g. "hook_resid_post", "attn.hook_pattern")
+    """
+    suffixes = tuple(names)
+    return lambda hook_name: hook_name.endswith(suffixes)
+
+
+def check_left_padding(input_ids: torch.Tensor, attention_mask: torch.Tensor, pad_token_id: int) -> None:
+    """
+    HookedTransformer infers the attention mask of a left-padded batch from its leading pad tokens: check that it matches
+    the attention_mask of the batch
+    """
+    inferred_padding = (input_ids != pad_token_id).cumsum(dim=-1) == 0
+    if not torch.equal(inferred_padding.cpu(), attention_mask.cpu() == 0):
+        raise ValueError(
+            "The attention mask of the batch does not match the leading pad tokens (pad_token_id "
+            f"{pad_token_id}): a prompt starts with the pad token, use same-length batches (no token_budget)"
+        )
+
+
+def unembed_last_position(
+    resid: torch.Tensor,
+    W_U: torch.Tensor,
+    b_U: Optional[torch.Tensor],
+    targets: Optional[torch.Tensor] = None,
+    normalize: Literal["none", "softmax", "log_softmax"] = "none",
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    resid: (batch, d_model) final residual stream of the last position, after the final layer norm
+    targets: (batch, n_targets) token ids whose logits are needed, None for the whole vocabulary
+    return: (logits, logsumexp) with logits of shape (batch, n_targets) or (batch, d_vocab) and the (batch,) logsumexp over
+        the vocabulary, computed only if a normalization is requested (None otherwise)
+    """
+    if targets is not None and normalize == "none":
+        # only the target columns of the unembedding are needed
+        targets = targets.to(resid.device)
+        logits = einops.einsum(resid, W_U[:, targets], "b d, d b t -> b t")
+        if b_U is not None:
+            logits = logits + b_U[targets]
+        return logits, None
+    logits = resid @ W_U
+    if b_U is not None:
+        logits = logits + b_U
+    logsumexp = torch.logsumexp(logits, dim=-1) if normalize != "none" else None
+    if targets is not None:
+        logits = logits.gather(1, targets.to(resid.device))
+    return logits, logsumexp
+
+
+def normalize_readout(
+    logits: torch.Tensor,
+    logsumexp: Optional[torch.Tensor],
+    normalize: Literal["none", "softmax", "log_softmax"] = "none",
+) -> torch.Tensor:
+    """
+    Apply softmax/log_softmax to (a subset of the columns of) last-position logits using the logsumexp over the vocabulary
+    """
+    if normalize == "none":
+        return logits
+    if normalize == "log_softmax":
+        return logits - logsumexp.unsqueeze(-1)
+    if normalize == "softmax":
+        return torch.exp(logits - logsumexp.unsqueeze(-1))
+    raise ValueError(f"normalize must be one of none, softmax, log_softmax, got {normalize}")
+
+
 class ModelConfig:
     def __init__(self, **config):
         self.model_name: str
@@ -62,6 +131,25 @@ class BaseModel:
     def tokenize(self, text: str, prepend_bos: bool = False) -> torch.Tensor:
         pass
 
+    @abstractmethod
+    def tokenize_batch(
+        self, texts: List[str], prepend_bos: bool = False
+    ) -> List[List[int]]:
+        """
+        Tokenize a list of strings with a single tokenizer call, returning the (unpadded) token ids of each string
+        """
+        pass
+
+    def tokenize_batch_with_offsets(
+        self, texts: List[str], prepend_bos: bool = False
+    ) -> Tuple[List[List[int]], List[List[Tuple[int, int]]]]:
+        """
+        Like tokenize_batch, but also return the (start, end) character offsets of each token. Requires a fast tokenizer
+        """
+        raise NotImplementedError(
+            "tokenize_batch_with_offsets method must be implemented"
+        )
+
     @abstractmethod
     def to_string_token(self, token):
         pass
@@ -76,13 +164,49 @@ class BaseModel:
         self.model.eval()
 
     @abstractmethod
-    def run_with_cache(self, *args, **kwargs):
+    def run_with_cache(
+        self,
+        *args,
+        names: Optional[List[str]] = None,
+        offload_to_cpu: bool = False,
+        **kwargs,
+    ):
+        """
+        names: cache only the hook points ending with one of these names (None caches every activation)
+        offload_to_cpu: move each activation to the cpu as soon as it is produced
+        """
         raise NotImplementedError("run_with_cache method must be implemented")
 
     @abstractmethod
     def unembed(self):
+        """
+        Unembedding matrix of shape (d_model, d_vocab)
+        """
         raise NotImplementedError("unembed method must be implemented")
 
+    @abstractmethod
+    def embed(self):
+        """
+        Embedding matrix of shape (d_vocab, d_model)
+        """
+        raise NotImplementedError("embed method must be implemented")
+
+    @abstractmethod
+    def readout(
+        self,
+        input,
+        targets: Optional[torch.Tensor] = None,
+        normalize: Literal["none", "softmax", "log_softmax"] = "none",
+        fwd_hooks: Optional[List] = None,
+        **kwargs,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Forward up to the final residual stream, apply the final layer norm and the unembedding to the last position only.
+        Return the logits of the targets (or of the whole vocabulary if targets is None) and the logsumexp over the vocabulary
+        when a normalization is requested (see unembed_last_position and normalize_readout)
+        """
+        raise NotImplementedError("readout method must be implemented")
+
     @abstractmethod
     def reset_hooks(self):
         raise NotImplementedError("reset_hooks method must be implemented")
@@ -128,12 +252,62 @@ class WrapHookedTransformer(BaseModel):
     def tokenize(self, text: str, prepend_bos: bool = False):
         return self.model.to_tokens(text, prepend_bos)
 
+    def tokenize_batch(self, texts: List[str], prepend_bos: bool = False):
+        input_ids = self.tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+        if prepend_bos:
+            input_ids = [[self.tokenizer.bos_token_id] + ids for ids in input_ids]
+        return input_ids
+
+    def tokenize_batch_with_offsets(self, texts: List[str], prepend_bos: bool = False):
+        encoding = self.tokenizer(
+            list(texts), add_special_tokens=False, return_offsets_mapping=True
+        )
+        input_ids, offsets = encoding["input_ids"], encoding["offset_mapping"]
+        if prepend_bos:
+            input_ids = [[self.tokenizer.bos_token_id] + ids for ids in input_ids]
+            offsets = [[(0, 0)] + offset for offset in offsets]
+        return input_ids, offsets
+
     def to_string_token(self, token):
         return self.to_string_token(token)
 
-    def run_with_cache(self, *args, **kwargs):
+    def run_with_cache(
+        self,
+        *args,
+        names: Optional[List[str]] = None,
+        offload_to_cpu: bool = False,
+        **kwargs,
+    ):
+        if names is not None:
+            kwargs["names_filter"] = get_names_filter(names)
+        if offload_to_cpu:
+            kwargs["device"] = "cpu"
         return self.model.run_with_cache(*args, **kwargs)
 
+    def readout(
+        self,
+        input,
+        targets: Optional[torch.Tensor] = None,
+        normalize: Literal["none", "softmax", "log_softmax"] = "none",
+        fwd_hooks: Optional[List] = None,
+        **kwargs,
+    ):
+        attention_mask = kwargs.pop("attention_mask", None)
+        if attention_mask is not None:
+            # the forward takes no mask: it is inferred from the leading pad tokens when padding on the left
+            check_left_padding(input, attention_mask, self.get_tokenizer().pad_token_id)
+            kwargs.update(padding_side="left", prepend_bos=False)
+        if fwd_hooks is not None and len(fwd_hooks) > 0:
+            resid = self.model.run_with_hooks(
+                input, fwd_hooks=fwd_hooks, stop_at_layer=self.cfg.n_layers, **kwargs
+            )
+        else:
+            resid = self.model(input, stop_at_layer=self.cfg.n_layers, **kwargs)
+        resid = self.model.ln_final(resid[:, -1:, :])[:, 0, :]
+        return unembed_last_position(
+            resid, self.model.W_U, self.model.b_U, targets=targets, normalize=normalize
+        )
+
     def reset_hooks(self):
         self.model.reset_hooks()
 
@@ -143,6 +317,9 @@ class WrapHookedTransformer(BaseModel):
     def unembed(self):
         return self.model.W_U
 
+    def embed(self):
+        return self.model.W_E
+
     def get_tokenizer(self):
         return self.model.tokenizer
 
@@ -176,6 +353,15 @@ class WrapAutoModelForCausalLM(BaseModel):
         )
         return tokens
 
+    def tokenize_batch(self, texts: List[str], prepend_bos: bool = False):
+        return self.tokenizer(list(texts), add_special_tokens=True)["input_ids"]
+
+    def tokenize_batch_with_offsets(self, texts: List[str], prepend_bos: bool = False):
+        encoding = self.tokenizer(
+            list(texts), add_special_tokens=True, return_offsets_mapping=True
+        )
+        return encoding["input_ids"], encoding["offset_mapping"]
+
     def to_string_token(self, tokens: torch.Tensor):
         # for each token in the tensor, convert it to string
         assert tokens.shape[0] == 1, "Batch size must be 1"
@@ -186,6 +372,36 @@ class WrapAutoModelForCausalLM(BaseModel):
             string_tokens.append(self.tokenizer.decode(t))
         return string_tokens
 
+    def readout(
+        self,
+        input,
+        targets: Optional[torch.Tensor] = None,
+        normalize: Literal["none", "softmax", "log_softmax"] = "none",
+        fwd_hooks: Optional[List] = None,
+        **kwargs,
+    ):
+        if fwd_hooks is not None and len(fwd_hooks) > 0:
+            raise NotImplementedError("Hooks are not supported for HuggingFace models")
+        if "attention_mask" in kwargs and "position_ids" not in kwargs:
+            # left-padded batch: restart the positions after the padding
+            kwargs["position_ids"] = (kwargs["attention_mask"].cumsum(dim=-1) - 1).clamp(min=0)
+        # the last hidden state of the base model already went through the final layer norm
+        hidden_states = self.model.base_model(input, **kwargs).last_hidden_state
+        lm_head = self.model.get_output_embeddings()
+        return unembed_last_position(
+            hidden_states[:, -1, :],
+            lm_head.weight.T,
+            lm_head.bias,
+            targets=targets,
+            normalize=normalize,
+        )
+
+    def unembed(self):
+        return self.model.get_output_embeddings().weight.T
+
+    def embed(self):
+        return self.model.get_input_embeddings().weight
+
     def get_tokenizer(self):
         return self.tokenizer
 
@@ -3,7 +3,6 @@ import os  # noqa: F401
 import json  # noqa:  F811
 
 import torch  # noqa: F401
-from torch.utils.data import DataLoader  # noqa: F401
 from transformers import AutoTokenizer, AutoModelForCausalLM  # noqa: E402
 from tqdm import tqdm  # noqa: F401
 from typing import Literal, Optional, Tuple  # noqa: F401
@@ -30,6 +29,7 @@ class EvaluateMechanism:
         premise="Redefine",
         family_name: Optional[str] = None,
         num_samples=1,
+        token_budget: Optional[int] = None,
     ):
         self.tokenizer = model.get_tokenizer()
         self.model = model
@@ -43,6 +43,7 @@ class EvaluateMechanism:
         self.premise = premise
         self.family_name = family_name
         self.n_samples = num_samples
+        self.token_budget = token_budget
         print("Model device", self.model.device)
 
     def update(
@@ -56,7 +57,13 @@ class EvaluateMechanism:
         self.premise = premise
 
     def check_prediction(self, logit, target):
-        probs = torch.softmax(logit, dim=-1)[:, -1, :]
+        """
+        logit: (batch, d_vocab) last-position logits, or (batch, seq_len, d_vocab) full logits
+        """
+        if logit.ndim == 3:
+            logit = logit[:, -1, :]
+        # the argmax of the logits is the argmax of the probabilities: no softmax needed
+        probs = logit
         # count the number of times the model predicts the target[:, 0] or target[:, 1]
         num_samples = target.shape[0]
         target_true = 0
@@ -86,34 +93,23 @@ class EvaluateMechanism:
         all_false_indices = []
         all_other_indices = []
 
-        idx = 0
         for batch in dataloader:
             input_ids = batch["input_ids"].to(self.device)
-            logits = self.model(input_ids)["logits"]
+            if "attention_mask" in batch:
+                # left-padded batch of mixed lengths: each model wrapper masks the padding in its own way
+                logits, _ = self.model.readout(input_ids, attention_mask=batch["attention_mask"].to(self.device))
+            else:
+                logits, _ = self.model.readout(input_ids)
             count = self.check_prediction(logits, batch["target"])
             target_true += len(count[0])
             target_false += len(count[1])
             other += len(count[2])
 
-            all_true_indices.extend(
-                [
-                    self.dataset.original_index[i + idx * self.batch_size]
-                    for i in count[0]
-                ]
-            )
-            all_false_indices.extend(
-                [
-                    self.dataset.original_index[i + idx * self.batch_size]
-                    for i in count[1]
-                ]
-            )
-            all_other_indices.extend(
-                [
-                    self.dataset.original_index[i + idx * self.batch_size]
-                    for i in count[2]
-                ]
-            )
-            idx += 1
+            # map the rows of the batch back to the ids of the records in the dataset
+            ids = batch["ids"].tolist()
+            all_true_indices.extend([ids[i] for i in count[0]])
+            all_false_indices.extend([ids[i] for i in count[1]])
+            all_other_indices.extend([ids[i] for i in count[2]])
         return (
             target_true,
             target_false,
@@ -132,11 +128,15 @@ class EvaluateMechanism:
             all_true_indices = []
             all_false_indices = []
             all_other_indices = []
-            for length in tqdm(self.dataset.get_lengths()):
+            # with a token budget all the lengths are packed together in left-padded batches
+            lengths = [None] if self.token_budget is not None else self.dataset.get_lengths()
+            for length in tqdm(lengths):
                 self.dataset.set_len(length)
                 if len(self.dataset) == 0:
                     continue
-                dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=True)
+                dataloader = self.dataset.get_dataloader(
+                    batch_size=self.batch_size, shuffle=True, token_budget=self.token_budget
+                )
                 result = self.evaluate(length, dataloader)
                 target_true_tmp += result[0]
                 target_false_tmp += result[1]
@@ -0,0 +1,117 @@
+import os
+import numpy as np
+import torch
+from typing import Dict, List, Optional, Sequence, Tuple
+
+WORD2VEC_MODEL = "word2vec-google-news-300"
+MISSING_SCORE = -100.0
+
+Pair = Tuple[str, str]
+
+
+def get_word_vectors_path(data_dir: str = "../data") -> str:
+    return os.path.join(data_dir, f"{WORD2VEC_MODEL}.kv")
+
+
+def load_word_vectors(path: Optional[str] = None):
+    """
+    Load the word2vec KeyedVectors memory-mapped from a local file.
+    The first time, the model is downloaded with gensim and saved in the local format (vectors in a separate .npy file),
+    afterwards only the pages of the vectors actually used are read.
+    """
+    from gensim.models import KeyedVectors
+
+    path = path if path is not None else get_word_vectors_path()
+    if not os.path.exists(path):
+        import gensim.downloader as api
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        api.load(WORD2VEC_MODEL).save(path)
+    return KeyedVectors.load(path, mmap="r")
+
+
+def strip_target(target: str) -> str:
+    # targets are stored with the leading space of the tokenizer
+    return target[1:] if target.startswith(" ") else target
+
+
+def pair_similarity(word_vectors, pairs: Sequence[Pair]) -> np.ndarray:
+    """
+    Cosine similarity of each (word, word) pair in a single vectorized operation, MISSING_SCORE if a word is out of vocabulary
+    """
+    scores = np.full(len(pairs), MISSING_SCORE, dtype=np.float32)
+    key_to_index = word_vectors.key_to_index
+    rows = [
+        i
+        for i, (first, second) in enumerate(pairs)
+        if first in key_to_index and second in key_to_index
+    ]
+    if len(rows) == 0:
+        return scores
+    first_index = np.array([key_to_index[pairs[i][0]] for i in rows])
+    second_index = np.array([key_to_index[pairs[i][1]] for i in rows])
+    # gather only the needed rows of the memory-mapped matrix
+    first_vectors = np.asarray(word_vectors.vectors[first_index], dtype=np.float32)
+    second_vectors = np.asarray(word_vectors.vectors[second_index], dtype=np.float32)
+    dot = (first_vectors * second_vectors).sum(-1)
+    norms = np.linalg.norm(first_vectors, axis=-1) * np.linalg.norm(second_vectors, axis=-1)
+    scores[rows] = dot / np.maximum(norms, np.finfo(np.float32).tiny)
+    return scores
+
+
+def assign_groups(
+    scores: np.ndarray, edges: Sequence[float], out_of_range: int = -100
+) -> np.ndarray:
+    """
+    Index of the [edges[i], edges[i+1]) interval containing each score, out_of_range outside [edges[0], edges[-1])
+    """
+    edges = np.asarray(edges)
+    groups = np.digitize(scores, edges) - 1
+    groups[(scores < edges[0]) | (scores >= edges[-1])] = out_of_range
+    return groups
+
+
+def token_pair_similarity(
+    vectors: torch.Tensor, pairs: torch.Tensor, chunk_size: int = 4096
+) -> torch.Tensor:
+    """
+    Cosine similarity between the rows of vectors (n_vocab, d) indexed by each (token, token) pair (n_pairs, 2).
+    Only the rows of the unique tokens are gathered and normalized, the pairs are scored in chunks to bound memory.
+    """
+    tokens, inverse = torch.unique(pairs.to(vectors.device), return_inverse=True)
+    normalized = torch.nn.functional.normalize(vectors[tokens].float(), dim=-1)
+    scores = []
+    for start in range(0, inverse.shape[0], chunk_size):
+        chunk = inverse[start : start + chunk_size]
+        scores.append((normalized[chunk[:, 0]] * normalized[chunk[:, 1]]).sum(-1).cpu())
+    return torch.cat(scores) if len(scores) > 0 else torch.zeros(0)
+
+
+class SimilarityScorer:
+    """
+    Word2vec similarity between target_true and target_new, persisted in a {(target_true, target_new): score} dict.
+    Word vectors are loaded only if some pair has never been scored.
+    """
+
+    def __init__(self, score_path: str, word_vectors_path: Optional[str] = None):
+        self.score_path = score_path
+        self.word_vectors_path = word_vectors_path
+        self.scores: Dict[Pair, float] = (
+            torch.load(score_path) if os.path.exists(score_path) else {}
+        )
+
+    def __call__(self, pairs: Sequence[Pair]) -> np.ndarray:
+        pairs = [(strip_target(first), strip_target(second)) for first, second in pairs]
+        missing: List[Pair] = list(dict.fromkeys(p for p in pairs if p not in self.scores))
+        if len(missing) > 0:
+            word_vectors = load_word_vectors(self.word_vectors_path)
+            for pair, score in zip(missing, pair_similarity(word_vectors, missing).tolist()):
+                self.scores[pair] = score
+            self.save()
+        return np.array([self.scores[p] for p in pairs], dtype=np.float32)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.score_path) or ".", exist_ok=True)
+        tmp_path = f"{self.score_path}.tmp"
+        torch.save(self.scores, tmp_path)
+        os.replace(tmp_path, self.score_path)
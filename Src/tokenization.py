@@ -0,0 +1,141 @@
+import numpy as np
+import string
+import torch
+from tqdm import tqdm
+from typing import Dict, Iterable, List, Optional, Tuple
+from Src.model import BaseModel
+
+
+def locate_char_spans(
+    offsets: List[List[Tuple[int, int]]], char_spans: np.ndarray
+) -> np.ndarray:
+    """
+    Map character spans to token spans for a whole batch of tokenized texts at once.
+    offsets: for each text, the (start, end) character offsets of its tokens (from a fast tokenizer)
+    char_spans: (n_texts, n_spans, 2) start and (exclusive) end character of each span, -1 for missing spans
+    return: (n_texts, n_spans, 2) first and last token of each span, -1 for missing spans
+    """
+    n_texts = len(offsets)
+    max_len = max([len(offset) for offset in offsets], default=0)
+    pad = np.iinfo(np.int64).max
+    token_starts = np.full((n_texts, max_len), pad, dtype=np.int64)
+    token_ends = np.full((n_texts, max_len), pad, dtype=np.int64)
+    for i, offset in enumerate(offsets):
+        if len(offset) > 0:
+            offset = np.asarray(offset, dtype=np.int64)
+            token_starts[i, : len(offset)] = offset[:, 0]
+            token_ends[i, : len(offset)] = offset[:, 1]
+
+    span_starts = char_spans[..., 0]
+    span_ends = char_spans[..., 1]
+    # first token = number of tokens ending before the span starts, last token = number of tokens starting before the span ends - 1
+    first_token = (token_ends[:, None, :] <= span_starts[:, :, None]).sum(-1)
+    last_token = (token_starts[:, None, :] < span_ends[:, :, None]).sum(-1) - 1
+    missing = (span_starts < 0) | (last_token < first_token)
+    first_token[missing] = -1
+    last_token[missing] = -1
+    return np.stack([first_token, last_token], axis=-1)
+
+
+def template_field_spans(template: str, args: Tuple) -> List[Tuple[int, int, int]]:
+    """
+    Character spans of the replacement fields of a str.format template in template.format(*args), read from the parsed
+    template (escaped braces, literal text and format specs included) rather than assuming a template shape.
+    return: (argument index, start, exclusive end) of each field, in order
+    """
+    formatter = string.Formatter()
+    spans = []
+    offset = 0
+    auto_index = 0
+    for literal, field_name, format_spec, conversion in formatter.parse(template):
+        offset += len(literal)
+        if field_name is None:
+            continue
+        if field_name == "":
+            index, auto_index = auto_index, auto_index + 1
+        else:
+            index = int(field_name)
+        value = formatter.format_field(formatter.convert_field(args[index], conversion), format_spec or "")
+        spans.append((index, offset, offset + len(value)))
+        offset += len(value)
+    return spans
+
+
+class BatchTokenizer:
+    """
+    Tokenize lists of strings with a few batched tokenizer calls.
+    Repeated strings (targets, subjects) are tokenized once and served from a memo afterwards.
+    Tensors are kept on `device` (cpu by default) and moved to the model device only at batching time.
+    """
+
+    def __init__(
+        self,
+        model: BaseModel,
+        device: str = "cpu",
+        batch_size: int = 1024,
+    ):
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+        self.memo: Dict[str, torch.Tensor] = {}
+
+    def _to_tensor(self, ids: List[int]) -> torch.Tensor:
+        return torch.tensor(ids, dtype=torch.long, device=self.device)
+
+    def _encode_chunks(
+        self, texts: List[str], desc: Optional[str] = None
+    ) -> Iterable[List[int]]:
+        chunks = range(0, len(texts), self.batch_size)
+        if desc is not None:
+            chunks = tqdm(chunks, desc=desc, total=len(chunks))
+        for start in chunks:
+            for ids in self.model.tokenize_batch(texts[start : start + self.batch_size]):
+                yield ids
+
+    def supports_offsets(self) -> bool:
+        return getattr(self.model.get_tokenizer(), "is_fast", False)
+
+    def encode_with_offsets(
+        self, texts: List[str], desc: Optional[str] = None
+    ) -> Tuple[List[torch.Tensor], List[List[Tuple[int, int]]]]:
+        """
+        Tokenize the strings (not memoized) and return the token ids along with the character offsets of each token
+        """
+        input_ids, offsets = [], []
+        chunks = range(0, len(texts), self.batch_size)
+        if desc is not None:
+            chunks = tqdm(chunks, desc=desc, total=len(chunks))
+        for start in chunks:
+            chunk_ids, chunk_offsets = self.model.tokenize_batch_with_offsets(
+                texts[start : start + self.batch_size]
+            )
+            input_ids.extend(self._to_tensor(ids) for ids in chunk_ids)
+            offsets.extend(chunk_offsets)
+        return input_ids, offsets
+
+    def prefetch(self, texts: Iterable[str], desc: Optional[str] = None) -> None:
+        """
+        Tokenize all the strings not yet in the memo with batched calls
+        """
+        missing = list(dict.fromkeys(t for t in texts if t not in self.memo))
+        for text, ids in zip(missing, self._encode_chunks(missing, desc)):
+            self.memo[text] = self._to_tensor(ids)
+
+    def __call__(
+        self, texts: List[str], memoize: bool = True, desc: Optional[str] = None
+    ) -> List[torch.Tensor]:
+        """
+        Return the 1D token ids of each string. Use memoize=False for strings that are not expected to repeat (e.g. full prompts)
+        """
+        if not memoize:
+            return [self._to_tensor(ids) for ids in self._encode_chunks(texts, desc)]
+        self.prefetch(texts, desc)
+        return [self.memo[t] for t in texts]
+
+    def encode(self, text: str) -> torch.Tensor:
+        if text not in self.memo:
+            self.prefetch([text])
+        return self.memo[text]
+
+    def clear(self):
+        self.memo = {}
@@ -12,7 +12,7 @@ from rich.table import Table
 import time
 import os
 import torch.nn.functional as F
-from typing import Literal, Union
+from typing import Literal, Optional, Union
 
 
 def check_dataset_and_sample(dataset_path, model_name, hf_model_name):
@@ -149,7 +149,11 @@ def aggregate_result(
     second_subject_positions: torch.Tensor,
     subject_lengths: torch.Tensor,
     length: int,
+    pad_offsets: Optional[torch.Tensor] = None,
 ) -> torch.Tensor:
+    """
+    pad_offsets: (batch,) number of left-padding tokens of each example in a mixed-length batch, the positions must already be shifted
+    """
     if "copyVSfact" in experiment:
         return aggregate_result_copyVSfact(
             pattern,
@@ -158,6 +162,7 @@ def aggregate_result(
             second_subject_positions,
             subject_lengths,
             length,
+            pad_offsets,
         )
     elif experiment == "contextVSfact":
         raise NotImplementedError("Not implemented yet")
@@ -172,6 +177,7 @@ def aggregate_result_copyVSfact(
     second_subject_positions: torch.Tensor,
     subject_lengths: torch.Tensor,
     length: int,
+    pad_offsets: Optional[torch.Tensor] = None,
 ) -> torch.Tensor:
     batch_size = pattern.shape[1]
     assert batch_size == first_subject_positions.shape[0], "Batch size mismatch"
@@ -187,6 +193,7 @@ def aggregate_result_copyVSfact(
             second_subject_positions[i],
             subject_lengths[i],
             length,
+            pad_offsets[i] if pad_offsets is not None else 0,
         )
     return intermediate_aggregate
     
@@ -197,6 +204,7 @@ def aggregate_single_result_copyVSfact(
     second_subject_positions: torch.Tensor,
     subject_lengths: torch.Tensor,
     length: int,
+    pad_offset: Union[torch.Tensor, int] = 0,
 ) -> torch.Tensor:
     #assert the shape of the object_positions, subject_positions and subject_lengths
     assert object_positions.shape == first_subject_positions.shape == subject_lengths.shape, "Shape mismatch"
@@ -206,7 +214,7 @@ def aggregate_single_result_copyVSfact(
     
     
     # pre-subject
-    pre_subject = slice(0, first_subject_positions-1)
+    pre_subject = slice(pad_offset, first_subject_positions-1)
     intermediate_aggregate[..., 0] = pattern[..., pre_subject].mean(dim=-1)
     
     # first token subject
@@ -0,0 +1,238 @@
+import tempfile
+import unittest
+from itertools import product
+from unittest import mock
+import torch
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.experiment import Ablate, LogitStorage
+from Src.experiment.interventions import compile_edits
+
+
+class TestAblate(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, cls.model, "copyVSfact", cache_dir=None)
+        cls.length = cls.dataset.get_lengths()[0]
+
+    def reference_head_object_pos(self, layer, head):
+        """
+        Zero the attention of the last position to the object in one head, freezing the attention output of the
+        following layers
+        """
+        self.dataset.set_len(self.length)
+        input_ids = torch.stack(list(self.dataset.tokenized_prompts))
+        obj_pos = torch.stack(list(self.dataset.obj_pos))
+        clean_cache = self.model.model.run_with_cache(input_ids, prepend_bos=False)[1]
+
+        def ablate(pattern, hook):
+            pattern[torch.arange(pattern.shape[0]), head, -1, obj_pos] = 0
+            return pattern
+
+        def freeze(attn_out, hook):
+            return clean_cache[hook.name]
+
+        hooks = [(f"blocks.{layer}.attn.hook_pattern", ablate)] + [
+            (f"blocks.{other}.hook_attn_out", freeze)
+            for other in range(layer + 1, self.model.cfg.n_layers - 1)
+        ]
+        logits = self.model.model.run_with_hooks(input_ids, fwd_hooks=hooks, prepend_bos=False)[:, -1]
+        return logits.gather(-1, torch.stack(list(self.dataset.targets))[:, :1])[:, 0]
+
+    def test_head_object_pos(self):
+        ablate = Ablate(self.dataset, self.model, batch_size=3)
+        logit_mem = ablate.ablate_single_len(self.length, "head_object_pos")[0]
+        self.assertEqual(logit_mem.shape, (self.model.cfg.n_layers - 1, 1, self.model.cfg.n_heads, len(self.dataset)))
+        for layer, head in [(0, 1), (1, 3)]:
+            torch.testing.assert_close(logit_mem[layer, 0, head], self.reference_head_object_pos(layer, head))
+
+    def test_attn_out_pattern(self):
+        ablate = Ablate(self.dataset, self.model, batch_size=3)
+        logit_mem = ablate.ablate_single_len(self.length, "attn_out_pattern")[0]
+        self.assertEqual(logit_mem.shape, (self.model.cfg.n_layers - 1, self.length, len(self.dataset)))
+        self.assertTrue(torch.isfinite(logit_mem).all())
+
+    def test_sweep_matches_single_runs(self):
+        for component in ["attn_out_pattern", "head_object_pos", "head", "mlp_out"]:
+            single = Ablate(self.dataset, self.model, batch_size=3).ablate_single_len(self.length, component)
+            sweep = Ablate(self.dataset, self.model, batch_size=3, sweep_budget_mb=64).ablate_single_len(
+                self.length, component
+            )
+            for single_logit, sweep_logit in zip(single, sweep):
+                torch.testing.assert_close(single_logit, sweep_logit)
+
+    def test_edits_compiled_once_per_layer(self):
+        for sweep_budget_mb in [None, 64]:
+            ablate = Ablate(self.dataset, self.model, batch_size=2, sweep_budget_mb=sweep_budget_mb)
+            with mock.patch("Src.experiment.ablation.compile_edits", wraps=compile_edits) as compile_mock:
+                for component in ["mlp_out", "head"]:
+                    ablate.ablate_single_len(self.length, component)
+            # several batches and interventions per layer, a single compilation per (component, layer)
+            self.assertGreater(len(self.dataset), 2)
+            self.assertEqual(compile_mock.call_count, 2 * (self.model.cfg.n_layers - 1))
+
+    def test_approximate_run_has_no_winners(self):
+        ablate = Ablate(self.dataset, self.model, batch_size=3)
+        dataframe, _ = ablate.run("head", approximate=True)
+        heads = dataframe[dataframe["component"] == "head"]
+        self.assertTrue(heads["mem_sum"].isna().all())
+        self.assertTrue(heads["cp_sum"].isna().all())
+        self.assertFalse(heads["mem"].isna().any())
+
+    def test_streaming_run(self):
+        ablate = Ablate(self.dataset, self.model, batch_size=3)
+        dataframe, results = ablate.run("head", streaming=True)
+        _, per_example = ablate.run("head")
+        self.assertEqual(set(results), {"mem_mean", "cp_mean", "n_examples", "base_mem", "base_cp"})
+        self.assertEqual(set(per_example), {"mem", "cp", "base_mem", "base_cp"})
+        # the streaming means are the means of the per-example logits over all the lengths
+        torch.testing.assert_close(results["mem_mean"].float(), per_example["mem"].mean(dim=-1), rtol=1e-5, atol=1e-5)
+        self.assertTrue((results["n_examples"] == per_example["mem"].shape[-1]).all())
+        self.assertIn("n_examples", dataframe.columns)
+
+
+class TestAblateAdaptive(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        path = write_records(toy_records(n_repeats=2), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, cls.model, "copyVSfact", cache_dir=None)
+        cls.lengths = [length for length in cls.dataset.get_lengths() if length != 11]
+
+    def stream_ids(self, ablate, seed):
+        """
+        Example ids of each batch of the stratified stream drawn with the seed
+        """
+        batches = ablate.get_stratified_batches(self.lengths, generator=torch.Generator().manual_seed(seed))
+        return [batch["ids"].tolist() for batch in batches]
+
+    def full_run(self, component):
+        """
+        Per-example mem - cp of the full ablation keyed by example id, (layer, 1, head, example)
+        """
+        ablate = Ablate(self.dataset, self.model, batch_size=3)
+        mem, cp = ablate.ablate(component)[:2]
+        ids = []
+        for length in self.lengths:
+            self.dataset.set_len(length)
+            ids.extend(self.dataset.original_index)
+        return mem - cp, ids
+
+    def test_stops_once_converged(self):
+        ablate = Ablate(self.dataset, self.model, batch_size=3)
+        stream = self.stream_ids(ablate, seed=0)
+        self.assertGreater(len(stream), 3)
+        counted = mock.patch.object(Ablate, "_ablate_batch", autospec=True, side_effect=Ablate._ablate_batch)
+        with counted as ablate_batch:
+            # any half width is within the tolerance: stops at the first check after min_examples
+            stats = ablate.ablate_adaptive(
+                "head", tolerance=1e6, min_examples=6, generator=torch.Generator().manual_seed(0)
+            )
+        self.assertEqual(ablate_batch.call_count, 2)
+        self.assertTrue((stats[2].count == 6).all())
+        self.assertTrue(stats[2].converged(1e6, min_count=6).all())
+
+        # the estimate of the evaluated batches is the mean of the full ablation over the same examples
+        full_diff, ids = self.full_run("head")
+        evaluated = [ids.index(i) for batch in stream[:2] for i in batch]
+        torch.testing.assert_close(stats[2].mean.float(), full_diff[..., evaluated].mean(dim=-1), rtol=1e-5, atol=1e-5)
+
+    def test_interventions_stop_separately(self):
+        ablate = Ablate(self.dataset, self.model, batch_size=3)
+        generator = torch.Generator().manual_seed(1)
+        tolerance, min_examples = 0.5, 6
+        stats = ablate.ablate_adaptive("head", tolerance=tolerance, min_examples=min_examples, generator=generator)
+        diff = stats[2]
+        n_examples = sum(len(batch) for batch in self.stream_ids(ablate, seed=1))
+        stopped = diff.count < n_examples
+        self.assertGreater(len(diff.count.unique()), 1)
+        # an intervention stops only once its interval has settled
+        self.assertTrue(diff.converged(tolerance, min_count=min_examples)[stopped].all())
+        self.assertIsNone(ablate.candidates)
+
+    def test_no_tolerance_streams_every_batch(self):
+        ablate = Ablate(self.dataset, self.model, batch_size=3)
+        n_batches = len(self.stream_ids(ablate, seed=0))
+        counted = mock.patch.object(Ablate, "_ablate_batch", autospec=True, side_effect=Ablate._ablate_batch)
+        with counted as ablate_batch:
+            dataframe, results = ablate.run_adaptive("head", tolerance=None, min_examples=6)
+        self.assertEqual(ablate_batch.call_count, n_batches)
+        full_diff, ids = self.full_run("head")
+        self.assertTrue((results["n_examples"] == len(ids)).all())
+        heads = dataframe[dataframe["component"] == "head"]
+        self.assertTrue((heads["n_examples"] == len(ids)).all())
+        torch.testing.assert_close(
+            torch.tensor(heads["diff"].to_numpy()),
+            full_diff.mean(dim=-1).flatten().double(),
+            rtol=1e-5,
+            atol=1e-5,
+        )
+
+
+class TestAttributionPatching(unittest.TestCase):
+    eps = 1e-2
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, cls.model, "copyVSfact", cache_dir=None)
+        cls.length = cls.dataset.get_lengths()[0]
+        cls.dataset.set_len(cls.length)
+        cls.input_ids = torch.stack(list(cls.dataset.tokenized_prompts))
+        cls.targets = torch.stack(list(cls.dataset.targets))
+        logits, cls.clean_cache = cls.model.model.run_with_cache(cls.input_ids, prepend_bos=False)
+        cls.clean_logit = logits[:, -1].gather(-1, cls.targets)
+
+    def exact_slope(self, hook_name, select, frozen_names):
+        """
+        (mem, cp) change of the logits per unit of the exact ablation, scaled down to (1 - eps) of the selected entries
+        with the frozen activations patched to their clean values: the slope the first-order estimate approximates
+        """
+
+        def ablate(activation, hook):
+            activation = activation.clone()
+            activation[select] *= 1 - self.eps
+            return activation
+
+        def freeze(activation, hook):
+            return self.clean_cache[hook.name]
+
+        hooks = [(hook_name, ablate)] + [(name, freeze) for name in frozen_names]
+        logits = self.model.model.run_with_hooks(self.input_ids, fwd_hooks=hooks, prepend_bos=False)[:, -1]
+        return (logits.gather(-1, self.targets) - self.clean_logit).T / self.eps
+
+    def test_heads_match_the_exact_ablation(self):
+        n_layers = self.model.cfg.n_layers - 1
+        for total_effect in [False, True]:
+            ablate = Ablate(self.dataset, self.model, batch_size=3)
+            estimate = ablate.attribution_patching_single_len(self.length, "head", total_effect=total_effect)
+            for layer, head in product(range(n_layers), range(self.model.cfg.n_heads)):
+                with self.subTest(total_effect=total_effect, layer=layer, head=head):
+                    later_layers = range(layer + 1, n_layers) if not total_effect else []
+                    frozen = [f"blocks.{other}.hook_attn_out" for other in later_layers]
+                    slope = self.exact_slope(f"blocks.{layer}.attn.hook_pattern", (slice(None), head, -1), frozen)
+                    for i in range(2):
+                        effect = estimate[i][layer, 0, head] - self.clean_logit[:, i]
+                        torch.testing.assert_close(effect, slope[i], rtol=1e-2, atol=1e-2)
+
+    def test_positions_match_the_exact_ablation(self):
+        n_layers = self.model.cfg.n_layers - 1
+        for total_effect in [False, True]:
+            ablate = Ablate(self.dataset, self.model, batch_size=3)
+            # per-position logits, before the aggregation over the positions
+            with mock.patch.object(LogitStorage, "get_aggregate_logit", lambda storage, **kwargs: storage.get_logit()):
+                estimate = ablate.attribution_patching_single_len(self.length, "mlp_out", total_effect=total_effect)
+            frozen = [] if total_effect else [f"blocks.{layer}.attn.hook_pattern" for layer in range(n_layers)]
+            for layer, position in product(range(n_layers), range(self.length)):
+                with self.subTest(total_effect=total_effect, layer=layer, position=position):
+                    slope = self.exact_slope(f"blocks.{layer}.hook_mlp_out", (slice(None), position), frozen)
+                    for i in range(2):
+                        effect = estimate[i][layer, position] - self.clean_logit[:, i]
+                        torch.testing.assert_close(effect, slope[i], rtol=1e-2, atol=1e-2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import tempfile
+import unittest
+import torch
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.experiment import Ablator
+
+
+class TestAblatorAdaptive(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        path = write_records(toy_records(n_repeats=2), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, cls.model, "copyVSfact", cache_dir=None)
+
+    def ablator(self):
+        ablator = Ablator(self.dataset, self.model, batch_size=3, experiment="copyVSfact")
+        ablator.set_heads([(0, 1), (1, 2)], position="attribute")
+        return ablator
+
+    def full_run(self, ablator):
+        """
+        Per-example diff of the full ablation keyed by example id
+        """
+        diff = ablator.ablate()["diff"]
+        ids = []
+        for length in ablator.get_length_groups():
+            self.dataset.set_len(length)
+            ids.extend(self.dataset.original_index)
+        return dict(zip(ids, diff.tolist()))
+
+    def stream_ids(self, ablator, seed):
+        batches = ablator.get_stratified_batches(generator=torch.Generator().manual_seed(seed))
+        return [batch["ids"].tolist() for batch in batches]
+
+    def test_stops_once_converged(self):
+        ablator = self.ablator()
+        stream = self.stream_ids(ablator, seed=0)
+        self.assertGreater(len(stream), 3)
+        # any half width is within the tolerance: stops at the first batch with min_examples
+        result = ablator.ablate_adaptive(tolerance=1e6, min_examples=5, generator=torch.Generator().manual_seed(0))
+        self.assertEqual(result["diff"].shape[0], 6)
+        # the evaluated examples are the first batches of the stream, with the values of the full run
+        full = self.full_run(ablator)
+        expected = torch.tensor([full[i] for batch in stream[:2] for i in batch])
+        torch.testing.assert_close(result["diff"], expected, rtol=1e-5, atol=1e-5)
+
+    def test_unsettled_runs_every_batch(self):
+        ablator = self.ablator()
+        # min_examples above the size of the dataset: the loop never stops early
+        generator = torch.Generator().manual_seed(0)
+        result = ablator.ablate_adaptive(tolerance=1e6, min_examples=10_000, generator=generator)
+        full = self.full_run(ablator)
+        self.assertEqual(result["diff"].shape[0], len(full))
+        expected = torch.tensor(sorted(full.values()))
+        torch.testing.assert_close(result["diff"].sort().values, expected, rtol=1e-5, atol=1e-5)
+
+        dataframe = ablator.run(tolerance=1e6, min_examples=10_000)
+        self.assertEqual(dataframe["n_examples"].item(), len(full))
+        self.assertAlmostEqual(dataframe["diff"].item(), sum(full.values()) / len(full), places=4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import unittest
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from unittest import mock
+from Src import accumulator
+from Src.accumulator import RunningQuantiles, RunningStats
+
+
+class TestRunningStats(unittest.TestCase):
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        # (layer, position, examples)
+        self.values = torch.randn(3, 5, 40, generator=generator, dtype=torch.float64) * 2 + 1
+
+    def assert_stats(self, stats, values):
+        torch.testing.assert_close(stats.mean, values.mean(dim=-1))
+        torch.testing.assert_close(stats.std(), values.std(dim=-1))
+        torch.testing.assert_close(stats.count, torch.full(values.shape[:-1], float(values.shape[-1]), dtype=torch.float64))
+
+    def test_update_in_batches(self):
+        stats = RunningStats(self.values.shape[:-1])
+        for batch in self.values.split([7, 1, 20, 12], dim=-1):
+            stats.update(batch)
+        self.assert_stats(stats, self.values)
+        torch.testing.assert_close(stats.sum(), self.values.sum(dim=-1))
+
+    def test_update_with_mask(self):
+        mask = torch.zeros(self.values.shape[:-1], dtype=torch.bool)
+        mask[0] = True
+        stats = RunningStats.from_values(self.values[..., :10])
+        stats.update(self.values[..., 10:], mask=mask)
+        torch.testing.assert_close(stats.mean[0], self.values[0].mean(dim=-1))
+        torch.testing.assert_close(stats.std()[0], self.values[0].std(dim=-1))
+        torch.testing.assert_close(stats.mean[1:], self.values[1:, :, :10].mean(dim=-1))
+
+    def test_merge(self):
+        stats = RunningStats.from_values(self.values[..., :15])
+        stats.merge(RunningStats.from_values(self.values[..., 15:]))
+        self.assert_stats(stats, self.values)
+
+        empty = RunningStats(self.values.shape[:-1])
+        empty.merge(stats)
+        self.assert_stats(empty, self.values)
+
+    def test_pool(self):
+        stats = RunningStats.from_values(self.values)
+        # all the positions and examples of each layer
+        self.assert_stats(stats.pool(dim=1), self.values.flatten(1, 2))
+        index = [0, 3]
+        self.assert_stats(stats.pool(dim=1, index=index), self.values[:, index].flatten(1, 2))
+        self.assertTrue(torch.isnan(RunningStats((2, 3)).pool(dim=1).mean).all())
+
+    def test_std_and_half_width_with_one_example(self):
+        stats = RunningStats.from_values(self.values[..., :1])
+        self.assertTrue((stats.std() == 0).all())
+        self.assertTrue(torch.isinf(stats.half_width()).all())
+
+    def test_converged(self):
+        stats = RunningStats.from_values(self.values)
+        half_width = stats.half_width()
+        # settled once the half width is at most the tolerance
+        tolerance = half_width.median().item()
+        converged = stats.converged(tolerance)
+        self.assertTrue(converged[half_width <= tolerance].all())
+        self.assertTrue(converged.any())
+        # or once the interval excludes zero, whatever the tolerance
+        excludes_zero = stats.mean.abs() > half_width
+        self.assertTrue(excludes_zero.any())
+        torch.testing.assert_close(stats.converged(0.0), excludes_zero)
+        # never before min_count examples, nor with a single example (infinite half width)
+        self.assertFalse(stats.converged(1e6, min_count=41).any())
+        self.assertTrue(stats.converged(1e6, min_count=40).all())
+        self.assertFalse(RunningStats.from_values(self.values[..., :1]).converged(1e6).any())
+
+
+@unittest.skipUnless(accumulator.TDigest is not None, "tdigest is not installed")
+class TestRunningQuantiles(unittest.TestCase):
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        # (layer, position, examples)
+        self.values = torch.randn(2, 3, 2000, generator=generator, dtype=torch.float64) * 2 + 1
+
+    def assert_quantiles(self, quantiles, values):
+        for q in [0.1, 0.5, 0.9]:
+            torch.testing.assert_close(quantiles.quantile(q), values.quantile(q, dim=-1), rtol=0, atol=0.1)
+
+    def test_update_in_batches(self):
+        quantiles = RunningQuantiles(self.values.shape[:-1])
+        for batch in self.values.split([700, 1, 1299], dim=-1):
+            quantiles.update(batch)
+        self.assertEqual(quantiles.quantile(0.5).shape, self.values.shape[:-1])
+        self.assert_quantiles(quantiles, self.values)
+
+    def test_update_with_mask_and_merge(self):
+        mask = torch.zeros(self.values.shape[:-1], dtype=torch.bool)
+        mask[0] = True
+        quantiles = RunningQuantiles(self.values.shape[:-1])
+        quantiles.update(self.values, mask=mask)
+        torch.testing.assert_close(quantiles.quantile(0.5)[0], self.values[0].median(dim=-1).values, rtol=0, atol=0.1)
+        # the entries without examples have no quantiles
+        self.assertTrue(torch.isnan(quantiles.quantile(0.5)[1:]).all())
+
+        first = RunningQuantiles(self.values.shape[:-1])
+        first.update(self.values[..., :1000])
+        second = RunningQuantiles(self.values.shape[:-1])
+        second.update(self.values[..., 1000:])
+        first.merge(second)
+        self.assert_quantiles(first, self.values)
+
+    def test_missing_tdigest(self):
+        with mock.patch.object(accumulator, "TDigest", None):
+            with self.assertRaises(ImportError):
+                RunningQuantiles((2, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import tempfile
+import unittest
+from unittest import mock
+import torch
+from transformer_lens import HookedTransformer
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.base_experiment import BaseExperiment, _vocab_reductions, to_logit_token
+from Src.experiment import Ablate, HeadPattern, LogitAttribution, LogitLens
+
+
+class TestPaddedBatches(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, cls.model, "copyVSfact", cache_dir=None)
+
+    def last_logits(self, experiment):
+        logits = {}
+        for batch in experiment.get_dataloader():
+            model_input, model_kwargs = experiment.get_model_input(batch)
+            logit, _ = self.model.readout(model_input, **model_kwargs)
+            for i, row in zip(batch["ids"].tolist(), logit):
+                logits[i] = row
+        return logits
+
+    def test_padded_batch_matches_per_length_batches(self):
+        self.assertGreater(len(self.dataset.get_lengths()), 1)
+        experiment = BaseExperiment(self.dataset, self.model, batch_size=4)
+        per_length = {}
+        for length in self.dataset.get_lengths():
+            experiment.set_len(length)
+            per_length.update(self.last_logits(experiment))
+
+        padded_experiment = BaseExperiment(self.dataset, self.model, batch_size=len(per_length), token_budget=10_000)
+        padded_experiment.set_len(None)
+        batches = list(padded_experiment.get_dataloader())
+        self.assertEqual(len(batches), 1)
+        self.assertGreater(int((batches[0]["attention_mask"] == 0).sum()), 0)
+        padded = self.last_logits(padded_experiment)
+
+        self.assertEqual(padded.keys(), per_length.keys())
+        for i in per_length:
+            torch.testing.assert_close(padded[i], per_length[i])
+
+    def test_prompt_starting_with_pad_token(self):
+        experiment = BaseExperiment(self.dataset, self.model, batch_size=4, token_budget=10_000)
+        experiment.set_len(None)
+        batch = next(iter(experiment.get_dataloader()))
+        row = int(batch["pad_offset"].argmax())
+        batch["input_ids"][row, batch["pad_offset"][row]] = self.model.get_tokenizer().pad_token_id
+        with self.assertRaises(ValueError):
+            experiment.get_model_input(batch)
+
+    def test_basic_logit_of_the_first_length(self):
+        first = self.dataset.get_lengths()[0]
+        experiment = BaseExperiment(self.dataset, self.model, batch_size=3)
+        experiment.set_len(first)
+        expected = self.last_logits(experiment)
+        targets = {i: target for i, target in zip(self.dataset.original_index, self.dataset.targets)}
+        for token_budget in [None, 10_000]:
+            experiment = BaseExperiment(self.dataset, self.model, batch_size=3, token_budget=token_budget)
+            logit_mem, logit_cp = experiment.get_basic_logit()
+            self.assertEqual(logit_mem.shape, (len(expected),))
+            for row, i in enumerate(sorted(expected)):
+                torch.testing.assert_close(logit_mem[row], expected[i][targets[i][0]])
+                torch.testing.assert_close(logit_cp[row], expected[i][targets[i][1]])
+
+
+class TestModelInput(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, cls.model, "copyVSfact", cache_dir=None)
+
+    def test_input_ids_match_the_prompts(self):
+        experiment = BaseExperiment(self.dataset, self.model, batch_size=4)
+        for length in self.dataset.get_lengths():
+            experiment.set_len(length)
+            for batch in experiment.get_dataloader():
+                model_input, model_kwargs = experiment.get_model_input(batch)
+                self.assertEqual(model_kwargs, {"prepend_bos": False})
+                tokens = self.model.model.to_tokens(batch["prompt"], prepend_bos=False)
+                self.assertTrue(torch.equal(model_input, tokens))
+                torch.testing.assert_close(
+                    self.model.model(model_input), self.model.model(batch["prompt"], prepend_bos=False)
+                )
+
+    def test_experiments_do_not_retokenize(self):
+        length = self.dataset.get_lengths()[0]
+        with mock.patch.object(HookedTransformer, "to_tokens", side_effect=AssertionError("re-tokenized a prompt")):
+            BaseExperiment(self.dataset, self.model, batch_size=4).get_basic_logit()
+            LogitLens(self.dataset, self.model, 4, "copyVSfact").project_length(length, "resid_post")
+            LogitAttribution(self.dataset, self.model, 4, "copyVSfact").attribute_single_len(
+                length, mock.MagicMock(), "logit"
+            )
+            HeadPattern(self.dataset, self.model, 4, "copyVSfact").extract_single_len(length, mock.MagicMock())
+            Ablate(self.dataset, self.model, batch_size=4).ablate("mlp_out")
+
+
+class TestToLogitToken(unittest.TestCase):
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        # integer logits: ties between the maximum and the targets
+        self.logit = torch.randint(-4, 5, (6, 3, 23), generator=generator).float()
+        self.target = torch.randint(0, 23, (6, 3), generator=generator)
+        last = self.logit[:, -1, :]
+        self.target_logit = last.gather(-1, self.target[:, :2])
+        self.dense = {
+            "none": self.target_logit,
+            "softmax": torch.softmax(last, dim=-1).gather(-1, self.target[:, :2]),
+            "log_softmax": torch.log_softmax(last, dim=-1).gather(-1, self.target[:, :2]),
+        }
+        self.rank = (last.unsqueeze(1) > self.target_logit.unsqueeze(-1)).sum(-1)
+        self.winners = (last.argmax(dim=-1, keepdim=True) == self.target[:, :2]).float()
+
+    def test_vocab_reductions(self):
+        last = self.logit[:, -1, :]
+        for chunk_size in [None, 1, 3, 7, 23, 64]:
+            logsumexp, argmax, rank = _vocab_reductions(last, self.target_logit, chunk_size=chunk_size)
+            torch.testing.assert_close(logsumexp, torch.logsumexp(last, dim=-1))
+            self.assertTrue(torch.equal(argmax, last.argmax(dim=-1)), chunk_size)
+            self.assertTrue(torch.equal(rank, self.rank), chunk_size)
+        self.assertEqual(_vocab_reductions(last, self.target_logit, False, False, False), (None, None, None))
+
+    def test_chunked_matches_dense(self):
+        for normalize in ["none", "softmax", "log_softmax", "logsoftmax"]:
+            expected = self.dense["log_softmax" if normalize == "logsoftmax" else normalize]
+            for chunk_size in [None, 1, 3, 7, 64]:
+                logit_mem, logit_cp, index_mem, index_cp, mem_winners, cp_winners = to_logit_token(
+                    self.logit, self.target, normalize, return_index=True, return_winners=True, vocab_chunk_size=chunk_size
+                )
+                torch.testing.assert_close(torch.stack([logit_mem, logit_cp], dim=-1), expected)
+                self.assertTrue(torch.equal(torch.stack([index_mem, index_cp], dim=-1), self.rank))
+                self.assertTrue(torch.equal(torch.stack([mem_winners, cp_winners], dim=-1), self.winners))
+
+    def test_return_values(self):
+        logit_mem, logit_cp, index_mem, index_cp = to_logit_token(self.logit[:, -1, :], self.target)
+        torch.testing.assert_close(logit_mem, self.target_logit[:, 0])
+        self.assertIsNone(index_mem)
+        _, _, index_mem, index_cp = to_logit_token(self.logit, self.target, return_index=True, vocab_chunk_size=5)
+        self.assertTrue(torch.equal(index_cp, self.rank[:, 1]))
+        _, _, index_mem, _, mem_winners, _ = to_logit_token(self.logit, self.target, return_winners=True)
+        self.assertIsNone(index_mem)
+        self.assertTrue(torch.equal(mem_winners, self.winners[:, 0]))
+
+    def test_invalid_normalize(self):
+        with self.assertRaises(ValueError):
+            to_logit_token(self.logit, self.target, normalize="probs")
+
+
+if __name__ == "__main__":
+    unittest.main()
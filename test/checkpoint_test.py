@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+from unittest import mock
+import torch
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.experiment import Ablate
+
+
+class TestAblationCheckpoint(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        cls.path = write_records(toy_records(), tempfile.mkdtemp())
+
+    def dataset(self, start=None, end=None):
+        return BaseDataset(self.path, self.model, "copyVSfact", start=start, end=end, cache_dir=None)
+
+    def test_fingerprint(self):
+        fingerprint = self.dataset().get_fingerprint()
+        self.assertEqual(fingerprint, self.dataset().get_fingerprint())
+        self.assertNotEqual(fingerprint, self.dataset(start=0, end=8).get_fingerprint())
+        first_half, second_half = self.dataset(start=0, end=8), self.dataset(start=4, end=12)
+        self.assertNotEqual(first_half.get_fingerprint(), second_half.get_fingerprint())
+
+    def test_resumed_run_matches_uninterrupted_run(self):
+        dataset = self.dataset()
+        expected_dataframe, expected = Ablate(dataset, self.model, batch_size=3).run("head")
+
+        checkpoint_dir = tempfile.mkdtemp()
+        original = Ablate._ablate_batch
+        n_calls = []
+
+        def interrupted(*args, **kwargs):
+            # the job is killed while ablating the third batch
+            if len(n_calls) == 2:
+                raise KeyboardInterrupt
+            n_calls.append(1)
+            return original(*args, **kwargs)
+
+        with mock.patch.object(Ablate, "_ablate_batch", autospec=True, side_effect=interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                Ablate(dataset, self.model, batch_size=3, checkpoint_dir=checkpoint_dir).run("head")
+
+        with mock.patch.object(Ablate, "_ablate_batch", autospec=True, side_effect=original) as resumed_batches:
+            ablate = Ablate(dataset, self.model, batch_size=3, checkpoint_dir=checkpoint_dir, resume=True)
+            dataframe, result = ablate.run("head")
+        # only the batches missing from the checkpoint are ablated
+        n_batches = sum(-(-len(dataset.index.lookup(length=length)) // 3) for length in dataset.get_lengths())
+        self.assertEqual(resumed_batches.call_count, n_batches - 2)
+        for key, value in expected.items():
+            torch.testing.assert_close(result[key], value)
+        self.assertTrue(dataframe.reset_index(drop=True).equals(expected_dataframe.reset_index(drop=True)))
+
+    def test_changed_slice_is_rejected(self):
+        checkpoint_dir = tempfile.mkdtemp()
+        Ablate(self.dataset(start=0, end=8), self.model, batch_size=3, checkpoint_dir=checkpoint_dir).run("head")
+        dataset = self.dataset(start=4, end=12)
+        ablate = Ablate(dataset, self.model, batch_size=3, checkpoint_dir=checkpoint_dir, resume=True)
+        with self.assertRaises(ValueError) as context:
+            ablate.run("head")
+        self.assertIn("dataset", str(context.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+import torch
+from unittest import mock
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.dataset_cache import TokenizationCache, file_fingerprint
+
+
+class TestTokenizationCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = write_records(toy_records(), self.directory)
+        self.cache_dir = os.path.join(self.directory, "cache")
+
+    def assert_same_store(self, first, second):
+        self.assertEqual(first.store.length_of, second.store.length_of)
+        for length, bucket in first.store.buckets.items():
+            for name, column in bucket.columns.items():
+                other = second.store.buckets[length].columns[name]
+                if isinstance(column, torch.Tensor):
+                    self.assertTrue(torch.equal(column, other), name)
+                else:
+                    self.assertEqual(column, other, name)
+
+    def test_warm_start_matches_cold_start(self):
+        cold = BaseDataset(self.path, self.model, "copyVSfact", cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        with mock.patch.object(BaseDataset, "__tokenize__", side_effect=AssertionError("tokenized on a warm start")):
+            warm = BaseDataset(self.path, self.model, "copyVSfact", cache_dir=self.cache_dir)
+        self.assertIsNotNone(warm._cache_entry)
+        self.assertEqual(sorted(cold.get_lengths()), sorted(warm.get_lengths()))
+        self.assert_same_store(cold, warm)
+
+        # the premise is spliced on a cache miss, then cached too
+        warm.update("Imagine")
+        cold.update("Imagine")
+        self.assert_same_store(cold, warm)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_to_records_sets_positions_only(self):
+        cold = BaseDataset(self.path, self.model, "copyVSfact", cache_dir=self.cache_dir)
+        key = os.listdir(self.cache_dir)[0]
+        entry = TokenizationCache(self.cache_dir).load(key)
+        records = [{"source_index": i} for i in range(len(toy_records()))]
+        cached = TokenizationCache.to_records(entry, records)
+        self.assertEqual(cached, set(range(len(records))))
+        for d, expected in zip(records, sorted(cold.full_data, key=lambda d: d["source_index"])):
+            self.assertEqual(d["obj_pos"], expected["obj_pos"])
+            self.assertEqual(d["length"], expected["length"])
+            self.assertNotIn("tokenized_prompt", d)
+
+    def test_file_fingerprint(self):
+        fingerprint = file_fingerprint(self.path)
+        self.assertEqual(fingerprint, file_fingerprint(self.path))
+        write_records(toy_records(n_repeats=2), self.directory)
+        self.assertNotEqual(fingerprint, file_fingerprint(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
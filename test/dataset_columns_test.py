@@ -0,0 +1,154 @@
+import os
+import sys
+import unittest
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Src.dataset_columns import ColumnBatchLoader, ColumnStore, PaddedBatchLoader, TokenBudgetSampler
+
+
+def make_records(lengths):
+    """
+    Processed records with distinct token ids: the token j of record i is 100 * i + j + 1
+    """
+    records = []
+    for i, length in enumerate(lengths):
+        records.append(
+            {
+                "prompt": f"prompt {i}",
+                "length": length,
+                "tokenized_prompt": torch.arange(length) + 100 * i + 1,
+                "targets": torch.tensor([i, -i]),
+                "obj_pos": length - 3,
+                "1_subj_pos": 1,
+                "2_subj_pos": -1 if i % 2 else length - 2,
+                "subj_len": i % 3,
+                "similarity_group": i % 2,
+            }
+        )
+    return records
+
+
+class TestColumnStore(unittest.TestCase):
+    def setUp(self):
+        self.lengths = [5, 7, 5, 6, 7, 5]
+        self.records = make_records(self.lengths)
+        self.store = ColumnStore(self.records)
+
+    def assert_row(self, columns, row, i):
+        record = self.records[i]
+        self.assertEqual(columns["prompt"][row], record["prompt"])
+        self.assertEqual(int(columns["ids"][row]), i)
+        self.assertTrue(torch.equal(columns["input_ids"][row], record["tokenized_prompt"]))
+        self.assertTrue(torch.equal(columns["target"][row], record["targets"]))
+        for name in ["obj_pos", "1_subj_pos", "2_subj_pos", "subj_len", "similarity_group"]:
+            self.assertEqual(int(columns[name][row]), record[name], name)
+
+    def test_buckets(self):
+        self.assertEqual(sorted(self.store.buckets), [5, 6, 7])
+        self.assertEqual(self.store.length_of, dict(enumerate(self.lengths)))
+        self.assertEqual(self.store.buckets[5].columns["input_ids"].shape, (3, 5))
+
+    def test_select(self):
+        ids = [5, 0, 2]
+        columns = self.store.select(ids)
+        for row, i in enumerate(ids):
+            self.assert_row(columns, row, i)
+        # the whole bucket in order is not copied
+        whole = self.store.select([0, 2, 5])
+        self.assertIs(whole["input_ids"], self.store.buckets[5].columns["input_ids"])
+        self.assertEqual(self.store.select([]), {"prompt": []})
+
+    def test_select_mixed_lengths_without_padding(self):
+        with self.assertRaises(ValueError):
+            self.store.select([0, 1])
+
+    def test_batch_loader(self):
+        columns = self.store.select([0, 2, 5])
+        batches = list(ColumnBatchLoader(columns, batch_size=2))
+        self.assertEqual([len(batch["prompt"]) for batch in batches], [2, 1])
+        self.assertTrue(torch.equal(torch.cat([batch["input_ids"] for batch in batches]), columns["input_ids"]))
+
+        shuffled = list(ColumnBatchLoader(columns, batch_size=2, shuffle=True))
+        ids = torch.cat([batch["ids"] for batch in shuffled])
+        self.assertEqual(sorted(ids.tolist()), [0, 2, 5])
+        for batch in shuffled:
+            for row, i in enumerate(batch["ids"].tolist()):
+                self.assert_row(batch, row, i)
+
+
+class TestPaddedColumns(unittest.TestCase):
+    def setUp(self):
+        self.lengths = [5, 7, 5, 6, 7, 5, 3]
+        self.records = make_records(self.lengths)
+        self.store = ColumnStore(self.records)
+        self.pad_token_id = 0
+
+    def test_select_padded(self):
+        ids = [1, 0, 3, 6]
+        columns = self.store.select_padded(ids, self.pad_token_id)
+        max_length = 7
+        self.assertEqual(columns["input_ids"].shape, (4, max_length))
+        for row, i in enumerate(ids):
+            record = self.records[i]
+            length = record["length"]
+            offset = max_length - length
+            self.assertEqual(columns["prompt"][row], record["prompt"])
+            self.assertEqual(int(columns["ids"][row]), i)
+            self.assertEqual(int(columns["length"][row]), length)
+            self.assertEqual(int(columns["pad_offset"][row]), offset)
+            # left padding: the last token is always at -1
+            self.assertTrue(torch.equal(columns["input_ids"][row, offset:], record["tokenized_prompt"]))
+            self.assertTrue(torch.all(columns["input_ids"][row, :offset] == self.pad_token_id))
+            self.assertEqual(columns["attention_mask"][row].tolist(), [0] * offset + [1] * length)
+            self.assertTrue(torch.equal(columns["target"][row], record["targets"]))
+            self.assertEqual(int(columns["subj_len"][row]), record["subj_len"])
+            for name in ["obj_pos", "1_subj_pos", "2_subj_pos"]:
+                expected = record[name] + offset if record[name] >= 0 else -1
+                self.assertEqual(int(columns[name][row]), expected, name)
+            # the shifted positions index the same tokens
+            obj_pos = int(columns["obj_pos"][row])
+            self.assertEqual(int(columns["input_ids"][row, obj_pos]), int(record["tokenized_prompt"][record["obj_pos"]]))
+        self.assertEqual(self.store.select_padded([], self.pad_token_id), {"prompt": []})
+
+    def test_select_with_pad_token_id(self):
+        padded = self.store.select_padded([0, 1], self.pad_token_id)
+        columns = self.store.select([0, 1], pad_token_id=self.pad_token_id)
+        for name, column in padded.items():
+            if isinstance(column, torch.Tensor):
+                self.assertTrue(torch.equal(column, columns[name]), name)
+
+    def test_token_budget_sampler(self):
+        ids = list(range(len(self.lengths)))
+        for token_budget, max_batch_size in [(7, None), (15, None), (20, None), (100, 2), (100, None)]:
+            sampler = TokenBudgetSampler(self.store.length_of, ids, token_budget, max_batch_size)
+            batches = list(sampler)
+            self.assertEqual(len(sampler), len(batches))
+            self.assertEqual(sorted(i for batch in batches for i in batch), ids)
+            flat = [self.lengths[i] for batch in batches for i in batch]
+            self.assertEqual(flat, sorted(flat))
+            for batch in batches:
+                padded_tokens = len(batch) * max(self.lengths[i] for i in batch)
+                self.assertLessEqual(padded_tokens, token_budget)
+                if max_batch_size is not None:
+                    self.assertLessEqual(len(batch), max_batch_size)
+        self.assertEqual(list(TokenBudgetSampler(self.store.length_of, ids, 15)), [[6, 0, 2], [5, 3], [1, 4]])
+        # a record longer than the budget still gets its own batch
+        self.assertEqual(list(TokenBudgetSampler(self.store.length_of, [1, 6], 4)), [[6], [1]])
+
+    def test_padded_batch_loader(self):
+        ids = [0, 1, 2, 4, 6]
+        for shuffle in [False, True]:
+            loader = PaddedBatchLoader(self.store, ids, token_budget=15, pad_token_id=self.pad_token_id, shuffle=shuffle)
+            batches = list(loader)
+            self.assertEqual(len(loader), len(batches))
+            self.assertEqual(sorted(i for batch in batches for i in batch["ids"].tolist()), ids)
+            for batch in batches:
+                expected = self.store.select_padded(batch["ids"].tolist(), self.pad_token_id)
+                for name, column in batch.items():
+                    if isinstance(column, torch.Tensor):
+                        self.assertTrue(torch.equal(column, expected[name]), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
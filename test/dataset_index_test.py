@@ -0,0 +1,128 @@
+import random
+import tempfile
+import unittest
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.dataset_index import RecordIndex
+
+
+def make_records():
+    records = []
+    for i in range(12):
+        records.append(
+            {
+                "prompt": f"prompt {i % 10}",
+                "target_new": " Italy",
+                "target_true": " France",
+                "length": 5 + i % 3,
+                "similarity_group": i % 2,
+                "outcome": "target_true" if i < 6 else "target_false",
+            }
+        )
+    # without the optional keys
+    records.append({"prompt": "other", "target_new": " Spain", "target_true": " Italy", "length": 5})
+    return records
+
+
+class TestRecordIndex(unittest.TestCase):
+    def setUp(self):
+        self.records = make_records()
+        self.index = RecordIndex(self.records)
+
+    def brute_force(self, length=None, similarity_group=None, outcome=None):
+        return [
+            i
+            for i, d in enumerate(self.records)
+            if (length is None or d["length"] == length)
+            and (similarity_group is None or d.get("similarity_group") == similarity_group)
+            and (outcome is None or d.get("outcome") == outcome)
+        ]
+
+    def test_lookup_and_count(self):
+        for length in [None, 5, 6, 7, 8]:
+            for similarity_group in [None, 0, 1]:
+                for outcome in [None, "target_true", "target_false"]:
+                    expected = self.brute_force(length, similarity_group, outcome)
+                    self.assertEqual(self.index.lookup(length, similarity_group, outcome), expected)
+                    self.assertEqual(self.index.count(length, similarity_group, outcome), len(expected))
+        # the lookup is a copy of the bucket
+        self.index.lookup(length=5, similarity_group=0, outcome="target_true").append(-1)
+        self.assertNotIn(-1, self.index.lookup())
+
+    def test_duplicates(self):
+        # prompts 0-1 repeat as 10-11
+        self.assertEqual(self.index.duplicates, [(0, 10), (1, 11)])
+
+    def test_sample(self):
+        rng = random.Random(0)
+        sample = self.index.sample(3, similarity_group=1, rng=rng)
+        self.assertEqual(sample, sorted(sample))
+        self.assertEqual(len(sample), 3)
+        self.assertTrue(set(sample) <= set(self.brute_force(similarity_group=1)))
+        self.assertEqual(self.index.sample(100, length=7), self.brute_force(length=7))
+        self.assertEqual(self.index.sample(3, similarity_group=1, rng=random.Random(0)), sample)
+
+    def test_stratified_sample(self):
+        strata = self.index.stratified_sample(2, by=("length", "outcome"), rng=random.Random(0), similarity_group=0)
+        expected_strata = {
+            (d["length"], d["outcome"]) for d in self.records if d.get("similarity_group") == 0
+        }
+        self.assertEqual(set(strata), expected_strata)
+        for (length, outcome), ids in strata.items():
+            expected = self.brute_force(length, 0, outcome)
+            self.assertEqual(len(ids), min(2, len(expected)))
+            self.assertTrue(set(ids) <= set(expected))
+
+
+class TestSimilaritySelection(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        model = ToyHookedTransformer()
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, model, "copyVSfact", cache_dir=None)
+
+    def set_groups(self, similarity_type):
+        self.dataset.similarity = (True, 0, similarity_type)
+        for i, d in enumerate(self.dataset.full_data):
+            d["similarity_group"] = i % 2
+        self.dataset.minimal_size = 2
+        self.dataset.__build_index__()
+        self.group = [i for i, d in enumerate(self.dataset.full_data) if d["similarity_group"] == 0]
+
+    def test_self_similarity(self):
+        self.set_groups("self-similarity")
+        self.dataset.set_len(None)
+        self.assertEqual(self.dataset.original_index, self.group)
+        length = self.dataset.get_lengths()[0]
+        self.dataset.set_len(length)
+        self.assertEqual(
+            self.dataset.original_index, [i for i in self.group if self.dataset.full_data[i]["length"] == length]
+        )
+
+    def test_no_group_selects_nothing(self):
+        self.set_groups("self-similarity")
+        self.dataset.similarity = (True, None, "self-similarity")
+        self.assertEqual(self.dataset.filter_similarity_data(), [])
+        self.dataset.set_len(None)
+        self.assertEqual(self.dataset.prompts, [])
+
+    def test_modify_self_similarity_is_redrawn(self):
+        self.set_groups("modify-self-similarity")
+        random.seed(0)
+        samples = set()
+        for _ in range(20):
+            ids = self.dataset.filter_similarity_data()
+            self.assertEqual(len(ids), 2)
+            self.assertTrue(set(ids) <= set(self.group))
+            samples.add(tuple(ids))
+        self.assertGreater(len(samples), 1)
+        # the length filter applies after the sample of the whole group
+        length = self.dataset.get_lengths()[0]
+        for _ in range(20):
+            ids = self.dataset.filter_similarity_data(length=length)
+            self.assertLessEqual(len(ids), 2)
+            self.assertTrue(all(self.dataset.full_data[i]["length"] == length for i in ids))
+
+
+if __name__ == "__main__":
+    unittest.main()
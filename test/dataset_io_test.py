@@ -0,0 +1,95 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Src.dataset_io import (
+    count_records,
+    get_line_index_path,
+    iter_json_array,
+    iter_records,
+    json_to_jsonl,
+    load_line_index,
+)
+
+RECORDS = [
+    {"template": "{}: Paris is the capital of{}.", "subject": "Paris", "target_new": " Italy", "id": i, "note": "ü, [\"]"}
+    for i in range(10)
+]
+
+
+class TestDatasetIO(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.json_path = os.path.join(self.directory, "data.json")
+        with open(self.json_path, "w") as f:
+            json.dump(RECORDS, f, indent=4, ensure_ascii=False)
+
+    def write_jsonl(self, records, name="data.jsonl", blank_lines=False):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+                if blank_lines:
+                    f.write("\n")
+        return path
+
+    def test_iter_json_array_across_chunks(self):
+        for chunk_size in [1, 7, 64, 1 << 16]:
+            self.assertEqual(list(iter_json_array(self.json_path, chunk_size=chunk_size)), RECORDS)
+
+    def test_iter_json_array_errors(self):
+        empty_path = os.path.join(self.directory, "empty.json")
+        with open(empty_path, "w") as f:
+            f.write("  [ ]\n")
+        self.assertEqual(list(iter_json_array(empty_path)), [])
+
+        object_path = os.path.join(self.directory, "object.json")
+        with open(object_path, "w") as f:
+            json.dump({"records": RECORDS}, f)
+        with self.assertRaises(ValueError):
+            list(iter_json_array(object_path))
+
+        truncated_path = os.path.join(self.directory, "truncated.json")
+        with open(truncated_path, "w") as f:
+            f.write(json.dumps(RECORDS)[:-40])
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json_array(truncated_path, chunk_size=16))
+
+    def test_iter_records_slices(self):
+        jsonl_path = self.write_jsonl(RECORDS, blank_lines=True)
+        for path in [self.json_path, jsonl_path]:
+            for start, end in [(None, None), (2, 5), (8, None), (-3, None), (None, -8), (5, 2), (3, 100)]:
+                self.assertEqual(list(iter_records(path, start, end)), RECORDS[start:end], (path, start, end))
+            self.assertEqual(count_records(path), len(RECORDS))
+
+    def test_sidecar_index(self):
+        path = self.write_jsonl(RECORDS[:4], blank_lines=True)
+        offsets = load_line_index(path)
+        self.assertTrue(os.path.exists(get_line_index_path(path)))
+        self.assertEqual(len(offsets), 5)
+        self.assertEqual(offsets[-1], os.path.getsize(path))
+        with open(path, "rb") as f:
+            for offset, record in zip(offsets[:-1], RECORDS[:4]):
+                f.seek(int(offset))
+                self.assertEqual(json.loads(f.readline()), record)
+
+        # the index of a file that changed is rebuilt
+        self.write_jsonl(RECORDS, blank_lines=True)
+        os.utime(get_line_index_path(path), (0, 0))
+        self.assertEqual(len(load_line_index(path)), len(RECORDS) + 1)
+        self.assertEqual(list(iter_records(path, 7, None)), RECORDS[7:])
+
+    def test_json_to_jsonl(self):
+        jsonl_path = json_to_jsonl(self.json_path)
+        self.assertEqual(jsonl_path, os.path.join(self.directory, "data.jsonl"))
+        self.assertTrue(os.path.exists(get_line_index_path(jsonl_path)))
+        self.assertEqual(list(iter_records(jsonl_path)), RECORDS)
+        np.testing.assert_array_equal(np.load(get_line_index_path(jsonl_path)), load_line_index(jsonl_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import tempfile
+import unittest
+import torch
+from unittest import mock
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+
+
+class TestSplicePremise(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        cls.directory = tempfile.mkdtemp()
+
+    def build(self, records, premise="Redefine"):
+        path = write_records(records, self.directory)
+        return BaseDataset(path, self.model, "copyVSfact", premise=premise, cache_dir=None)
+
+    def assert_same_dataset(self, spliced, fresh):
+        self.assertEqual(sorted(spliced.get_lengths()), sorted(fresh.get_lengths()))
+        self.assertEqual(spliced.store.length_of, fresh.store.length_of)
+        for length, bucket in fresh.store.buckets.items():
+            for name, column in bucket.columns.items():
+                other = spliced.store.buckets[length].columns[name]
+                if isinstance(column, torch.Tensor):
+                    self.assertTrue(torch.equal(column, other), name)
+                else:
+                    self.assertEqual(column, other, name)
+        for d, expected in zip(spliced.full_data, fresh.full_data):
+            for key in ["prompt", "length", "obj_pos", "1_subj_pos", "2_subj_pos", "subj_len"]:
+                self.assertEqual(d[key], expected[key], key)
+
+    def test_splice_matches_fresh_tokenization(self):
+        # "Suppose a city" changes the length of the premise prefix and shifts every position
+        for premise in ["Imagine", "Suppose a city"]:
+            dataset = self.build(toy_records())
+            with mock.patch.object(
+                BaseDataset, "__tokenize_and_locate__", side_effect=AssertionError("re-encoded a clean prompt")
+            ):
+                dataset.update(premise)
+            self.assert_same_dataset(dataset, self.build(toy_records(), premise=premise))
+
+    def test_merged_boundary_is_reencoded(self):
+        # "Redefine:" is a single (unknown) word: the premise is not a token prefix of the prompt
+        records = toy_records()
+        records.append(dict(records[0], template=records[0]["template"].replace("{} :", "{}:")))
+        dataset = self.build(records)
+        with mock.patch.object(
+            BaseDataset, "__tokenize_and_locate__", autospec=True, side_effect=BaseDataset.__tokenize_and_locate__
+        ) as tokenize:
+            dataset.update("Imagine")
+        self.assertEqual(tokenize.call_count, 1)
+        self.assert_same_dataset(dataset, self.build(records, premise="Imagine"))
+
+
+    def test_templates_with_numbered_fields_and_prefix(self):
+        records = toy_records()
+        template = records[0]["template"]
+        rest = template[len("{} : "):]
+        records.append(dict(records[0], template="{0} : " + rest.replace("{}", "{1}")))
+        # literal text before the premise: the subject occurs in the prefix too
+        records.append(dict(records[0], template="Paris is in Europe . {} : " + rest))
+        records.append(dict(records[0], template="Paris is in{1} . {0} : " + rest.replace("{}", "{1}")))
+        dataset = self.build(records)
+        with mock.patch.object(
+            BaseDataset, "__tokenize_and_locate__", side_effect=AssertionError("re-encoded a clean prompt")
+        ):
+            dataset.update("Suppose a city")
+        self.assert_same_dataset(dataset, self.build(records, premise="Suppose a city"))
+
+    def test_repeated_premise_is_reencoded(self):
+        records = toy_records()
+        records.append(dict(records[0], template="{0} : " + records[0]["template"][len("{} : "):].replace("{}", "{1}") + " {0}"))
+        dataset = self.build(records)
+        with mock.patch.object(
+            BaseDataset, "__tokenize_and_locate__", autospec=True, side_effect=BaseDataset.__tokenize_and_locate__
+        ) as tokenize:
+            dataset.update("Suppose a city")
+        self.assertEqual(tokenize.call_count, 1)
+        self.assert_same_dataset(dataset, self.build(records, premise="Suppose a city"))
+
+
+if __name__ == "__main__":
+    unittest.main()
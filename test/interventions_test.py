@@ -0,0 +1,104 @@
+import tempfile
+import unittest
+import torch
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.experiment.interventions import Edit, bind_hooks, compile_edits
+
+
+def apply(hooks, activations):
+    """
+    Apply the bound hooks to toy activations keyed by hook name
+    """
+    for hook_name, hook in hooks:
+        activations[hook_name] = hook(activations[hook_name], None)
+    return activations
+
+
+class TestCompileEdits(unittest.TestCase):
+    def setUp(self):
+        # [batch, head, query, key] pattern and [batch, pos, d_model] residual
+        self.pattern = torch.rand(3, 4, 5, 5) + 1
+        self.resid = torch.rand(3, 5, 2) + 1
+        self.activations = lambda: {"pattern": self.pattern.clone(), "resid": self.resid.clone()}
+
+    def test_int_position(self):
+        hooks = bind_hooks(compile_edits([Edit("resid", query=-2)]))
+        result = apply(hooks, self.activations())["resid"]
+        expected = self.resid.clone()
+        expected[:, 3] = 0
+        torch.testing.assert_close(result, expected)
+
+    def test_column_position(self):
+        batch = {"obj_pos": torch.tensor([0, 2, -1])}
+        hooks = bind_hooks(compile_edits([Edit("pattern", heads=(1,), query=-1, key="obj_pos")]), batch)
+        result = apply(hooks, self.activations())["pattern"]
+        expected = self.pattern.clone()
+        for row, key in enumerate([0, 2, 4]):
+            expected[row, 1, -1, key] = 0
+        torch.testing.assert_close(result, expected)
+
+    def test_merged_heads(self):
+        edits = [Edit("pattern", heads=(head,), query=-1, scale=0.5) for head in (0, 2)]
+        fused = compile_edits(edits + [Edit("resid", query=0)])
+        self.assertEqual([hook.hook_name for hook in fused], ["pattern", "resid"])
+        self.assertEqual(fused[0].edits, [Edit("pattern", heads=(0, 2), query=-1, scale=0.5)])
+
+        result = apply(bind_hooks(fused), self.activations())["pattern"]
+        expected = self.pattern.clone()
+        expected[:, [0, 2], -1] *= 0.5
+        torch.testing.assert_close(result, expected)
+
+    def test_column_heads_on_stacked_batch(self):
+        # two copies of a batch of 3, each copy with its own head, as in the ablation sweeps
+        batch = {"sweep_head": torch.tensor([1, 1, 1, 3, 3, 3]), "obj_pos": torch.tensor([0, 2, 4])}
+        edits = [Edit("pattern", heads="sweep_head", query=-1, key="obj_pos"), Edit("pattern", heads=(0,), value=2.0)]
+        fused = compile_edits(edits)
+        self.assertEqual(len(fused), 1)
+        self.assertEqual(len(fused[0].edits), 2)
+
+        pattern = self.pattern.repeat(2, 1, 1, 1)
+        result = apply(bind_hooks(fused, batch), {"pattern": pattern.clone()})["pattern"]
+        expected = pattern.clone()
+        for row, (head, key) in enumerate(zip([1, 1, 1, 3, 3, 3], [0, 2, 4] * 2)):
+            expected[row, head, -1, key] = 0
+        expected[:, 0] = 2.0
+        torch.testing.assert_close(result, expected)
+
+    def test_scale_keeps_masked_scores(self):
+        # causal and padding -inf scores stay -inf when scaled by 0 (instead of -inf * 0 = nan)
+        scores = torch.rand(2, 4, 5, 5).masked_fill(torch.ones(5, 5, dtype=torch.bool).triu(1), float("-inf"))
+        hooks = bind_hooks(compile_edits([Edit("scores", heads=(1, 2), scale=0.0)]))
+        result = apply(hooks, {"scores": scores.clone()})["scores"]
+        self.assertFalse(torch.isnan(result).any())
+        expected = scores.clone()
+        expected[:, [1, 2]] = scores[:, [1, 2]].masked_fill(scores[:, [1, 2]].isfinite(), 0)
+        torch.testing.assert_close(result, expected)
+
+    def test_scale_on_left_padded_batch(self):
+        model = ToyHookedTransformer()
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        dataset = BaseDataset(path, model, "copyVSfact", cache_dir=None)
+        dataset.set_len(None)
+        batch = next(iter(dataset.get_dataloader(batch_size=len(dataset), token_budget=10_000)))
+        self.assertGreater(int((batch["attention_mask"] == 0).sum()), 0)
+        # uniform attention of the last position over every key of layer 0
+        edits = [Edit("blocks.0.attn.hook_attn_scores", query=-1, scale=0.0)]
+        logits, _ = model.readout(
+            batch["input_ids"], attention_mask=batch["attention_mask"], fwd_hooks=bind_hooks(compile_edits(edits))
+        )
+        self.assertFalse(torch.isnan(logits).any())
+        for row, pad_offset in enumerate(batch["pad_offset"].tolist()):
+            expected, _ = model.readout(
+                batch["input_ids"][row : row + 1, pad_offset:], fwd_hooks=bind_hooks(compile_edits(edits))
+            )
+            torch.testing.assert_close(logits[row], expected[0], rtol=1e-4, atol=1e-4)
+
+    def test_heads_on_residual(self):
+        hooks = bind_hooks(compile_edits([Edit("resid", heads=(0,))]))
+        with self.assertRaises(ValueError):
+            apply(hooks, self.activations())
+
+
+if __name__ == "__main__":
+    unittest.main()
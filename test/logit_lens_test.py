@@ -0,0 +1,167 @@
+import tempfile
+import unittest
+import torch
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.experiment import HeadLogitStorage, LogitLens, LogitStorage
+from Src.experiment.logit_lens import IndexLogitStorage
+
+
+class TestProjectHeads(unittest.TestCase):
+    def lens_and_batch(self, normalization_type):
+        model = ToyHookedTransformer(normalization_type=normalization_type)
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        dataset = BaseDataset(path, model, "copyVSfact", cache_dir=None)
+        lens = LogitLens(dataset, model, batch_size=4, experiment="copyVSfact")
+        lens.set_len(dataset.get_lengths()[0])
+        batch = next(iter(lens.get_dataloader()))
+        _, cache = lens.run_with_cache(batch, names=lens.get_cached_activations("head"))
+        return model, lens, batch, cache
+
+    def reference(self, model, cache, target, normalization_type):
+        """
+        (layer, pos, head, batch) mem logits of the output of each head through the final norm and the unembedding
+        """
+        hooked_model = model.model
+        z = cache.stack_activation("z")
+        output = torch.einsum("lbphe,lhed->lbphd", z, hooked_model.W_O)
+        if normalization_type in ["LN", "LNPre"]:
+            output = output - output.mean(dim=-1, keepdim=True)
+        output = output / cache["ln_final.hook_scale"][None, :, :, None]
+        mem_directions = hooked_model.W_U[:, target[:, 0]]
+        return torch.einsum("lbphd,db->lphb", output, mem_directions)
+
+    def test_fast_path_applies_the_final_norm(self):
+        for normalization_type in ["LN", "LNPre", "RMS", "RMSPre"]:
+            with self.subTest(normalization_type=normalization_type):
+                model, lens, batch, cache = self.lens_and_batch(normalization_type)
+                fast_mem, fast_cp, _, _ = lens.project_heads(cache, batch["target"])
+                expected = self.reference(model, cache, batch["target"], normalization_type)
+                torch.testing.assert_close(fast_mem, expected, rtol=1e-4, atol=1e-4)
+
+                # the per-layer path through project_stack gives the same logits
+                slow_mem, slow_cp, _, _ = lens.project_heads(cache, batch["target"], return_index=True)
+                torch.testing.assert_close(fast_mem, slow_mem, rtol=1e-4, atol=1e-4)
+                torch.testing.assert_close(fast_cp, slow_cp, rtol=1e-4, atol=1e-4)
+
+
+class TestResidualLens(unittest.TestCase):
+    normalization_types = ["LN", "LNPre", "RMS", "RMSPre"]
+
+    def lens_and_batch(self, normalization_type, component):
+        model = ToyHookedTransformer(normalization_type=normalization_type)
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        dataset = BaseDataset(path, model, "copyVSfact", cache_dir=None)
+        lens = LogitLens(dataset, model, batch_size=4, experiment="copyVSfact")
+        lens.set_len(dataset.get_lengths()[0])
+        batch = next(iter(lens.get_dataloader()))
+        _, cache = lens.run_with_cache(batch, names=lens.get_cached_activations(component))
+        return model, lens, batch, cache
+
+    def reference(self, model, cache, stack, target):
+        """
+        (mem, cp) logits of a (..., batch, pos, d_model) stack through the ln_final module of the model, with the scale
+        of the final residual stream as the lens, and the target columns of W_U
+        """
+        hooked_model = model.model
+        final_scale = cache["ln_final.hook_scale"]
+        with hooked_model.hooks(fwd_hooks=[("ln_final.hook_scale", lambda scale, hook: final_scale)]):
+            normalized = hooked_model.ln_final(stack)
+        directions = hooked_model.W_U[:, target[:, :2]]  # d_model batch 2
+        return torch.einsum("...bpd,dbt->t...pb", normalized, directions)
+
+    def test_resid_lens_matches_ln_final(self):
+        for normalization_type in self.normalization_types:
+            with self.subTest(normalization_type=normalization_type):
+                model, lens, batch, cache = self.lens_and_batch(normalization_type, "resid_post")
+                resid = cache.stack_activation("resid_post")
+                mem, cp, _, _ = lens.project_stack(lens.apply_ln_final(cache, resid), batch["target"])
+                expected = self.reference(model, cache, resid, batch["target"])
+                torch.testing.assert_close(mem, expected[0], rtol=1e-4, atol=1e-4)
+                torch.testing.assert_close(cp, expected[1], rtol=1e-4, atol=1e-4)
+                # the lens of the last layer is the output of the model
+                logits = model.model(batch["input_ids"], prepend_bos=False)
+                b_U = model.model.b_U[batch["target"][:, :2]]
+                final = logits.gather(-1, batch["target"][:, None, :2].expand(-1, logits.shape[1], -1)) - b_U[:, None]
+                torch.testing.assert_close(mem[-1], final[..., 0].T, rtol=1e-4, atol=1e-4)
+                torch.testing.assert_close(cp[-1], final[..., 1].T, rtol=1e-4, atol=1e-4)
+
+    def test_head_lens_matches_ln_final(self):
+        for normalization_type in self.normalization_types:
+            with self.subTest(normalization_type=normalization_type):
+                model, lens, batch, cache = self.lens_and_batch(normalization_type, "head")
+                # (layer, head, batch, pos, d_model) output of each head
+                output = torch.einsum("lbphe,lhed->lhbpd", cache.stack_activation("z"), model.model.W_O)
+                expected = self.reference(model, cache, output, batch["target"]).transpose(2, 3)
+                for return_index in [False, True]:
+                    mem, cp, _, _ = lens.project_heads(cache, batch["target"], return_index=return_index)
+                    torch.testing.assert_close(mem, expected[0], rtol=1e-4, atol=1e-4)
+                    torch.testing.assert_close(cp, expected[1], rtol=1e-4, atol=1e-4)
+
+
+class TestLogitStorage(unittest.TestCase):
+    n_layers, length, n_heads = 2, 3, 4
+
+    def batches(self, n_metrics, sizes, n_heads=1, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        return [
+            tuple(torch.randn(self.n_layers, self.length, n_heads, size, generator=generator) for _ in range(n_metrics))
+            for size in sizes
+        ]
+
+    def test_store_matches_store_stack(self):
+        sizes = [3, 1, 4]
+        for n_examples in [None, sum(sizes)]:
+            batches = self.batches(4, sizes, self.n_heads)
+            by_cell = HeadLogitStorage(self.n_layers, self.length, "copyVSfact", self.n_heads, n_examples=n_examples)
+            stacked = HeadLogitStorage(self.n_layers, self.length, "copyVSfact", self.n_heads, n_examples=n_examples)
+            for batch in batches:
+                # mem and cp logits without ranks, then the winners
+                stacked.store_stack(batch[:2] + (None, None), mem_winners=batch[2], cp_winners=batch[3])
+                for layer in range(self.n_layers):
+                    for position in range(self.length):
+                        for head in range(self.n_heads):
+                            cell = tuple(value[layer, position, head] for value in batch)
+                            by_cell.store(
+                                layer, position, cell[:2] + (None, None), head=head, mem_winners=cell[2], cp_winners=cell[3]
+                            )
+            expected = [torch.cat([batch[i] for batch in batches], dim=-1) for i in range(4)]
+            for result in [by_cell.get_logit(), stacked.get_logit()]:
+                self.assertEqual(len(result), 4)
+                for values, reference in zip(result, expected):
+                    torch.testing.assert_close(values, reference)
+            if n_examples is not None:
+                # allocated once with the known number of examples
+                self.assertEqual(stacked.logits["mem_logit"].shape[-1], n_examples)
+
+    def test_growth_and_unstored_metrics(self):
+        storage = LogitStorage(self.n_layers, self.length, "copyVSfact")
+        batches = self.batches(2, [2, 3, 5, 1])
+        for batch in batches:
+            storage.store_stack(batch + (None, None))
+        self.assertGreaterEqual(storage.logits["mem_logit"].shape[-1], 11)
+        self.assertIsNone(storage.logits["mem_winners"])
+        mem, cp = storage.get_logit()
+        # (layers, position, examples) for a single head
+        torch.testing.assert_close(mem, torch.cat([batch[0] for batch in batches], dim=-1).flatten(1, 2))
+        torch.testing.assert_close(cp, torch.cat([batch[1] for batch in batches], dim=-1).flatten(1, 2))
+
+    def test_merge_state(self):
+        batches = self.batches(4, [2, 3])
+        first = IndexLogitStorage(self.n_layers, self.length, "copyVSfact")
+        second = IndexLogitStorage(self.n_layers, self.length, "copyVSfact")
+        first.store_stack(batches[0])
+        second.store_stack(batches[1])
+        first.merge(second.get_state())
+        for values, reference in zip(first.get_state().values(), [torch.cat(pair, dim=-1) for pair in zip(*batches)]):
+            torch.testing.assert_close(values, reference)
+
+    def test_store_stack_after_uneven_stores(self):
+        storage = LogitStorage(self.n_layers, self.length, "copyVSfact")
+        storage.store(0, 0, (torch.zeros(2), torch.zeros(2), None, None))
+        with self.assertRaises(ValueError):
+            storage.store_stack(self.batches(2, [1])[0] + (None, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import tempfile
+import unittest
+from unittest import mock
+import torch
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.experiment import HeadPattern, LogitAttribution, LogitLens
+from Src.model import get_names_filter
+
+
+class TestSelectiveCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, cls.model, "copyVSfact", cache_dir=None)
+        cls.length = cls.dataset.get_lengths()[0]
+
+    def assert_same(self, first, second):
+        if isinstance(first, torch.Tensor):
+            torch.testing.assert_close(first, second)
+        elif isinstance(first, dict):
+            self.assertEqual(first.keys(), second.keys())
+            for key in first:
+                self.assert_same(first[key], second[key])
+        elif isinstance(first, (list, tuple)):
+            self.assertEqual(len(first), len(second))
+            for a, b in zip(first, second):
+                self.assert_same(a, b)
+        else:
+            self.assertEqual(first, second)
+
+    def test_names_filter(self):
+        names_filter = get_names_filter(["attn.hook_pattern", "ln_final.hook_scale"])
+        self.assertTrue(names_filter("blocks.0.attn.hook_pattern"))
+        self.assertTrue(names_filter("ln_final.hook_scale"))
+        self.assertFalse(names_filter("blocks.0.ln1.hook_scale"))
+        self.assertFalse(names_filter("blocks.0.hook_attn_out"))
+
+    def test_run_with_cache_names(self):
+        input_ids = self.model.model.to_tokens(["Redefine : Rome is in Italy"], prepend_bos=False)
+        full_logits, full_cache = self.model.run_with_cache(input_ids)
+        logits, cache = self.model.run_with_cache(
+            input_ids, names=["hook_attn_out", "ln_final.hook_scale"], offload_to_cpu=True
+        )
+        torch.testing.assert_close(logits, full_logits)
+        expected = [f"blocks.{layer}.hook_attn_out" for layer in range(self.model.cfg.n_layers)] + ["ln_final.hook_scale"]
+        self.assertEqual(sorted(cache.keys()), sorted(expected))
+        for name in expected:
+            self.assertEqual(cache[name].device.type, "cpu")
+            torch.testing.assert_close(cache[name], full_cache[name])
+
+    def test_declared_activations_suffice(self):
+        attribution = LogitAttribution(self.dataset, self.model, 4, "copyVSfact")
+        pattern = HeadPattern(self.dataset, self.model, 4, "copyVSfact")
+        lens = LogitLens(self.dataset, self.model, 4, "copyVSfact")
+        runs = [
+            (attribution, lambda: attribution.attribute()),
+            (pattern, lambda: pattern.extract()),
+        ]
+        for experiment, run in runs:
+            declared = run()
+            # None caches every activation
+            with mock.patch.object(experiment, "cached_activations", None):
+                self.assert_same(declared, run())
+        for component in ["resid_post", "mlp_out"]:
+            declared = lens.project_length(self.length, component, return_index=True)
+            with mock.patch.object(lens, "get_cached_activations", return_value=None):
+                self.assert_same(declared, lens.project_length(self.length, component, return_index=True))
+        lens.set_len(self.length)
+        batch = next(iter(lens.get_dataloader()))
+        _, cache = lens.run_with_cache(batch, names=lens.get_cached_activations("head"))
+        _, full_cache = lens.run_with_cache(batch, names=None)
+        for return_index in [False, True]:
+            self.assert_same(
+                lens.project_heads(cache, batch["target"], return_index=return_index),
+                lens.project_heads(full_cache, batch["target"], return_index=return_index),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
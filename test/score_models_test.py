@@ -0,0 +1,45 @@
+import tempfile
+import unittest
+import torch
+from toy_model import ToyAutoModelForCausalLM, ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.score_models import EvaluateMechanism
+
+
+class TestPaddedEvaluation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.path = write_records(toy_records(), tempfile.mkdtemp())
+        cls.models = [ToyHookedTransformer(), ToyAutoModelForCausalLM()]
+
+    def test_padded_readout_matches_unpadded_rows(self):
+        for model in self.models:
+            with self.subTest(model=type(model).__name__):
+                dataset = BaseDataset(self.path, model, "copyVSfact", cache_dir=None)
+                dataset.set_len(None)
+                batch = next(iter(dataset.get_dataloader(batch_size=len(dataset), token_budget=10_000)))
+                self.assertGreater(int((batch["attention_mask"] == 0).sum()), 0)
+                logits, _ = model.readout(batch["input_ids"], attention_mask=batch["attention_mask"])
+                for row, pad_offset in enumerate(batch["pad_offset"].tolist()):
+                    expected, _ = model.readout(batch["input_ids"][row : row + 1, pad_offset:])
+                    torch.testing.assert_close(logits[row], expected[0], rtol=1e-4, atol=1e-4)
+
+    def test_token_budget_matches_per_length_evaluation(self):
+        for model in self.models:
+            with self.subTest(model=type(model).__name__):
+                dataset = BaseDataset(self.path, model, "copyVSfact", cache_dir=None)
+                evaluator = EvaluateMechanism(model, dataset, similarity=(False, 0, "self-similarity"))
+                per_length = [set(), set(), set()]
+                for length in dataset.get_lengths():
+                    dataset.set_len(length)
+                    result = evaluator.evaluate(length, dataset.get_dataloader(batch_size=3))
+                    for indices, ids in zip(per_length, result[3:]):
+                        indices.update(ids)
+                dataset.set_len(None)
+                result = evaluator.evaluate(None, dataset.get_dataloader(batch_size=5, token_budget=40))
+                self.assertEqual([set(ids) for ids in result[3:]], per_length)
+                self.assertEqual(sum(result[:3]), len(dataset.full_data))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import tempfile
+import unittest
+import torch
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.experiment import Ablate, Screening
+from Src.experiment.screening import OBJECT_POSITION
+from Src.utils import aggregate_result
+
+
+class TestScreening(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, cls.model, "copyVSfact", cache_dir=None)
+        cls.screening = Screening(cls.dataset, cls.model, batch_size=3, top_k=3)
+        cls.scores = cls.screening.screen()
+
+    def test_scores_per_position(self):
+        (_, _, diff), labels = self.screening.attributor.attribute()
+        diff_mean = diff.mean(dim=1).abs()
+        n_positions = diff_mean.shape[-1]
+        n_layers, n_heads = self.model.cfg.n_layers - 1, self.model.cfg.n_heads
+        for component in ["mlp_out", "attn_out", "attn_out_pattern"]:
+            component_scores = self.scores[self.scores["component"] == component]
+            self.assertEqual(len(component_scores), n_layers * n_positions)
+        for component in ["head", "head_object_pos"]:
+            self.assertEqual(len(self.scores[self.scores["component"] == component]), n_layers * n_heads)
+
+        def score(component, layer, column, value):
+            rows = self.scores[
+                (self.scores["component"] == component) & (self.scores["layer"] == layer) & (self.scores[column] == value)
+            ]
+            self.assertEqual(len(rows), 1)
+            return rows["score"].item()
+
+        for layer, position in [(0, 3), (1, OBJECT_POSITION), (1, n_positions - 1)]:
+            expected = diff_mean[labels.index(f"{layer}_mlp_out"), position].item()
+            self.assertAlmostEqual(score("mlp_out", layer, "position", position), expected, places=5)
+        # each head component is scored at the position it ablates
+        for layer, head in [(0, 1), (1, 3)]:
+            label = labels.index(f"L{layer}H{head}")
+            self.assertAlmostEqual(score("head", layer, "head", head), diff_mean[label, -1].item(), places=5)
+            self.assertAlmostEqual(
+                score("head_object_pos", layer, "head", head), diff_mean[label, OBJECT_POSITION].item(), places=5
+            )
+
+    def test_select_and_report(self):
+        for component, column in [("mlp_out", "position"), ("head_object_pos", "head")]:
+            candidates = self.screening.select(self.scores, component)
+            component_scores = self.scores[self.scores["component"] == component]
+            top = component_scores.nlargest(3, "score")
+            self.assertEqual(
+                sorted((layer, index) for layer, indices in candidates.items() for index in indices),  # type: ignore
+                sorted(zip(top["layer"].astype(int), top[column].astype(int))),
+            )
+            report = self.screening.report(self.scores, component, candidates)
+            self.assertEqual(report["n_ablated"], 3)
+            self.assertAlmostEqual(report["ablated_score"], top["score"].sum(), places=5)
+
+    def test_aggregated_positions(self):
+        ablate = Ablate(self.dataset, self.model, batch_size=3)
+        length = self.dataset.get_lengths()[0]
+        ablate.set_len(length, slice_to_fit_batch=False)
+        batch = next(iter(ablate.get_dataloader()))
+        mask = ablate._get_aggregated_positions(batch)
+        columns = [batch[name] for name in ["obj_pos", "1_subj_pos", "2_subj_pos", "subj_len"]]
+        for aggregated_position in range(mask.shape[-1]):
+            # the aggregated position only reads the positions of the mask
+            pattern = torch.rand(1, len(batch["prompt"]), length)
+            pattern[..., ~mask[:, aggregated_position]] = float("nan")
+            aggregated = aggregate_result("copyVSfact", pattern, *columns, length=length)
+            self.assertFalse(torch.isnan(aggregated[..., aggregated_position]).any(), aggregated_position)
+
+    def test_run_flags_the_skipped_interventions(self):
+        components = ["mlp_out", "head_object_pos"]
+        dataframe, report, _ = self.screening.run(components)
+        full = Ablate(self.dataset, self.model, batch_size=3)
+        for component in components:
+            with self.subTest(component=component):
+                rows = dataframe[dataframe["component"] == component]
+                component_report = report[report["component"] == component].iloc[0]
+                self.assertEqual(int((~rows["skipped"].astype(bool)).sum()), component_report["n_ablated"])
+                # the ablated interventions have the exact values of the full ablation
+                full_rows = full.run(component)[0]
+                full_rows = full_rows[full_rows["component"] == component]
+                kept = ~rows["skipped"].astype(bool).to_numpy()
+                self.assertFalse(full_rows["skipped"].astype(bool).any())
+                for column in ["mem", "cp"]:
+                    torch.testing.assert_close(
+                        torch.tensor(rows[column].to_numpy()[kept]),
+                        torch.tensor(full_rows[column].to_numpy()[kept]),
+                        rtol=1e-4,
+                        atol=1e-4,
+                    )
+        self.assertIsNone(self.screening.ablator.candidates)
+
+
+if __name__ == "__main__":
+    unittest.main()
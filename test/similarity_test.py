@@ -0,0 +1,123 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import torch
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.similarity import (
+    MISSING_SCORE,
+    SimilarityScorer,
+    assign_groups,
+    load_word_vectors,
+    pair_similarity,
+    token_pair_similarity,
+)
+
+try:
+    from gensim.models import KeyedVectors
+except ImportError:
+    KeyedVectors = None
+
+EDGES = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]
+
+
+def toy_word_vectors():
+    word_vectors = KeyedVectors(vector_size=3)
+    word_vectors.add_vectors(
+        ["France", "Italy", "Paris", "Rome"],
+        np.array([[1, 0, 0], [1, 1, 0], [0, 0, 2], [0, 1, 1]], dtype=np.float32),
+    )
+    return word_vectors
+
+
+class TestAssignGroups(unittest.TestCase):
+    def test_edges(self):
+        scores = np.array([0.0, 0.1, 0.35, 0.7999, 0.8, 1.0, -0.01, MISSING_SCORE])
+        groups = assign_groups(scores, EDGES)
+        # each interval is closed on the left, open on the right
+        self.assertEqual(groups.tolist(), [0, 1, 3, 7, -100, -100, -100, -100])
+        self.assertEqual(assign_groups(np.array([0.5]), EDGES, out_of_range=-1).tolist(), [5])
+
+    def test_matches_the_intervals(self):
+        scores = np.random.default_rng(0).uniform(-0.2, 1.0, 1000).astype(np.float32)
+        groups = assign_groups(scores, EDGES)
+        for score, group in zip(scores.tolist(), groups.tolist()):
+            expected = -100
+            for i, (low, high) in enumerate(zip(EDGES[:-1], EDGES[1:])):
+                if low <= score < high:
+                    expected = i
+            self.assertEqual(group, expected, score)
+
+
+class TestTokenPairSimilarity(unittest.TestCase):
+    def test_chunked_matches_dense(self):
+        generator = torch.Generator().manual_seed(0)
+        vectors = torch.randn(50, 8, generator=generator)
+        pairs = torch.randint(0, 50, (37, 2), generator=generator)
+        dense = torch.nn.functional.cosine_similarity(vectors[pairs[:, 0]], vectors[pairs[:, 1]], dim=-1)
+        for chunk_size in [1, 5, 37, 4096]:
+            torch.testing.assert_close(token_pair_similarity(vectors, pairs, chunk_size=chunk_size), dense)
+        self.assertEqual(token_pair_similarity(vectors, torch.zeros((0, 2), dtype=torch.long)).shape, (0,))
+
+
+class TestModelEmbeddingSimilarity(unittest.TestCase):
+    def test_scores_of_the_target_tokens(self):
+        model = ToyHookedTransformer()
+        dataset = BaseDataset(write_records(toy_records(), tempfile.mkdtemp()), model, "copyVSfact", cache_dir=None)
+        tokenizer = model.get_tokenizer()
+        for source, vectors in [("unembed", model.unembed().T), ("embed", model.embed())]:
+            dataset.similarity_source = source
+            dataset.__compute_similarity_scores__()
+            for d in dataset.full_data:
+                true_token = tokenizer(d["target_true"], add_special_tokens=False)["input_ids"][0]
+                new_token = tokenizer(d["target_new"], add_special_tokens=False)["input_ids"][0]
+                expected = torch.nn.functional.cosine_similarity(vectors[true_token], vectors[new_token], dim=0)
+                self.assertAlmostEqual(d["similarity_score"], expected.item(), places=5)
+
+
+@unittest.skipUnless(KeyedVectors is not None, "gensim is not installed")
+class TestWordVectors(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.word_vectors = toy_word_vectors()
+        self.word_vectors_path = os.path.join(self.directory, "toy.kv")
+        self.word_vectors.save(self.word_vectors_path)
+
+    def test_pair_similarity(self):
+        pairs = [("France", "Italy"), ("Paris", "Rome"), ("France", "Paris"), ("France", "Berlin")]
+        scores = pair_similarity(self.word_vectors, pairs)
+        expected = [self.word_vectors.similarity(first, second) for first, second in pairs[:3]]
+        np.testing.assert_allclose(scores[:3], expected, rtol=1e-6)
+        self.assertEqual(scores[3], MISSING_SCORE)
+        self.assertEqual(pair_similarity(self.word_vectors, [("Berlin", "Madrid")]).tolist(), [MISSING_SCORE])
+
+    def test_load_local_word_vectors(self):
+        with mock.patch("gensim.downloader.load", side_effect=AssertionError("downloaded a local model")):
+            word_vectors = load_word_vectors(self.word_vectors_path)
+        np.testing.assert_array_equal(word_vectors.vectors, self.word_vectors.vectors)
+        self.assertEqual(word_vectors.key_to_index, self.word_vectors.key_to_index)
+
+    def test_scorer_round_trip(self):
+        score_path = os.path.join(self.directory, "scores", "toy.pt")
+        scorer = SimilarityScorer(score_path, word_vectors_path=self.word_vectors_path)
+        pairs = [(" France", " Italy"), (" Paris", " Rome"), (" France", " Italy"), (" France", " Berlin")]
+        scores = scorer(pairs)
+        self.assertTrue(os.path.exists(score_path))
+        self.assertEqual(set(scorer.scores), {("France", "Italy"), ("Paris", "Rome"), ("France", "Berlin")})
+
+        # a new scorer serves the persisted scores without loading the word vectors
+        with mock.patch("Src.similarity.load_word_vectors", side_effect=AssertionError("loaded the word vectors")):
+            reloaded = SimilarityScorer(score_path, word_vectors_path=self.word_vectors_path)
+            np.testing.assert_array_equal(reloaded(pairs), scores)
+        self.assertEqual(reloaded.scores, scorer.scores)
+
+        # only the new pairs are scored
+        with mock.patch("Src.similarity.pair_similarity", wraps=pair_similarity) as scored:
+            reloaded(pairs + [("Rome", "Paris")])
+        self.assertEqual(scored.call_args.args[1], [("Rome", "Paris")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import torch
+from toy_model import ToyHookedTransformer, toy_records, write_records
+from Src.dataset import BaseDataset
+from Src.tokenization import BatchTokenizer, locate_char_spans, template_field_spans
+
+
+class TestBatchTokenizer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = ToyHookedTransformer()
+
+    def fresh(self, text):
+        return torch.tensor(self.model.get_tokenizer()(text, add_special_tokens=False)["input_ids"], dtype=torch.long)
+
+    def test_memo_hits_match_fresh_tokenization(self):
+        texts = [" Italy", " Paris is the capital of", " Italy", " France", "Rome", " Italy"]
+        # a small batch size splits the calls in several chunks
+        tokenizer = BatchTokenizer(self.model, batch_size=2)
+        first = tokenizer(texts)
+        self.assertEqual(sorted(tokenizer.memo), sorted(set(texts)))
+        with mock.patch.object(self.model, "tokenize_batch", side_effect=AssertionError("memo miss")):
+            second = tokenizer(texts)
+            encoded = tokenizer.encode(" France")
+        for text, ids, memo_ids in zip(texts, first, second):
+            self.assertTrue(torch.equal(ids, self.fresh(text)), text)
+            self.assertIs(memo_ids, tokenizer.memo[text])
+        self.assertTrue(torch.equal(encoded, self.fresh(" France")))
+
+        # prompts are not memoized
+        prompts = tokenizer(["Redefine : Rome is in", "Imagine : Paris is in"], memoize=False)
+        self.assertEqual(len(tokenizer.memo), len(set(texts)))
+        self.assertTrue(torch.equal(prompts[1], self.fresh("Imagine : Paris is in")))
+        tokenizer.clear()
+        self.assertEqual(tokenizer.memo, {})
+
+    def test_offsets_match_fresh_tokenization(self):
+        tokenizer = BatchTokenizer(self.model, batch_size=2)
+        texts = ["Redefine : Rome is in", "Imagine : Paris is the capital of", " Italy"]
+        input_ids, offsets = tokenizer.encode_with_offsets(texts)
+        for text, ids, text_offsets in zip(texts, input_ids, offsets):
+            self.assertTrue(torch.equal(ids, self.fresh(text)))
+            self.assertEqual(len(text_offsets), len(ids))
+            self.assertEqual(self.model.get_tokenizer().decode(ids.tolist()), " ".join(text[s:e] for s, e in text_offsets))
+
+    def test_dataset_has_no_disk_cache_by_default(self):
+        directory = tempfile.mkdtemp()
+        path = write_records(toy_records(), directory)
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            dataset = BaseDataset(path, self.model, "copyVSfact")
+        finally:
+            os.chdir(cwd)
+        self.assertIsNone(dataset.cache)
+        self.assertEqual(os.listdir(directory), ["toy.json"])
+
+
+class TestLocateCharSpans(unittest.TestCase):
+    def test_spans(self):
+        # "ab cd ef" and "xyz" tokenized as words with their leading space
+        offsets = [[(0, 2), (2, 5), (5, 8)], [(0, 3)]]
+        char_spans = np.array(
+            [
+                [(3, 5), (0, 8), (-1, -1)],
+                # a span starting inside a token and ending inside another covers both
+                [(1, 2), (4, 3), (0, 3)],
+            ],
+            dtype=np.int64,
+        )
+        token_spans = locate_char_spans(offsets, char_spans)
+        np.testing.assert_array_equal(token_spans[0], [[1, 1], [0, 2], [-1, -1]])
+        # empty spans are missing
+        np.testing.assert_array_equal(token_spans[1], [[0, 0], [-1, -1], [0, 0]])
+
+    def test_span_beyond_the_text(self):
+        token_spans = locate_char_spans([[(0, 2)], []], np.array([[(5, 7)], [(0, 1)]], dtype=np.int64))
+        np.testing.assert_array_equal(token_spans, [[[-1, -1]], [[-1, -1]]])
+
+
+class TestTemplateFieldSpans(unittest.TestCase):
+    def check(self, template, args):
+        prompt = template.format(*args)
+        spans = template_field_spans(template, args)
+        for index, start, end in spans:
+            self.assertEqual(prompt[start:end], args[index])
+        return spans
+
+    def test_auto_numbered(self):
+        spans = self.check("{}: Paris is the capital of{}.", ("Redefine", " Italy"))
+        self.assertEqual([index for index, _, _ in spans], [0, 1])
+
+    def test_escaped_braces_and_explicit_indices(self):
+        spans = self.check("{{note}} {1} then {0}, again {1}", ("Redefine", " Italy"))
+        self.assertEqual([(index, start) for index, start, _ in spans], [(1, 7), (0, 19), (1, 35)])
+
+    def test_format_spec(self):
+        spans = template_field_spans("{0:>10}|{1!r}", ("Redefine", "Italy"))
+        self.assertEqual(spans, [(0, 0, 10), (1, 11, 18)])
+
+
+class TestCharSpans(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        model = ToyHookedTransformer()
+        path = write_records(toy_records(), tempfile.mkdtemp())
+        cls.dataset = BaseDataset(path, model, "copyVSfact", cache_dir=None)
+
+    def spans(self, template, subject="Rome", target_new=" Italy"):
+        d = {"template": template, "subject": subject, "target_new": target_new}
+        prompt = self.dataset.__get_prompt__(d)
+        return prompt, self.dataset.__get_char_spans__(d, prompt)
+
+    def test_object_from_the_template_fields(self):
+        for template in [
+            "{}: Rome is in{}. Rome is in",
+            "{{Rome}} {}: Rome is in{}. Rome is in",
+            "{0}: Rome is in{1}. Rome is in",
+        ]:
+            prompt, (_, _, (start, end)) = self.spans(template)
+            self.assertEqual(prompt[start:end], "Italy")
+            self.assertEqual(prompt[:start].count("Italy"), 0)
+
+    def test_object_equal_to_the_premise(self):
+        prompt, (_, _, (start, end)) = self.spans("{}: Rome is in{}. Rome is in", target_new=" Redefine")
+        self.assertEqual(prompt[start:end], "Redefine")
+        self.assertGreater(start, 0)
+
+    def test_second_subject_at_a_word_boundary(self):
+        # the first bare match of the second subject is inside "Romeo"
+        prompt, (first, second, _) = self.spans("{}: Rome is in{}. Romeo and Rome is in")
+        self.assertEqual(prompt[first[0] : first[1]], "Rome")
+        self.assertEqual(second[0], prompt.index(" Rome is in", first[1]) + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
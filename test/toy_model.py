@@ -0,0 +1,110 @@
+import json
+import os
+import sys
+import tempfile
+from typing import Dict, List
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import AutoTokenizer, GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+from Src.model import WrapAutoModelForCausalLM, WrapHookedTransformer
+
+# tiny whitespace vocabulary: the tests run offline, without downloading a pretrained tokenizer
+WORDS = [
+    "<|endoftext|>", "Redefine", "Imagine", "Suppose", ":", ".", "is", "the", "capital", "of", "a", "city", "in",
+    "Paris", "Rome", "Berlin", "Madrid", "France", "Italy", "Germany", "Spain", "Europe", "and",
+]
+
+RECORDS = [
+    {"subject": "Paris", "target_true": " France", "target_new": " Italy"},
+    {"subject": "Rome", "target_true": " Italy", "target_new": " Spain"},
+    {"subject": "Berlin", "target_true": " Germany", "target_new": " France"},
+    {"subject": "Madrid", "target_true": " Spain", "target_new": " Germany"},
+]
+
+
+def toy_tokenizer() -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.WordLevel({w: i for i, w in enumerate(WORDS)}, unk_token="<|endoftext|>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    special = "<|endoftext|>"
+    fast = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token=special, eos_token=special, pad_token=special, unk_token=special
+    )
+    # HookedTransformer reloads the tokenizer by name, so it has to live on disk
+    directory = tempfile.mkdtemp()
+    fast.save_pretrained(directory)
+    return AutoTokenizer.from_pretrained(directory)
+
+
+class ToyHookedTransformer(WrapHookedTransformer):
+    """
+    Randomly initialized HookedTransformer with the toy tokenizer, registered as gpt2 (space-prefixed predictions)
+    """
+
+    def __init__(self, normalization_type: str = "LN", n_layers: int = 3, seed: int = 0):
+        super().__init__("gpt2", normalization_type, n_layers, seed)
+
+    def initialize_model(self, model_name: str, normalization_type: str, n_layers: int, seed: int):
+        cfg = HookedTransformerConfig(
+            n_layers=n_layers,
+            d_model=16,
+            n_ctx=32,
+            d_head=4,
+            n_heads=4,
+            d_mlp=32,
+            d_vocab=len(WORDS),
+            act_fn="gelu",
+            normalization_type=normalization_type,
+            seed=seed,
+            device="cpu",
+        )
+        self.model = HookedTransformer(cfg, tokenizer=toy_tokenizer())
+        self.model.eval()
+        self.device = "cpu"
+        self.tokenizer = self.model.tokenizer
+        self.cfg.update_config(n_layers=cfg.n_layers, n_heads=cfg.n_heads, full_config=self.model.cfg)
+
+
+class ToyAutoModelForCausalLM(WrapAutoModelForCausalLM):
+    """
+    Randomly initialized HuggingFace GPT-2 with the toy tokenizer, registered as gpt2
+    """
+
+    def __init__(self, n_layers: int = 2, seed: int = 0):
+        super().__init__("gpt2", "cpu", n_layers, seed)
+
+    def initialize_model(self, model_name: str, device: str, n_layers: int, seed: int):
+        torch.manual_seed(seed)
+        config = GPT2Config(vocab_size=len(WORDS), n_positions=32, n_embd=16, n_layer=n_layers, n_head=4)
+        self.model = GPT2LMHeadModel(config).eval()
+        self.tokenizer = toy_tokenizer()
+        self.device = "cpu"
+        self.cfg.update_config(n_layers=config.n_layer, n_heads=config.n_head, full_config=config)
+
+
+def toy_records(n_repeats: int = 1) -> List[Dict]:
+    """
+    copyVSfact records: the templates have a different number of words, so the prompts have a few different lengths
+    """
+    templates = [
+        "{} : {subject} is the capital of{} . {subject} is the capital of",
+        "{} : {subject} is a city in{} . {subject} is the capital of",
+        "{} : {subject} is a city in Europe and the capital of{} . {subject} is the capital of",
+    ]
+    records = []
+    for _ in range(n_repeats):
+        for template in templates:
+            for record in RECORDS:
+                records.append(
+                    dict(record, template=template.replace("{subject}", record["subject"]), prompt="")
+                )
+    return records
+
+
+def write_records(records: List[Dict], directory: str, name: str = "toy.json") -> str:
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        json.dump(records, f)
+    return path